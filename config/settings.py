@@ -65,8 +65,14 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Banco de teste em arquivo: o teste do materializar_agenda --workers abre outros processos
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
+# journal_mode=WAL em cada conexão (core/signals.py): leitores não esperam a gravação terminar,
+# o que ajuda o materializar_agenda --workers e o servidor com vários processos. Muda o formato do
+# arquivo do banco (cria -wal/-shm ao lado), por isso é opcional
+SQLITE_WAL = config('SQLITE_WAL', default=False, cast=bool)
 
 LANGUAGE_CODE = 'pt-br'
 TIME_ZONE = 'America/Sao_Paulo'
@@ -79,6 +85,27 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# --- AGENDA FIXA ---
+# Sessões futuras da grade são projetadas na hora (sem linha no banco) e só viram
+# Agendamento quando alguém interage com elas ou quando entram no horizonte abaixo
+AGENDA_OCORRENCIAS_VIRTUAIS = config('AGENDA_OCORRENCIAS_VIRTUAIS', default=True, cast=bool)
+# Janela rolante (em semanas) até onde a grade fixa é materializada em Agendamentos
+AGENDA_HORIZONTE_SEMANAS = config('AGENDA_HORIZONTE_SEMANAS', default=2 if AGENDA_OCORRENCIAS_VIRTUAIS else 16, cast=int)
+# Tarefa da fila EXECUTANDO há mais que isso (minutos) é tida como abandonada e volta a PENDENTE
+AGENDA_TAREFA_TEMPO_LIMITE = config('AGENDA_TAREFA_TEMPO_LIMITE', default=30, cast=int)
+# Cache compartilhado entre os processos (ex.: redis://127.0.0.1:6379/1, exige o pacote redis).
+# Sem ele fica o LocMemCache padrão, que vale só para o próprio processo
+CACHE_REDIS_URL = config('CACHE_REDIS_URL', default='')
+if CACHE_REDIS_URL:
+    CACHES = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': CACHE_REDIS_URL}}
+# Grade semanal renderizada, .ics e respostas 304 do feed servidos do cache, invalidados por data
+# (ver core/cache_agenda.py). As versões das datas ficam no cache: com LocMemCache e vários
+# processos um worker não vê a troca feita por outro, por isso só liga sozinho com o Redis acima
+AGENDA_CACHE_GRADE = config('AGENDA_CACHE_GRADE', default=bool(CACHE_REDIS_URL), cast=bool)
+# Agenda ao vivo (SSE, exige servir por config/asgi.py). Sem isso os avisos só chegam às conexões do
+# mesmo processo que gravou; ligado, as datas alteradas passam pela tabela AlteracaoAgenda
+AGENDA_ALTERACOES_BANCO = config('AGENDA_ALTERACOES_BANCO', default=False, cast=bool)
+
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'dashboard'
 LOGOUT_REDIRECT_URL = 'login'
@@ -7,11 +7,18 @@ from django.conf.urls.static import static
 from core.views import (
     dashboard,
     lista_pacientes, 
+    buscar_pacientes,
     cadastro_paciente, 
     editar_paciente,
     lista_agendamentos, 
+    grade_semana,
+    feed_agenda,
+    eventos_agenda,
+    calendario_terapeuta,
+    renovar_calendario,
     novo_agendamento,
     reposicao_agendamento,
+    abrir_ocorrencia,
     realizar_consulta,
     detalhe_paciente,
     confirmar_agendamento, 
@@ -19,6 +26,7 @@ from core.views import (
     excluir_agendamento,
     limpar_dia,
     lista_consultas_geral,
+    buscar_prontuarios,
     cadastrar_equipe,
     lista_terapeutas,
     relatorio_mensal,
@@ -27,6 +35,8 @@ from core.views import (
     nova_agenda_fixa, 
     editar_agenda_fixa, 
     excluir_agenda_fixa,
+    status_tarefa,
+    horarios_livres,
     ocupacao_salas,
     relatorio_grade_pacientes, 
     relatorio_atrasos,
@@ -48,14 +58,23 @@ urlpatterns = [
     path('', dashboard, name='dashboard'),
 
     path('pacientes/', lista_pacientes, name='lista_pacientes'),
+    path('pacientes/buscar/', buscar_pacientes, name='buscar_pacientes'),
     path('pacientes/novo/', cadastro_paciente, name='cadastro_paciente'),
     path('pacientes/editar/<int:paciente_id>/', editar_paciente, name='editar_paciente'),
     path('paciente/<int:paciente_id>/', detalhe_paciente, name='detalhe_paciente'),
     
     path('agendamentos/', lista_agendamentos, name='lista_agendamentos'),
+    path('agendamentos/grade-semana/', grade_semana, name='grade_semana'),
+    path('agendamentos/feed/', feed_agenda, name='feed_agenda'),
+    path('agendamentos/eventos/', eventos_agenda, name='eventos_agenda'),
+    path('calendario/renovar/', renovar_calendario, name='renovar_calendario'),
+    path('calendario/<str:token>.ics', calendario_terapeuta, name='calendario_terapeuta'),
     path('agendamentos/novo/', novo_agendamento, name='novo_agendamento'),
     path('agendamentos/reposicao/<int:agendamento_id>/', reposicao_agendamento, name='reposicao_agendamento'),
+    path('agendamentos/horarios-livres/', horarios_livres, name='horarios_livres'),
+    path('agendamentos/ocorrencia/<int:agenda_id>/<str:data>/', abrir_ocorrencia, name='abrir_ocorrencia'),
     path('consultas/historico/', lista_consultas_geral, name='lista_consultas_geral'),
+    path('consultas/prontuarios/', buscar_prontuarios, name='buscar_prontuarios'),
     
     path('agendamentos/confirmar/<int:agendamento_id>/', confirmar_agendamento, name='confirmar_agendamento'),
     path('agendamentos/atender/<int:agendamento_id>/', realizar_consulta, name='realizar_consulta'),
@@ -73,6 +92,7 @@ urlpatterns = [
     path('agenda-fixa/nova/', nova_agenda_fixa, name='nova_agenda_fixa'),
     path('agenda-fixa/editar/<int:id>/', editar_agenda_fixa, name='editar_agenda_fixa'),
     path('agenda-fixa/excluir/<int:id>/', excluir_agenda_fixa, name='excluir_agenda_fixa'),
+    path('agenda-fixa/tarefa/<int:tarefa_id>/', status_tarefa, name='status_tarefa'),
 
     # --- Area da Equipe ---
     path('equipe/novo/', cadastrar_equipe, name='cadastrar_equipe'),
@@ -1,16 +1,27 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
-from .models import Paciente, Terapeuta, Agendamento, Consulta, Convenio, Sala, AgendaFixa, AnexoConsulta
-from .utils import gerar_agenda_futura
+from .models import Paciente, Terapeuta, Agendamento, Consulta, Convenio, Sala, AgendaFixa, AnexoConsulta, TarefaMaterializacao
+from django.db import transaction
+from .utils import enfileirar_materializacao, planejar_agenda_futura, ressincronizar_agenda_fixa
 
 # --- Ação customizada para gerar agenda em massa ---
 @admin.action(description='Gerar agenda futura para os selecionados (Materializar)')
 def acao_gerar_agenda(modeladmin, request, queryset):
-    # Nota: O queryset aqui não é muito usado pois a função gera para todos os ativos,
+    # Nota: O queryset aqui não é muito usado pois a materialização roda para todos os ativos,
     # mas mantemos o padrão do Django Admin.
-    total = gerar_agenda_futura() 
-    modeladmin.message_user(request, f"Processo concluído. {total} novos agendamentos criados no total baseados na grade ativa.")
+    tarefa = enfileirar_materializacao()
+    modeladmin.message_user(request, f"Materialização enfileirada (tarefa #{tarefa.id}). Acompanhe em Tarefas de Materialização.")
+
+@admin.action(description='Simular materialização (sem gravar)')
+def acao_simular_agenda(modeladmin, request, queryset):
+    plano = planejar_agenda_futura()
+    modeladmin.message_user(
+        request,
+        f"Simulação: {len(plano.criar)} agendamentos seriam criados, {len(plano.atualizar)} atualizados "
+        f"e {len(plano.pulos)} datas puladas por conflito com outro paciente "
+        f"({len(plano.conflitos_sala)} com sala já ocupada)."
+    )
 
 # --- 1. Usuários (Customização para mostrar grupos) ---
 class UserAdmin(BaseUserAdmin):
@@ -51,16 +62,28 @@ class AgendamentoAdmin(admin.ModelAdmin):
 # --- 3. Agenda Fixa (NOVO) ---
 @admin.register(AgendaFixa)
 class AgendaFixaAdmin(admin.ModelAdmin):
-    list_display = ('get_dia_semana_display', 'hora_inicio', 'paciente', 'terapeuta', 'sala', 'ativo')
+    list_display = ('get_dia_semana_display', 'hora_inicio', 'paciente', 'terapeuta', 'sala', 'ativo', 'materializado_ate')
     list_filter = ('dia_semana', 'terapeuta', 'sala', 'ativo')
     search_fields = ('paciente__nome', 'terapeuta__nome')
     ordering = ('dia_semana', 'hora_inicio')
-    actions = [acao_gerar_agenda] 
+    actions = [acao_gerar_agenda, acao_simular_agenda]
+
+    def save_model(self, request, obj, form, change):
+        with transaction.atomic():
+            super().save_model(request, obj, form, change)
+            if change:
+                ressincronizar_agenda_fixa(obj)
+
+@admin.register(TarefaMaterializacao)
+class TarefaMaterializacaoAdmin(admin.ModelAdmin):
+    list_display = ('id', 'agenda_fixa', 'status', 'progresso', 'resultado', 'criado_em', 'concluido_em')
+    list_filter = ('status',)
+    readonly_fields = ('status', 'total', 'processados', 'resultado', 'erro', 'iniciado_em', 'concluido_em')
 
 # --- 4. Salas (NOVO) ---
 @admin.register(Sala)
 class SalaAdmin(admin.ModelAdmin):
-    list_display = ('nome',)
+    list_display = ('nome', 'compartilhada')
     search_fields = ('nome',)
 
 # --- 5. Outros Modelos ---
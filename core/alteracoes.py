@@ -0,0 +1,63 @@
+"""Avisos de alteração da agenda para as telas abertas (eventos SSE de `eventos_agenda`).
+
+Toda gravação que troca versões em `cache_agenda` chama `publicar` depois do commit com as datas
+afetadas. Cada conexão SSE deste processo tem sua fila asyncio e recebe o aviso na hora.
+
+Com vários processos (workers WSGI gravando, um processo ASGI servindo os eventos) o aviso em
+memória não atravessa processos. Ligando AGENDA_ALTERACOES_BANCO, as datas também vão para a
+tabela AlteracaoAgenda e cada conexão consulta o que entrou depois do último id visto.
+"""
+import asyncio
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+TUDO = '*'  # Mudança que vale para todas as datas
+GUARDAR_POR = timedelta(days=1)
+
+_filas = set()
+
+def assinar():
+    """Fila que recebe, a cada alteração, o conjunto de datas ('AAAA-MM-DD' ou TUDO). Chamar dentro do event loop."""
+    fila = asyncio.Queue()
+    _filas.add((asyncio.get_running_loop(), fila))
+    return fila
+
+def cancelar(fila):
+    for assinatura in [a for a in _filas if a[1] is fila]:
+        _filas.discard(assinatura)
+
+def publicar(datas):
+    """Avisa as conexões deste processo (e grava na tabela, se ligada). `datas` vazio/None = TUDO."""
+    datas = {str(d) for d in datas} if datas else {TUDO}
+    if settings.AGENDA_ALTERACOES_BANCO:
+        _registrar(datas)
+    for loop, fila in list(_filas):
+        # Chamado de threads síncronas (views, signals): a fila só pode ser mexida no loop dela
+        try:
+            loop.call_soon_threadsafe(fila.put_nowait, set(datas))
+        except RuntimeError:  # loop já encerrado
+            _filas.discard((loop, fila))
+
+def _registrar(datas):
+    from .models import AlteracaoAgenda
+
+    criadas = AlteracaoAgenda.objects.bulk_create([AlteracaoAgenda(data=None if d == TUDO else d) for d in datas])
+    # Limpeza de tempos em tempos; ninguém precisa de alterações antigas
+    if any(a.id and a.id % 500 == 0 for a in criadas):
+        AlteracaoAgenda.objects.filter(criado_em__lt=timezone.now() - GUARDAR_POR).delete()
+
+def ultimo_id():
+    from .models import AlteracaoAgenda
+    return AlteracaoAgenda.objects.order_by('-id').values_list('id', flat=True).first() or 0
+
+def alteracoes_desde(ultimo):
+    """(novo último id, datas alteradas depois de `ultimo`) pela tabela AlteracaoAgenda."""
+    from .models import AlteracaoAgenda
+
+    datas = set()
+    for id_, data in AlteracaoAgenda.objects.filter(id__gt=ultimo).values_list('id', 'data'):
+        ultimo = id_
+        datas.add(str(data) if data else TUDO)
+    return ultimo, datas
@@ -0,0 +1,98 @@
+"""Índice em memória dos bloqueios fixos semanais.
+
+Os bloqueios mudam raramente e são consultados em todo formulário de agendamento e em toda
+montagem de grade. Por isso ficam compilados uma vez por processo: para cada (terapeuta, dia da
+semana) um bitmap com um bit por minuto do dia, mais a lista dos bloqueios já expandida nos
+slots visuais da grade da clínica.
+
+Cada processo guarda sua cópia. Uma versão no cache do Django (trocada pelos signals de
+BloqueioFixo) avisa os demais processos que precisam recompilar. Com cache compartilhado a
+versão não expira e a troca chega na hora a todos. Com o LocMemCache (uma cópia da versão por
+processo) ela expira em VALIDADE_VERSAO segundos, o prazo em que outro worker ainda pode usar
+os bloqueios antigos.
+"""
+from collections import defaultdict
+import uuid
+
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from .grade import indices_intervalo
+from .utils import horarios_clinica
+
+CHAVE_VERSAO = 'bloqueios_fixos:versao'
+VALIDADE_VERSAO = 10  # segundos, só com LocMemCache; recompilar custa uma consulta
+
+_indice = {'versao': None}
+
+def _minutos(hora):
+    return hora.hour * 60 + hora.minute
+
+def mascara_minutos(hora_inicio, hora_fim):
+    """Bits dos minutos do dia em [hora_inicio, hora_fim)."""
+    inicio, fim = _minutos(hora_inicio), _minutos(hora_fim)
+    if fim <= inicio: return 0
+    return ((1 << (fim - inicio)) - 1) << inicio
+
+def _validade():
+    return VALIDADE_VERSAO if isinstance(caches['default'], LocMemCache) else None
+
+def _versao_atual():
+    return cache.get_or_set(CHAVE_VERSAO, lambda: uuid.uuid4().hex, _validade())
+
+def _compilar():
+    from .models import BloqueioFixo
+
+    bitmaps = defaultdict(int)
+    por_dia = defaultdict(list)
+    for b in BloqueioFixo.objects.select_related('terapeuta').order_by('hora_inicio', 'id'):
+        b.tipo_obj = 'bloqueio'
+        b.indices_grade = indices_intervalo(b.hora_inicio, b.hora_fim)
+        bitmaps[(b.terapeuta_id, b.dia_semana)] |= mascara_minutos(b.hora_inicio, b.hora_fim)
+        por_dia[b.dia_semana].append(b)
+    projecao = {dia: _por_slot(bloqueios) for dia, bloqueios in por_dia.items()}
+    return dict(bitmaps), dict(por_dia), projecao
+
+def _por_slot(bloqueios):
+    slots = [[] for _ in horarios_clinica()]
+    for b in bloqueios:
+        for i in b.indices_grade:
+            slots[i].append(b)
+    return slots
+
+def _carregar():
+    versao = _versao_atual()
+    if _indice['versao'] != versao:
+        bitmaps, por_dia, projecao = _compilar()
+        _indice.update(versao=versao, bitmaps=bitmaps, por_dia=por_dia, projecao=projecao)
+    return _indice
+
+def invalidar():
+    """Descarta o índice (deste e dos demais processos). Chamado pelos signals de BloqueioFixo."""
+    cache.set(CHAVE_VERSAO, uuid.uuid4().hex, _validade())
+    _indice['versao'] = None
+
+def esta_bloqueado(terapeuta_id, dia_semana, hora_inicio, hora_fim):
+    """True se o intervalo [hora_inicio, hora_fim) cruza algum bloqueio fixo do terapeuta."""
+    return bool(mascara_bloqueios(terapeuta_id, dia_semana) & mascara_minutos(hora_inicio, hora_fim))
+
+def mascara_bloqueios(terapeuta_id, dia_semana):
+    """Bitmap de minutos bloqueados do terapeuta no dia da semana (0 se nenhum)."""
+    return _carregar()['bitmaps'].get((terapeuta_id, int(dia_semana)), 0)
+
+def bloqueios_do_dia(dia_semana, terapeutas=None):
+    """Bloqueios de um dia da semana, já com `indices_grade` (posições dos slots visuais cobertos).
+    `terapeutas` restringe a uma lista de ids; None traz todos."""
+    bloqueios = _carregar()['por_dia'].get(int(dia_semana), [])
+    if terapeutas is None:
+        return bloqueios
+    terapeutas = {int(t) for t in terapeutas}
+    return [b for b in bloqueios if b.terapeuta_id in terapeutas]
+
+def projecao_semanal(terapeutas=None):
+    """{dia da semana: uma lista por slot da grade com os bloqueios que o cobrem}, pronta para `Grade.carimbar`.
+    Sem filtro vem do índice compilado; com `terapeutas` é montada uma vez por chamada, não por data."""
+    indice = _carregar()
+    if terapeutas is None:
+        return indice['projecao']
+    return {dia: _por_slot(bloqueios_do_dia(dia, terapeutas)) for dia in indice['por_dia']}
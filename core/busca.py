@@ -0,0 +1,122 @@
+"""Busca de pacientes por nome (sem acento), CPF, telefone ou carteirinha.
+
+No SQLite a busca usa a tabela FTS5 `core_paciente_busca` (tokenizador trigram), criada na
+migração 0037 e mantida por triggers em core_paciente. Qualquer trecho de 3+ caracteres é
+encontrado pelo índice, sem varrer a tabela. Os resultados vêm ordenados: primeiro quem começa
+com o termo, depois quem tem uma palavra começando com ele, depois em ordem alfabética. Sem nenhum
+resultado exato, uma segunda consulta por trigramas soltos acha nomes com erro de digitação.
+
+Em outros bancos (ou sem FTS5) `buscar` devolve None e quem chama filtra com icontains. No
+Postgres a migração cria um índice pg_trgm em nome_search, que acelera esse mesmo icontains.
+
+Migrações que recriam core_paciente no SQLite (AlterField) descartam os triggers. `disponivel`
+confere os triggers e, sem eles, a busca volta ao icontains até o índice ser refeito.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+
+from .models import Paciente
+from .normalizacao import chave_busca
+
+LIMITE = 500
+TRIGGERS = {'core_paciente_busca_ai', 'core_paciente_busca_au', 'core_paciente_busca_ad'}
+SIMILARIDADE_MINIMA = 0.5
+CANDIDATOS_APROXIMADOS = 500
+
+_estado = {'disponivel': None}
+
+def disponivel():
+    """True se o índice FTS5 existe com seus triggers (checado uma vez por processo)."""
+    if _estado['disponivel'] is None:
+        if connection.vendor != 'sqlite':
+            _estado['disponivel'] = False
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT name FROM sqlite_master WHERE (type = 'table' AND name = 'core_paciente_busca') "
+                    "OR (type = 'trigger' AND tbl_name = 'core_paciente')"
+                )
+                nomes = {nome for (nome,) in cursor.fetchall()}
+            _estado['disponivel'] = {'core_paciente_busca'} | TRIGGERS <= nomes
+    return _estado['disponivel']
+
+def normalizar(termo):
+    """Minúsculas sem acento; CPF/telefone digitados com pontuação viram só dígitos."""
+    termo = chave_busca(termo or '').strip()
+    if re.fullmatch(r'[\d\s.\-/()]+', termo):
+        return re.sub(r'\D', '', termo)
+    return ' '.join(termo.split())
+
+def _frase(texto):
+    return '"' + texto.replace('"', '""') + '"'
+
+def _trigramas(texto):
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def buscar(termo, limite=LIMITE):
+    """Ids dos pacientes que casam com `termo`, do mais para o menos relevante (até `limite`).
+    None quando o índice não está disponível."""
+    if not disponivel():
+        return None
+    termo = normalizar(termo)
+    if not termo:
+        return []
+
+    palavras = termo.split()
+    longas = [p for p in palavras if len(p) >= 3]
+    curtas = [p for p in palavras if len(p) < 3]
+    if not longas:
+        # Trigramas precisam de 3 caracteres: 1-2 letras só pelo começo do nome ou do CPF (faixa no índice B-tree)
+        fim = termo + '\uffff'
+        return list(Paciente.objects.filter(
+            Q(nome_search__gte=termo, nome_search__lt=fim) | Q(cpf__gte=termo, cpf__lt=fim)
+        ).order_by('nome_search').values_list('id', flat=True)[:limite])
+
+    # Todas as palavras longas pelo índice; as curtas como trecho do texto dos que sobraram
+    sql = ["SELECT rowid FROM core_paciente_busca WHERE core_paciente_busca MATCH %s"]
+    parametros = [' AND '.join(_frase(p) for p in longas)]
+    for palavra in curtas:
+        sql.append("AND instr(texto, %s) > 0")
+        parametros.append(palavra)
+    # Ordem por faixas (começo do nome, começo de palavra) e alfabética dentro delas: o bm25 (rank)
+    # custa caro quando um sobrenome comum casa com milhares de cadastros e não diz muito em trigramas
+    sql.append("ORDER BY substr(texto, 1, %s) = %s DESC, instr(' ' || texto, %s) > 0 DESC, texto LIMIT %s")
+    parametros += [len(termo), termo, ' ' + palavras[0], limite]
+    with connection.cursor() as cursor:
+        cursor.execute(' '.join(sql), parametros)
+        ids = [id_ for (id_,) in cursor.fetchall()]
+    if ids:
+        return ids
+    return _aproximados(termo, limite)
+
+def _aproximados(termo, limite):
+    """Erro de digitação: candidatos que dividem um trecho de 4 letras (3 em palavras curtas) com o
+    termo, filtrados pela fração dos trigramas do termo que aparecem no texto."""
+    palavras = [p for p in termo.split() if len(p) >= 3]
+    trigramas = set().union(*(_trigramas(p) for p in palavras))
+    # 4 letras seguidas são bem mais raras que 3: poucos candidatos, consulta barata
+    trechos = set().union(*({p[i:i + 4] for i in range(len(p) - 3)} if len(p) >= 6 else _trigramas(p) for p in palavras))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT rowid, texto FROM core_paciente_busca WHERE core_paciente_busca MATCH %s LIMIT %s",
+            [' OR '.join(_frase(t) for t in sorted(trechos)), CANDIDATOS_APROXIMADOS],
+        )
+        candidatos = cursor.fetchall()
+    pontuados = []
+    for id_, texto in candidatos:
+        similaridade = len(trigramas & _trigramas(texto)) / len(trigramas)
+        if similaridade >= SIMILARIDADE_MINIMA:
+            pontuados.append((-similaridade, texto, id_))
+    return [id_ for _, _, id_ in sorted(pontuados)[:limite]]
+
+def filtrar(pacientes, termo):
+    """Aplica a busca a um queryset de pacientes. Com o índice devolve uma lista na ordem de relevância;
+    sem ele, o queryset filtrado por icontains (a ordem fica com quem chamou)."""
+    ids = buscar(termo)
+    if ids is None:
+        termo_limpo = chave_busca(termo)
+        return pacientes.filter(Q(nome_search__icontains=termo_limpo) | Q(cpf__icontains=termo))
+    posicao = {id_: i for i, id_ in enumerate(ids)}
+    return sorted(pacientes.filter(pk__in=ids), key=lambda p: posicao[p.pk])
@@ -0,0 +1,140 @@
+"""Busca de texto nas evoluções dos prontuários (Consulta.evolucao).
+
+No SQLite a busca usa a tabela FTS5 `core_consulta_busca` (palavras sem acento), criada na migração
+0038 e mantida por triggers em core_consulta: cada gravação do realizar_consulta já entra no índice.
+Palavras soltas casam pelo começo ("convuls" acha convulsão e convulsiva) e trechos entre aspas
+casam como frase. Sem o índice, cada palavra vira um icontains na evolução.
+
+Os resultados saem do mais recente para o mais antigo, paginados por chave (data, hora, id): a
+página seguinte começa depois do último item da anterior, sem OFFSET, e o trecho destacado só é
+montado para os itens da página.
+"""
+import re
+from collections import namedtuple
+from datetime import date, time
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import Agendamento, Consulta
+
+POR_PAGINA = 20
+TRIGGERS = {'core_consulta_busca_ai', 'core_consulta_busca_au', 'core_consulta_busca_ad'}
+PALAVRAS_TRECHO = 24
+CONTEXTO_SEM_INDICE = 80  # caracteres antes e depois da primeira ocorrência, sem o snippet() do FTS5
+INICIO_DESTAQUE, FIM_DESTAQUE = '\x02', '\x03'
+
+Resultado = namedtuple('Resultado', ['agendamento_id', 'data', 'hora_inicio', 'paciente_id', 'paciente_nome', 'terapeuta_nome', 'trecho'])
+
+_estado = {'disponivel': None}
+
+def disponivel():
+    """True se o índice FTS5 existe com seus triggers (checado uma vez por processo)."""
+    if _estado['disponivel'] is None:
+        if connection.vendor != 'sqlite':
+            _estado['disponivel'] = False
+        else:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT name FROM sqlite_master WHERE (type = 'table' AND name = 'core_consulta_busca') "
+                    "OR (type = 'trigger' AND tbl_name = 'core_consulta')"
+                )
+                nomes = {nome for (nome,) in cursor.fetchall()}
+            _estado['disponivel'] = {'core_consulta_busca'} | TRIGGERS <= nomes
+    return _estado['disponivel']
+
+def termos(texto):
+    """[(palavras, é_frase)]: trechos entre aspas ficam juntos, o resto vira palavras soltas."""
+    resultado = []
+    for frase, solta in re.findall(r'"([^"]*)"|(\S+)', texto or ''):
+        if frase:
+            palavras = re.findall(r'\w+', frase)
+            if palavras:
+                resultado.append((palavras, True))
+        else:
+            resultado.extend(([p], False) for p in re.findall(r'\w+', solta))
+    return resultado
+
+def expressao(texto):
+    """Consulta MATCH do FTS5. Só \\w entra nas aspas, então o que o usuário digita nunca vira operador."""
+    return ' AND '.join('"' + ' '.join(palavras) + '"' + ('' if frase else '*') for palavras, frase in termos(texto))
+
+def ler_cursor(valor):
+    """(data, hora, id) de um cursor gerado por `cursor_de`; None se vazio ou inválido."""
+    try:
+        dia, hora, id_ = (valor or '').split('_')
+        return date.fromisoformat(dia), time.fromisoformat(hora), int(id_)
+    except ValueError:
+        return None
+
+def cursor_de(resultado):
+    return f'{resultado.data.isoformat()}_{resultado.hora_inicio.isoformat()}_{resultado.agendamento_id}'
+
+def _destacar(texto):
+    # Escapa o texto do prontuário e só então troca os marcadores pelo <mark>
+    return mark_safe(escape(texto).replace(INICIO_DESTAQUE, '<mark>').replace(FIM_DESTAQUE, '</mark>'))
+
+def _trecho_sem_indice(texto, palavras):
+    padrao = re.compile('|'.join(re.escape(p) for p in palavras), re.IGNORECASE)
+    achado = padrao.search(texto)
+    inicio = max(achado.start() - CONTEXTO_SEM_INDICE, 0) if achado else 0
+    fim = (achado.end() if achado else 0) + CONTEXTO_SEM_INDICE
+    recorte = padrao.sub(lambda m: INICIO_DESTAQUE + m.group(0) + FIM_DESTAQUE, texto[inicio:fim])
+    return ('…' if inicio else '') + recorte + ('…' if fim < len(texto) else '')
+
+def _trechos(ids, texto):
+    if disponivel():
+        marcadores = ', '.join(['%s'] * len(ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid, snippet(core_consulta_busca, 0, %s, %s, '…', %s) FROM core_consulta_busca "
+                f"WHERE core_consulta_busca MATCH %s AND rowid IN ({marcadores})",
+                [INICIO_DESTAQUE, FIM_DESTAQUE, PALAVRAS_TRECHO, expressao(texto), *ids],
+            )
+            return dict(cursor.fetchall())
+    palavras = [p for grupo, _ in termos(texto) for p in grupo]
+    evolucoes = Consulta.objects.filter(pk__in=ids).values_list('pk', 'evolucao')
+    return {id_: _trecho_sem_indice(evolucao, palavras) for id_, evolucao in evolucoes}
+
+def buscar(texto, terapeuta=None, apos=None, limite=POR_PAGINA):
+    """Evoluções que casam com `texto`, mais recentes primeiro: (resultados, cursor da próxima página ou None).
+    Com `terapeuta`, só prontuários dos pacientes que ele atende (a mesma regra do detalhe_paciente)."""
+    grupos = termos(texto)
+    if not grupos:
+        return [], None
+
+    consultas = Consulta.objects.filter(agendamento__deletado=False)
+    if terapeuta is not None:
+        consultas = consultas.filter(
+            agendamento__paciente__in=Agendamento.objects.ativos().filter(terapeuta=terapeuta).values('paciente_id')
+        )
+    if disponivel():
+        consultas = consultas.filter(agendamento_id__in=RawSQL(
+            "SELECT rowid FROM core_consulta_busca WHERE core_consulta_busca MATCH %s", [expressao(texto)]
+        ))
+    else:
+        for palavras, _ in grupos:
+            consultas = consultas.filter(evolucao__icontains=' '.join(palavras))
+
+    chave = ler_cursor(apos)
+    if chave:
+        dia, hora, id_ = chave
+        consultas = consultas.filter(
+            Q(agendamento__data__lt=dia)
+            | Q(agendamento__data=dia, agendamento__hora_inicio__lt=hora)
+            | Q(agendamento__data=dia, agendamento__hora_inicio=hora, agendamento_id__lt=id_)
+        )
+
+    linhas = list(consultas.order_by('-agendamento__data', '-agendamento__hora_inicio', '-agendamento_id').values_list(
+        'agendamento_id', 'agendamento__data', 'agendamento__hora_inicio',
+        'agendamento__paciente_id', 'agendamento__paciente__nome', 'agendamento__terapeuta__nome',
+    )[:limite + 1])
+    mais = len(linhas) > limite
+    linhas = linhas[:limite]
+
+    trechos = _trechos([linha[0] for linha in linhas], texto) if linhas else {}
+    resultados = [Resultado(*linha, _destacar(trechos.get(linha[0], ''))) for linha in linhas]
+    return resultados, cursor_de(resultados[-1]) if mais else None
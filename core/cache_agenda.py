@@ -0,0 +1,104 @@
+"""Cache das grades renderizadas da agenda.
+
+Cada data (e cada mês) tem uma versão no cache do Django, trocada sempre que um agendamento daquela
+data muda (signals de Agendamento e os caminhos em lote: bulk_create, bulk_update, queryset.update).
+Cadastros que aparecem em todas as datas (bloqueios, grades fixas, nomes de pacientes,
+terapeutas e salas) trocam uma versão global. A chave de uma grade junta essas versões com os
+filtros da tela, então qualquer alteração gera uma chave nova e a antiga só expira.
+Cada versão leva junto o instante em que foi trocada, que vira o Last-Modified do feed JSON.
+
+Com mais de um processo servindo o sistema, o backend de CACHES precisa ser compartilhado
+(o LocMemCache padrão vale só para o próprio processo). Sem isso AGENDA_CACHE_GRADE fica
+desligado: grade, .ics e feed são sempre montados e as respostas não levam ETag.
+"""
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import http_date
+
+from . import alteracoes
+
+CHAVE_GLOBAL = 'agenda:versao'
+TEMPO_GRADE = 60 * 60
+
+# Períodos maiores que isso (calendário .ics de um ano) usam as versões por mês: centenas de
+# chaves por consulta estourariam o cache (o LocMemCache guarda só 300 entradas)
+MAX_DATAS_POR_DIA = 31
+
+def _chave_data(data):
+    return f'agenda:versao:{data}'  # date ou 'AAAA-MM-DD'
+
+def _chave_mes(data):
+    return f'agenda:versao:mes:{str(data)[:7]}'
+
+def _nova_versao():
+    return f'{uuid.uuid4().hex}:{int(time.time())}'
+
+def _instante(versao):
+    _, separador, instante = versao.rpartition(':')
+    return int(instante) if separador else 0
+
+def _trocar(chaves):
+    cache.set_many({chave: _nova_versao() for chave in chaves}, None)
+
+def _agora_e_no_commit(chaves, datas=None):
+    # Troca já (a própria transação e os testes veem a mudança) e de novo no commit, para
+    # descartar uma grade que outro request tenha montado com os dados antigos nesse meio tempo.
+    # As telas ao vivo só são avisadas no commit, quando os dados novos já estão visíveis
+    chaves = list(chaves)
+    if not chaves: return
+    _trocar(chaves)
+
+    def no_commit():
+        _trocar(chaves)
+        alteracoes.publicar(datas)
+    transaction.on_commit(no_commit)
+
+def invalidar_datas(datas):
+    """Marca as datas como alteradas. Chamar em todo caminho que grava agendamentos sem save()."""
+    datas = {d for d in datas if d}
+    _agora_e_no_commit({_chave_data(d) for d in datas} | {_chave_mes(d) for d in datas}, datas)
+
+def invalidar_tudo():
+    """Para mudanças que aparecem em qualquer data (bloqueios, grades, cadastros)."""
+    _agora_e_no_commit([CHAVE_GLOBAL])
+
+def _versoes(datas):
+    if len(datas) > MAX_DATAS_POR_DIA:
+        chaves = [CHAVE_GLOBAL] + list(dict.fromkeys(_chave_mes(d) for d in datas))
+    else:
+        chaves = [CHAVE_GLOBAL] + [_chave_data(d) for d in datas]
+    versoes = cache.get_many(chaves)
+    faltando = {c: _nova_versao() for c in chaves if c not in versoes}
+    if faltando:
+        # add: se outro processo criou a versão ao mesmo tempo, vale a dele
+        for chave, versao in faltando.items():
+            cache.add(chave, versao, None)
+        versoes.update(cache.get_many(list(faltando)))
+    return [versoes.get(c, '') for c in chaves]
+
+def _assinatura(versoes, partes):
+    return hashlib.md5('|'.join(versoes + [str(p) for p in partes]).encode()).hexdigest()
+
+def chave_grade(datas, *partes):
+    """Chave da grade das `datas` para a combinação de filtros/perfil em `partes`."""
+    return 'agenda:grade:' + _assinatura(_versoes(datas), partes)
+
+def versao_periodo(datas, *partes):
+    """(etag, último instante de alteração em segundos) das `datas` para `partes`, sem tocar no banco."""
+    versoes = _versoes(datas)
+    return _assinatura(versoes, partes), max(_instante(v) for v in versoes)
+
+def habilitado():
+    """AGENDA_CACHE_GRADE: só com CACHES compartilhado as versões valem para todos os processos."""
+    return settings.AGENDA_CACHE_GRADE
+
+def marcar_versao(resposta, etag, instante):
+    """ETag e Last-Modified da resposta; desligado o cache, nada que o navegador possa revalidar."""
+    if habilitado():
+        resposta['ETag'] = etag
+        resposta['Last-Modified'] = http_date(instante)
@@ -0,0 +1,173 @@
+"""Agenda do terapeuta em iCalendar (.ics), para assinar no celular.
+
+O arquivo sai em pedaços: agendamentos lidos com `.iterator()` só nas colunas usadas, sessões
+projetadas da grade fixa mês a mês e bloqueios fixos como eventos semanais (RRULE) na hora local,
+com a VTIMEZONE do fuso da clínica no cabeçalho. Uma janela de um ano com milhares de eventos
+nunca fica inteira na memória como instâncias de model.
+"""
+from datetime import datetime, timedelta, timezone as tz
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from .utils import projetar_ocorrencias
+
+DIAS_ANTES = 30
+DIAS_DEPOIS = 365
+PEDACO = 500  # eventos por chunk do iterator e por pedaço enviado
+DURACAO_PADRAO = timedelta(minutes=45)
+LIMITE_CACHE = 2 * 1024 * 1024  # calendários maiores são gerados de novo a cada consulta
+SIGLAS_DIAS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+
+def janela(hoje=None):
+    """(início, fim) das datas exportadas: um mês para trás e um ano para frente."""
+    hoje = hoje or timezone.localdate()
+    return hoje - timedelta(days=DIAS_ANTES), hoje + timedelta(days=DIAS_DEPOIS)
+
+def _texto(valor):
+    return str(valor or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _linha(conteudo):
+    # RFC 5545: linhas de até 75 octetos, continuação começa com espaço
+    bruto = conteudo.encode()
+    if len(bruto) <= 75:
+        return conteudo + '\r\n'
+    partes, atual = [], ''
+    for c in conteudo:
+        if len((atual + c).encode()) > (75 if not partes else 74):
+            partes.append(atual)
+            atual = ''
+        atual += c
+    partes.append(atual)
+    return '\r\n '.join(partes) + '\r\n'
+
+def _utc(data, hora, fuso):
+    # fuso resolvido uma vez por arquivo: make_aware consulta o fuso ativo a cada chamada
+    return datetime.combine(data, hora, tzinfo=fuso).astimezone(tz.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def _evento(uid, carimbo, fuso, data, hora_inicio, hora_fim, resumo, local=None, descricao=None, cancelado=False):
+    fim = hora_fim or (datetime.combine(data, hora_inicio) + DURACAO_PADRAO).time()
+    linhas = [
+        'BEGIN:VEVENT', f'UID:{uid}', f'DTSTAMP:{carimbo}',
+        f'DTSTART:{_utc(data, hora_inicio, fuso)}', f'DTEND:{_utc(data, fim, fuso)}', f'SUMMARY:{_texto(resumo)}',
+    ]
+    if local: linhas.append(f'LOCATION:{_texto(local)}')
+    if descricao: linhas.append(f'DESCRIPTION:{_texto(descricao)}')
+    if cancelado: linhas.append('STATUS:CANCELLED')
+    linhas.append('END:VEVENT')
+    return ''.join(_linha(l) for l in linhas)
+
+def _deslocamento(delta):
+    minutos = int(delta.total_seconds()) // 60
+    return f'{"-" if minutos < 0 else "+"}{abs(minutos) // 60:02d}{abs(minutos) % 60:02d}'
+
+def _vtimezone(fuso, data_inicio, data_fim):
+    """VTIMEZONE do fuso (o TZID dos bloqueios aponta para ele): o deslocamento em vigor no início
+    da janela e cada troca de horário até o fim, achadas no zoneinfo dia a dia e depois ao minuto."""
+    def no_fuso(momento):
+        return momento.astimezone(fuso)
+
+    def componente(inicio_local, de, para, local):
+        tipo = 'DAYLIGHT' if local.dst() else 'STANDARD'
+        return [
+            f'BEGIN:{tipo}', f'DTSTART:{inicio_local:%Y%m%dT%H%M%S}', f'TZOFFSETFROM:{_deslocamento(de)}',
+            f'TZOFFSETTO:{_deslocamento(para)}', f'TZNAME:{_texto(local.tzname())}', f'END:{tipo}',
+        ]
+
+    antes = datetime.combine(data_inicio - timedelta(days=1), datetime.min.time(), tzinfo=tz.utc)
+    ultimo = datetime.combine(data_fim + timedelta(days=1), datetime.min.time(), tzinfo=tz.utc)
+    atual = no_fuso(antes)
+    linhas = ['BEGIN:VTIMEZONE', f'TZID:{settings.TIME_ZONE}']
+    linhas += componente(datetime(1970, 1, 1), atual.utcoffset(), atual.utcoffset(), atual)
+    while antes < ultimo:
+        depois = antes + timedelta(days=1)
+        if no_fuso(depois).utcoffset() != atual.utcoffset():
+            while depois - antes > timedelta(minutes=1):
+                meio = antes + (depois - antes) / 2
+                if no_fuso(meio).utcoffset() == atual.utcoffset():
+                    antes = meio
+                else:
+                    depois = meio
+            troca = (antes + timedelta(minutes=1)).replace(second=0, microsecond=0)
+            novo = no_fuso(troca)
+            # DTSTART da troca na hora local de antes dela (RFC 5545)
+            linhas += componente((troca + atual.utcoffset()).replace(tzinfo=None), atual.utcoffset(), novo.utcoffset(), novo)
+            atual = novo
+        antes = depois
+    linhas.append('END:VTIMEZONE')
+    return linhas
+
+def _uid(id_, agenda_fixa_id, data):
+    # Sessão da grade mantém o mesmo UID de projetada para materializada: o celular não duplica
+    if agenda_fixa_id:
+        return f'grade-{agenda_fixa_id}-{data:%Y%m%d}@clinica'
+    return f'agendamento-{id_}@clinica'
+
+def eventos_ics(terapeuta, data_inicio, data_fim):
+    """Gera o calendário do terapeuta no período, em pedaços de texto."""
+    from .models import Agendamento, BloqueioFixo, TIPO_ATENDIMENTO_CHOICES
+
+    status = dict(Agendamento.STATUS_CHOICES)
+    tipos = dict(TIPO_ATENDIMENTO_CHOICES)
+    carimbo = timezone.now().astimezone(tz.utc).strftime('%Y%m%dT%H%M%SZ')
+    fuso = timezone.get_default_timezone()
+
+    yield ''.join(_linha(l) for l in [
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Clinica//Agenda//PT-BR', 'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH', f'X-WR-CALNAME:{_texto("Agenda - " + terapeuta.nome)}', f'X-WR-TIMEZONE:{settings.TIME_ZONE}',
+        *_vtimezone(fuso, data_inicio, data_fim),
+    ])
+
+    pedaco = []
+    linhas = Agendamento.objects.ativos().filter(terapeuta=terapeuta, data__range=[data_inicio, data_fim]).order_by().values_list(
+        'id', 'agenda_fixa_id', 'data', 'hora_inicio', 'hora_fim', 'status', 'tipo_atendimento', 'paciente__nome', 'sala__nome'
+    ).iterator(chunk_size=PEDACO)
+    for id_, agenda_fixa_id, data, hora_inicio, hora_fim, st, tipo, paciente, sala in linhas:
+        pedaco.append(_evento(
+            _uid(id_, agenda_fixa_id, data), carimbo, fuso, data, hora_inicio, hora_fim, paciente, sala,
+            f'{tipos.get(tipo, tipo)} • {status.get(st, st)}', cancelado=st == 'FALTA',
+        ))
+        if len(pedaco) >= PEDACO:
+            yield ''.join(pedaco)
+            pedaco = []
+
+    # Sessões da grade além da marca d'água, um mês por vez
+    inicio = data_inicio
+    while inicio <= data_fim:
+        fim = min(inicio + timedelta(days=30), data_fim)
+        for ag in projetar_ocorrencias(inicio, fim, [terapeuta.id]):
+            pedaco.append(_evento(
+                _uid(None, ag.agenda_fixa_id, ag.data), carimbo, fuso, ag.data, ag.hora_inicio, ag.hora_fim,
+                ag.paciente.nome, ag.sala.nome if ag.sala else None, f'{tipos.get(ag.tipo_atendimento, ag.tipo_atendimento)} • Agenda fixa',
+            ))
+        if pedaco:
+            yield ''.join(pedaco)
+            pedaco = []
+        inicio = fim + timedelta(days=1)
+
+    for b in BloqueioFixo.objects.filter(terapeuta=terapeuta).order_by('dia_semana', 'hora_inicio'):
+        primeira = data_inicio + timedelta(days=(b.dia_semana - data_inicio.weekday()) % 7)
+        pedaco.append(''.join(_linha(l) for l in [
+            'BEGIN:VEVENT', f'UID:bloqueio-{b.id}@clinica', f'DTSTAMP:{carimbo}',
+            # Hora local + RRULE: a repetição semanal acompanha o relógio da clínica
+            f'DTSTART;TZID={settings.TIME_ZONE}:{datetime.combine(primeira, b.hora_inicio):%Y%m%dT%H%M%S}',
+            f'DTEND;TZID={settings.TIME_ZONE}:{datetime.combine(primeira, b.hora_fim):%Y%m%dT%H%M%S}',
+            f'RRULE:FREQ=WEEKLY;BYDAY={SIGLAS_DIAS[b.dia_semana]}', 'SUMMARY:Bloqueio fixo', 'TRANSP:OPAQUE', 'END:VEVENT',
+        ]))
+    pedaco.append(_linha('END:VCALENDAR'))
+    yield ''.join(pedaco)
+
+def guardar_ao_final(pedacos, chave, tempo):
+    """Repassa os pedaços e, se o total couber em LIMITE_CACHE, guarda o arquivo inteiro em `chave`."""
+    guardados, tamanho = [], 0
+    for pedaco in pedacos:
+        if guardados is not None:
+            tamanho += len(pedaco)
+            if tamanho <= LIMITE_CACHE:
+                guardados.append(pedaco)
+            else:
+                guardados = None
+        yield pedaco
+    if guardados is not None:
+        cache.set(chave, ''.join(guardados), tempo)
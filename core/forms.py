@@ -4,7 +4,44 @@ from django.contrib.auth.forms import UserCreationForm
 from .models import Paciente, Terapeuta, Agendamento, Consulta, ESPECIALIDADES_CHOICES, AgendaFixa, Sala, BloqueioFixo
 from datetime import datetime, timedelta, time
 from django.utils import timezone
-from .utils import get_horarios_clinica
+from django.urls import reverse
+from .utils import get_horarios_clinica, horizonte_agenda
+from .bloqueios import esta_bloqueado
+
+# Semanas da grade conferidas ao salvar (o horizonte antigo, antes das ocorrências virtuais)
+SEMANAS_CONFERIDAS = 16
+
+def avisos_sala(sala, paciente, datas, hora_inicio, hora_fim, **ignorar):
+    """Aviso (não bloqueia) com as datas em que a sala já está ocupada por outro paciente."""
+    if not sala or sala.compartilhada or not datas:
+        return []
+    conflitos = Agendamento.verificar_conflitos_sala_lote([
+        dict(sala=sala, paciente=paciente, data=d, hora_inicio=hora_inicio, hora_fim=hora_fim, **ignorar)
+        for d in datas
+    ])
+    ocupadas = [f"{d.strftime('%d/%m')} ({ags[0].paciente.nome})" for d, ags in zip(datas, conflitos) if ags]
+    if not ocupadas:
+        return []
+    return [f"{sala.nome} já está ocupada neste horário em {len(ocupadas)} data(s): {', '.join(ocupadas)}."]
+
+class SelectPaciente(forms.Select):
+    """Select de paciente para o select2 em modo AJAX (buscar_pacientes): o HTML leva só a opção
+    selecionada, não a lista inteira de pacientes. A validação continua pelo queryset do campo."""
+
+    def __init__(self, attrs=None):
+        super().__init__(attrs={'class': 'form-control campo-paciente', **(attrs or {})})
+
+    def get_context(self, name, value, attrs):
+        contexto = super().get_context(name, value, attrs)
+        contexto['widget']['attrs']['data-url'] = reverse('buscar_pacientes')
+        return contexto
+
+    def optgroups(self, name, value, attrs=None):
+        ids = [v for v in value if str(v).isdigit()]
+        opcoes = [self.create_option(name, '', '', False, 0)]
+        for i, paciente in enumerate(self.choices.queryset.filter(pk__in=ids), start=1):
+            opcoes.append(self.create_option(name, paciente.pk, str(paciente), True, i))
+        return [(None, opcoes, 0)]
 
 class CadastroEquipeForm(UserCreationForm):
     nome_completo = forms.CharField(max_length=100, label="Nome Completo")
@@ -51,7 +88,7 @@ class AgendamentoForm(forms.ModelForm):
         model = Agendamento
         fields = ['paciente', 'terapeuta', 'modalidade', 'sala', 'data', 'hora_inicio', 'hora_fim']
         widgets = {
-            'paciente': forms.Select(attrs={'class': 'form-control campo-busca'}),
+            'paciente': SelectPaciente(),
             'terapeuta': forms.Select(attrs={'class': 'form-control campo-busca'}),
             'modalidade': forms.Select(attrs={'class': 'form-select'}),
             'sala': forms.Select(attrs={'class': 'form-select'}),
@@ -68,6 +105,7 @@ class AgendamentoForm(forms.ModelForm):
         self.fields['modalidade'].empty_label = "Padrão do Terapeuta"
         
         self.fields['paciente'].queryset = Paciente.objects.filter(ativo=True).order_by('nome')
+        self.avisos = []
 
     def clean(self):
         cleaned_data = super().clean()
@@ -86,24 +124,26 @@ class AgendamentoForm(forms.ModelForm):
             hora_fim = dt_fim.time()
             cleaned_data['hora_fim'] = hora_fim 
         
-        dia_semana = data.weekday()
-        bloqueado = BloqueioFixo.objects.filter(
-            terapeuta=terapeuta,
-            dia_semana=dia_semana,
-            hora_inicio__lt=hora_fim,
-            hora_fim__gt=hora_inicio
-        ).exists()
-
-        if bloqueado:
+        if esta_bloqueado(terapeuta.pk, data.weekday(), hora_inicio, hora_fim):
             raise forms.ValidationError(f"Bloqueado! Dr(a) {terapeuta.nome} possui um bloqueio fixo neste horário.")
 
-        tem_conflito = Agendamento.verificar_conflito(
-            terapeuta=terapeuta, data=data, hora_inicio=hora_inicio, hora_fim=hora_fim,
+        # A série inteira (repetições semanais) é conferida de uma vez
+        repeticoes = cleaned_data.get('repeticoes') or 0
+        datas = [data + timedelta(weeks=i) for i in range(repeticoes + 1)]
+        conflitos = Agendamento.verificar_conflitos_lote([
+            {'terapeuta': terapeuta, 'data': d, 'hora_inicio': hora_inicio, 'hora_fim': hora_fim,
+             'ignorar_id': self.instance.pk if self.instance.pk else None}
+            for d in datas
+        ])
+        
+        if conflitos[0]:
+            ocupadas = [f"{d.strftime('%d/%m')} ({ags[0].paciente.nome})" for d, ags in zip(datas, conflitos) if ags]
+            raise forms.ValidationError(f"Conflito! Dr(a) {terapeuta.nome} já possui atendimento neste horário. Datas ocupadas: {', '.join(ocupadas)}.")
+
+        self.avisos += avisos_sala(
+            cleaned_data.get('sala'), cleaned_data.get('paciente'), datas, hora_inicio, hora_fim,
             ignorar_id=self.instance.pk if self.instance.pk else None
         )
-        
-        if tem_conflito:
-            raise forms.ValidationError(f"Conflito! Dr(a) {terapeuta.nome} já possui atendimento neste horário.")
             
         return cleaned_data
 
@@ -138,7 +178,7 @@ class AgendaFixaForm(forms.ModelForm):
         model = AgendaFixa
         fields = ['paciente', 'terapeuta', 'modalidade', 'sala', 'dia_semana', 'hora_inicio', 'hora_fim', 'data_inicio', 'data_fim', 'ativo']
         widgets = {
-            'paciente': forms.Select(attrs={'class': 'form-control campo-busca'}),
+            'paciente': SelectPaciente(),
             'terapeuta': forms.Select(attrs={'class': 'form-control campo-busca'}),
             'modalidade': forms.Select(attrs={'class': 'form-select'}),
             'sala': forms.Select(attrs={'class': 'form-select'}),
@@ -155,6 +195,7 @@ class AgendaFixaForm(forms.ModelForm):
         self.fields['hora_fim'].required = False 
         self.fields['modalidade'].empty_label = "Padrão do Terapeuta"
         self.fields['paciente'].queryset = Paciente.objects.filter(ativo=True).order_by('nome')
+        self.avisos = []
 
     def clean(self):
         cleaned_data = super().clean()
@@ -172,18 +213,51 @@ class AgendaFixaForm(forms.ModelForm):
             hora_fim = cleaned_data['hora_fim']
             
         if terapeuta and dia_semana is not None and hora_inicio and hora_fim:
-            bloqueado = BloqueioFixo.objects.filter(
-                terapeuta=terapeuta,
-                dia_semana=int(dia_semana),
-                hora_inicio__lt=hora_fim,
-                hora_fim__gt=hora_inicio
-            ).exists()
-            
-            if bloqueado:
+            if esta_bloqueado(terapeuta.pk, dia_semana, hora_inicio, hora_fim):
                 raise forms.ValidationError("Este horário coincide com um BLOQUEIO FIXO deste terapeuta.")
+
+            self.verificar_ocorrencias(cleaned_data, hora_fim)
             
         return cleaned_data
 
+    def verificar_ocorrencias(self, cleaned_data, hora_fim):
+        """Avisa (sem bloquear) quais datas da grade já estão ocupadas por outro paciente até o horizonte."""
+        paciente = cleaned_data.get('paciente')
+        if not cleaned_data.get('ativo', True):
+            return
+
+        hoje = timezone.localdate()
+        data_atual = max(cleaned_data.get('data_inicio') or hoje, hoje)
+        data_atual += timedelta(days=(int(cleaned_data['dia_semana']) - data_atual.weekday()) % 7)
+        # Além do horizonte a grade segue projetada e colide com as outras grades do mesmo jeito
+        limite = max(horizonte_agenda(hoje), hoje + timedelta(weeks=SEMANAS_CONFERIDAS))
+        if cleaned_data.get('data_fim'):
+            limite = min(limite, cleaned_data['data_fim'])
+
+        datas = []
+        while data_atual <= limite:
+            datas.append(data_atual)
+            data_atual += timedelta(days=7)
+
+        conflitos = Agendamento.verificar_conflitos_lote([
+            {'terapeuta': cleaned_data['terapeuta'], 'data': d, 'hora_inicio': cleaned_data['hora_inicio'], 'hora_fim': hora_fim,
+             'ignorar_agenda_fixa': self.instance.pk}
+            for d in datas
+        ])
+        # Agendamentos do próprio paciente são absorvidos pela grade, não contam como conflito
+        ocupadas = []
+        for d, ags in zip(datas, conflitos):
+            outros = [ag for ag in ags if ag.paciente_id != getattr(paciente, 'pk', None)]
+            if outros:
+                ocupadas.append(f"{d.strftime('%d/%m')} ({outros[0].paciente.nome})")
+        if ocupadas:
+            self.avisos.append(f"{len(ocupadas)} data(s) com o horário já ocupado serão puladas: {', '.join(ocupadas)}.")
+
+        self.avisos += avisos_sala(
+            cleaned_data.get('sala'), paciente, datas, cleaned_data['hora_inicio'], hora_fim,
+            ignorar_agenda_fixa=self.instance.pk
+        )
+
 class BloqueioFixoForm(forms.ModelForm):
     class Meta:
         model = BloqueioFixo
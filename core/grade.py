@@ -0,0 +1,108 @@
+"""Montagem das grades (horário × coluna) das telas de agenda.
+
+A agenda semanal, a agenda fixa e a ocupação de salas desenham a mesma tabela: uma linha por
+slot de `horarios_clinica()` e uma coluna por data, dia da semana ou sala. `Grade` guarda as
+células numa lista de listas indexada por inteiros e entrega as linhas já na ordem de exibição,
+para o template só iterar.
+"""
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from .utils import horarios_clinica
+
+Linha = namedtuple('Linha', ['hora', 'celulas'])
+
+def indice_slot(hora, horarios=None):
+    """Posição do slot visual onde `hora` cai: o último slot que começa até ela (o primeiro, se antes de todos)."""
+    horarios = horarios_clinica() if horarios is None else horarios
+    return max(bisect_right(horarios, hora) - 1, 0)
+
+def indices_intervalo(hora_inicio, hora_fim, horarios=None):
+    """Slots visuais cobertos por [hora_inicio, hora_fim), andando de 45 em 45 min como as telas sempre fizeram."""
+    horarios = horarios_clinica() if horarios is None else horarios
+    indices = {}
+    atual = datetime.combine(datetime.today(), hora_inicio)
+    fim = datetime.combine(datetime.today(), hora_fim)
+    while atual < fim:
+        indices.setdefault(indice_slot(atual.time(), horarios))
+        atual += timedelta(minutes=45)
+    return tuple(indices)
+
+class Grade:
+    """Tabela de listas: `colunas` são as chaves das colunas (datas, dias, ids de sala), na ordem de exibição."""
+
+    def __init__(self, colunas, horarios=None):
+        self.horarios = horarios_clinica() if horarios is None else tuple(horarios)
+        self.colunas = list(colunas)
+        self._posicao = {chave: j for j, chave in enumerate(self.colunas)}
+        self.celulas = [[[] for _ in self.colunas] for _ in self.horarios]
+
+    def adicionar(self, coluna, hora, item):
+        """Coloca o item no slot de `hora`. Colunas fora da grade são ignoradas."""
+        j = self._posicao.get(coluna)
+        if j is not None:
+            self.celulas[indice_slot(hora, self.horarios)][j].append(item)
+
+    def carimbar(self, coluna, por_slot):
+        """Copia para a coluna uma projeção pronta (uma lista de itens por slot), ex.: os bloqueios do dia da semana."""
+        j = self._posicao.get(coluna)
+        if j is not None:
+            for linha, itens in zip(self.celulas, por_slot):
+                if itens:
+                    linha[j].extend(itens)
+
+    @property
+    def linhas(self):
+        return [Linha(hora, celulas) for hora, celulas in zip(self.horarios, self.celulas)]
+
+@lru_cache(maxsize=None)
+def _rotulos():
+    from .models import Agendamento, MODALIDADE_CHOICES, TIPO_ATENDIMENTO_CHOICES
+    return dict(Agendamento.STATUS_CHOICES), dict(TIPO_ATENDIMENTO_CHOICES), dict(MODALIDADE_CHOICES)
+
+class ItemAgenda:
+    """Agendamento como a grade semanal o desenha: só os campos exibidos, sem instância de model.
+    Montado de uma linha de `values_list(*ItemAgenda.CAMPOS)` ou de uma sessão projetada."""
+
+    CAMPOS = (
+        'id', 'data', 'hora_inicio', 'status', 'tipo_atendimento', 'modalidade', 'agenda_fixa_id',
+        'paciente__nome', 'terapeuta__nome', 'terapeuta__especialidade', 'sala__nome',
+        'hora_fim', 'paciente_id', 'terapeuta_id', 'sala_id',
+    )
+    __slots__ = (
+        'id', 'data', 'hora_inicio', 'status', 'status_display', 'tipo_display', 'descricao_modalidade',
+        'agenda_fixa', 'paciente_nome', 'terapeuta_nome', 'sala_nome', 'virtual', 'url_ocorrencia',
+        'hora_fim', 'tipo_atendimento', 'paciente_id', 'terapeuta_id', 'sala_id',
+    )
+    tipo_obj = 'agendamento'
+
+    def __init__(self, id, data, hora_inicio, status, tipo_atendimento, modalidade, agenda_fixa_id,
+                 paciente_nome, terapeuta_nome, especialidade, sala_nome, hora_fim, paciente_id, terapeuta_id, sala_id,
+                 virtual=False, url_ocorrencia=None):
+        rotulos_status, rotulos_tipo, rotulos_modalidade = _rotulos()
+        self.id, self.data, self.hora_inicio, self.hora_fim, self.status = id, data, hora_inicio, hora_fim, status
+        self.tipo_atendimento = tipo_atendimento
+        self.status_display = rotulos_status.get(status, status)
+        self.tipo_display = rotulos_tipo.get(tipo_atendimento, tipo_atendimento)
+        # Mesma regra de Agendamento.descricao_modalidade
+        if modalidade and modalidade != 'FISIOTERAPIA':
+            self.descricao_modalidade = rotulos_modalidade.get(modalidade, modalidade)
+        else:
+            self.descricao_modalidade = especialidade or "Padrão"
+        self.agenda_fixa = agenda_fixa_id
+        self.paciente_nome, self.terapeuta_nome, self.sala_nome = paciente_nome, terapeuta_nome, sala_nome
+        self.paciente_id, self.terapeuta_id, self.sala_id = paciente_id, terapeuta_id, sala_id
+        self.virtual, self.url_ocorrencia = virtual, url_ocorrencia
+
+    @classmethod
+    def de_agendamento(cls, ag):
+        """Para sessões projetadas (Agendamento não salvo, com `virtual` e `url_ocorrencia`)."""
+        return cls(
+            ag.id, ag.data, ag.hora_inicio, ag.status, ag.tipo_atendimento, ag.modalidade, ag.agenda_fixa_id,
+            ag.paciente.nome, ag.terapeuta.nome, ag.terapeuta.especialidade, ag.sala.nome if ag.sala else None,
+            ag.hora_fim, ag.paciente_id, ag.terapeuta_id, ag.sala_id,
+            virtual=getattr(ag, 'virtual', False), url_ocorrencia=getattr(ag, 'url_ocorrencia', None),
+        )
+
@@ -0,0 +1,235 @@
+import random
+import time
+from datetime import datetime, timedelta, time as hora
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+from core import views
+from core.grade import Grade, ItemAgenda
+from core.models import Agendamento, Paciente, Terapeuta, Sala
+from core.utils import get_horarios_clinica, BATCH_SIZE
+
+
+def _horarios_antigos():
+    # get_horarios_clinica antes do core/grade.py: recalculada a cada chamada
+    horarios = []
+    for inicio, quantidade in ((datetime(2000, 1, 1, 7, 15), 7), (datetime(2000, 1, 1, 13, 30), 8)):
+        horarios.extend((inicio + timedelta(minutes=45 * i)).time() for i in range(quantidade))
+    return horarios
+
+def _slot_antigo(hora_real, horarios_grade):
+    # encontrar_slot_visual: varre os slots até passar da hora
+    slot_candidato = horarios_grade[0]
+    for h in horarios_grade:
+        if h > hora_real:
+            break
+        slot_candidato = h
+    return slot_candidato.strftime('%H:%M')
+
+def _dict_get(dicionario, chave):
+    # Filtro dict_get do template antigo, aplicado duas vezes por célula
+    try:
+        return dicionario.get(int(chave))
+    except (ValueError, TypeError):
+        return dicionario.get(chave)
+
+def _montagem_antiga(itens, datas):
+    horarios_grade = _horarios_antigos()
+    agenda_map = {t.strftime('%H:%M'): {d.strftime('%Y-%m-%d'): [] for d in datas} for t in horarios_grade}
+    for item in itens:
+        h_str = _slot_antigo(item.hora_inicio, horarios_grade)
+        d_str = item.data.strftime('%Y-%m-%d')
+        if h_str in agenda_map and d_str in agenda_map[h_str]:
+            agenda_map[h_str][d_str].append(item)
+    return sum(
+        len(_dict_get(_dict_get(agenda_map, hora.strftime('%H:%M')), data.strftime('%Y-%m-%d')))
+        for hora in horarios_grade for data in datas
+    )
+
+def _montagem_grade(itens, datas):
+    grade = Grade(datas)
+    for item in itens:
+        grade.adicionar(item.data, item.hora_inicio, item)
+    return sum(len(celula) for linha in grade.linhas for celula in linha.celulas)
+
+
+class _Desfazer(Exception):
+    """Força o rollback da massa sintética ao final do benchmark."""
+
+
+class Command(BaseCommand):
+    help = 'Mede as consultas quentes da agenda em um ano de dados sintéticos, sem e com os índices de Agendamento, e opcionalmente as telas de grade (nada é gravado).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--terapeutas', type=int, default=10)
+        parser.add_argument('--dias', type=int, default=365, help='Período gerado, centrado em hoje')
+        parser.add_argument('--repeticoes', type=int, default=20, help='Execuções de cada consulta')
+        parser.add_argument('--semente', type=int, default=42)
+        parser.add_argument('--grade', action='store_true', help='Mede também o CPU por requisição das telas de grade e da montagem antiga x Grade')
+
+    def handle(self, *args, **kwargs):
+        self.repeticoes = max(1, kwargs['repeticoes'])
+        random.seed(kwargs['semente'])
+
+        try:
+            with transaction.atomic():
+                self._gerar_massa(kwargs['terapeutas'], kwargs['dias'])
+                cenarios = self._cenarios()
+
+                self._remover_indices()
+                antes = {nome: self._medir(consulta) for nome, consulta in cenarios}
+                self._criar_indices()
+                depois = {nome: self._medir(consulta) for nome, consulta in cenarios}
+
+                for nome, _ in cenarios:
+                    self._relatar(nome, antes[nome], depois[nome])
+                if kwargs['grade']:
+                    self._medir_grades()
+                raise _Desfazer
+        except _Desfazer:
+            pass
+
+        self.stdout.write(self.style.SUCCESS('Massa sintética descartada.'))
+
+    def _gerar_massa(self, qtd_terapeutas, dias):
+        hoje = timezone.localdate()
+        inicio = hoje - timedelta(days=dias // 2)
+        horarios = get_horarios_clinica()
+
+        terapeutas = [Terapeuta.objects.create(nome=f'Benchmark {i}') for i in range(qtd_terapeutas)]
+        salas = [Sala.objects.create(nome=f'Benchmark {i}') for i in range(max(1, qtd_terapeutas // 2))]
+        pacientes = Paciente.objects.bulk_create([
+            Paciente(nome=f'Paciente Benchmark {i}', cpf=f'{90000000000 + i}') for i in range(qtd_terapeutas * 8)
+        ])
+
+        agendamentos = []
+        for d in range(dias):
+            data = inicio + timedelta(days=d)
+            if data.weekday() > 5: continue
+            for terapeuta in terapeutas:
+                for h in random.sample(horarios, k=len(horarios) * 2 // 3):
+                    fim = (datetime.combine(data, h) + timedelta(minutes=45)).time()
+                    if data < hoje:
+                        status = random.choices(['REALIZADO', 'FALTA', 'AGUARDANDO'], weights=[85, 10, 5])[0]
+                    else:
+                        status = 'AGUARDANDO'
+                    agendamentos.append(Agendamento(
+                        paciente=random.choice(pacientes), terapeuta=terapeuta, sala=random.choice(salas),
+                        data=data, hora_inicio=h, hora_fim=fim, status=status,
+                        deletado=random.random() < 0.05,
+                    ))
+        Agendamento.objects.bulk_create(agendamentos, batch_size=BATCH_SIZE)
+        self.stdout.write(f'{len(agendamentos)} agendamentos sintéticos ({dias} dias, {qtd_terapeutas} terapeutas).')
+
+        self.terapeutas = terapeutas
+        self.hoje = hoje
+
+    def _cenarios(self):
+        hoje = self.hoje
+        segunda = hoje - timedelta(days=hoje.weekday())
+        corte = hoje - timedelta(days=1)
+
+        def verificar_conflito():
+            terapeuta = random.choice(self.terapeutas)
+            data = hoje + timedelta(days=random.randint(-60, 60))
+            return Agendamento.objects.ativos().filter(terapeuta=terapeuta, data=data).exclude(status='FALTA').filter(
+                hora_inicio__lt=hora(10, 30), hora_fim__gt=hora(9, 45)
+            )
+
+        def lista_agendamentos():
+            return Agendamento.objects.ativos().filter(
+                data__range=[segunda, segunda + timedelta(days=6)]
+            ).select_related('paciente', 'terapeuta', 'sala').order_by('data', 'hora_inicio')
+
+        def relatorio_atrasos():
+            return Agendamento.objects.ativos().filter(
+                status='AGUARDANDO', data__lte=corte
+            ).select_related('terapeuta', 'paciente', 'sala').order_by('terapeuta__nome', 'data')
+
+        return [
+            ('verificar_conflito', verificar_conflito),
+            ('lista_agendamentos', lista_agendamentos),
+            ('relatorio_atrasos', relatorio_atrasos),
+        ]
+
+    def _medir_grades(self):
+        """Tempo de CPU (consulta + montagem + template) de cada tela de grade na semana atual.
+        Sem o cache da grade (montada a cada requisição) e com ele já aquecido, em linhas separadas."""
+        usuario = User.objects.create_superuser('benchmark_grade', password=None)
+        fabrica = RequestFactory()
+        telas = [
+            ('lista_agendamentos', views.lista_agendamentos, {}),
+            ('lista_agendas_fixas', views.lista_agendas_fixas, {}),
+            ('ocupacao_salas', views.ocupacao_salas, {'data': self.hoje.isoformat()}),
+        ]
+        self.stdout.write(self.style.MIGRATE_HEADING('\ngrades (CPU por requisição)'))
+        for nome, view, params in telas:
+            requisicao = fabrica.get('/', params)
+            requisicao.user = usuario
+            with override_settings(AGENDA_CACHE_GRADE=False):
+                frio_ms, resposta = self._cpu_por_requisicao(view, requisicao)
+            with override_settings(AGENDA_CACHE_GRADE=True):
+                quente_ms, _ = self._cpu_por_requisicao(view, requisicao)
+            self.stdout.write(f'  {nome}: {frio_ms:.1f} ms sem cache, {quente_ms:.1f} ms com cache ({len(resposta.content) // 1024} KB)')
+        self._medir_montagem()
+
+    def _medir_montagem(self):
+        """Só a distribuição da semana nas células, mesmos itens: o caminho antigo (busca linear do
+        slot, dicts por texto e dict_get por célula) contra `Grade`. Consulta e template ficam de fora."""
+        segunda = self.hoje - timedelta(days=self.hoje.weekday())
+        datas = [segunda + timedelta(days=i) for i in range(6)]
+        itens = [ItemAgenda(*linha) for linha in Agendamento.objects.ativos().filter(
+            data__range=[datas[0], datas[-1]]
+        ).order_by('data', 'hora_inicio').values_list(*ItemAgenda.CAMPOS)]
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\nmontagem da grade semanal ({len(itens)} itens, CPU por requisição)'))
+        for nome, montar in (('antes (busca linear, chaves de texto)', _montagem_antiga), ('Grade (bisect, índices inteiros)', _montagem_grade)):
+            montar(itens, datas)
+            inicio = time.process_time()
+            for _ in range(self.repeticoes):
+                celulas = montar(itens, datas)
+            cpu_ms = (time.process_time() - inicio) * 1000 / self.repeticoes
+            self.stdout.write(f'  {nome}: {cpu_ms:.2f} ms ({celulas} itens nas células)')
+
+    def _cpu_por_requisicao(self, view, requisicao):
+        view(requisicao)  # aquecimento (imports, templates e, se ligado, o cache da grade)
+        inicio = time.process_time()
+        for _ in range(self.repeticoes):
+            resposta = view(requisicao)
+        return (time.process_time() - inicio) * 1000 / self.repeticoes, resposta
+
+    def _medir(self, consulta):
+        plano = consulta().explain()
+        inicio = time.perf_counter()
+        for _ in range(self.repeticoes):
+            list(consulta())
+        media_ms = (time.perf_counter() - inicio) * 1000 / self.repeticoes
+        return media_ms, plano
+
+    def _indices(self):
+        editor = connection.schema_editor(collect_sql=True)
+        return editor, Agendamento._meta.indexes
+
+    def _remover_indices(self):
+        editor, indices = self._indices()
+        tabela = editor.quote_name(Agendamento._meta.db_table)
+        with connection.cursor() as cursor:
+            for indice in indices:
+                cursor.execute(editor.sql_delete_index % {'table': tabela, 'name': editor.quote_name(indice.name)})
+
+    def _criar_indices(self):
+        editor, indices = self._indices()
+        with connection.cursor() as cursor:
+            for indice in indices:
+                cursor.execute(str(indice.create_sql(Agendamento, editor)))
+
+    def _relatar(self, nome, antes, depois):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n{nome}'))
+        self.stdout.write(f'  sem índices: {antes[0]:.2f} ms')
+        for linha in antes[1].splitlines():
+            self.stdout.write(f'      {linha}')
+        self.stdout.write(f'  com índices: {depois[0]:.2f} ms')
+        for linha in depois[1].splitlines():
+            self.stdout.write(f'      {linha}')
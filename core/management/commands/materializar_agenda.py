@@ -0,0 +1,87 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from core.models import AgendaFixa, Terapeuta
+from core.utils import planejar_agenda_futura, aplicar_plano
+
+# Trava compartilhada entre os processos: no SQLite só um escritor por vez
+_TRAVA_ESCRITA = None
+
+def _iniciar_processo(trava):
+    global _TRAVA_ESCRITA
+    import django
+    django.setup()
+    _TRAVA_ESCRITA = trava
+    # Cada processo abre a sua própria conexão
+    connections.close_all()
+
+def _materializar_terapeuta(terapeuta_id, dias_a_frente=None):
+    inicio = time.perf_counter()
+    plano = planejar_agenda_futura(dias_a_frente, terapeutas=[terapeuta_id])
+    tempo_plano = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    if _TRAVA_ESCRITA is not None:
+        with _TRAVA_ESCRITA:
+            total = aplicar_plano(plano)
+    else:
+        total = aplicar_plano(plano)
+    tempo_gravacao = time.perf_counter() - inicio
+
+    return terapeuta_id, total, tempo_plano, tempo_gravacao
+
+class Command(BaseCommand):
+    help = 'Materializa a Agenda Fixa em paralelo, um processo por terapeuta.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Quantidade de processos (1 = sem paralelismo)')
+        parser.add_argument('--dias', type=int, default=None, help='Dias à frente (padrão: AGENDA_HORIZONTE_SEMANAS)')
+
+    def handle(self, *args, **kwargs):
+        workers = max(1, kwargs['workers'])
+        dias = kwargs['dias']
+
+        terapeutas_ids = list(
+            AgendaFixa.objects.filter(ativo=True).order_by().values_list('terapeuta_id', flat=True).distinct()
+        )
+        nomes = dict(Terapeuta.objects.filter(id__in=terapeutas_ids).values_list('id', 'nome'))
+        self.stdout.write(self.style.WARNING(
+            f'Materializando {len(terapeutas_ids)} terapeutas com {workers} processo(s)...'
+        ))
+
+        inicio_geral = time.perf_counter()
+        resultados = []
+
+        if workers == 1:
+            for terapeuta_id in terapeutas_ids:
+                resultados.append(_materializar_terapeuta(terapeuta_id, dias))
+                self._relatar(nomes, *resultados[-1])
+        else:
+            trava = None
+            if connection.vendor == 'sqlite':
+                with connection.cursor() as cursor:
+                    cursor.execute('PRAGMA journal_mode')
+                    modo = cursor.fetchone()[0]
+                if modo != 'wal':
+                    # Sem WAL os processos que planejam esperam cada gravação terminar (ver SQLITE_WAL)
+                    self.stdout.write(self.style.WARNING(f'SQLite em journal_mode={modo}: leituras e gravação não se sobrepõem.'))
+                trava = multiprocessing.Lock()
+            connections.close_all()
+
+            with ProcessPoolExecutor(max_workers=workers, initializer=_iniciar_processo, initargs=(trava,)) as pool:
+                futuros = [pool.submit(_materializar_terapeuta, t_id, dias) for t_id in terapeutas_ids]
+                for futuro in as_completed(futuros):
+                    resultados.append(futuro.result())
+                    self._relatar(nomes, *resultados[-1])
+
+        total = sum(r[1] for r in resultados)
+        duracao = time.perf_counter() - inicio_geral
+        self.stdout.write(self.style.SUCCESS(f'--- FIM --- {total} agendamentos lançados em {duracao:.2f}s'))
+
+    def _relatar(self, nomes, terapeuta_id, total, tempo_plano, tempo_gravacao):
+        self.stdout.write(
+            f'{nomes.get(terapeuta_id, terapeuta_id)}: {total} agendamentos '
+            f'(plano {tempo_plano:.2f}s, gravação {tempo_gravacao:.2f}s)'
+        )
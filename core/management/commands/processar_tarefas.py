@@ -0,0 +1,43 @@
+import time
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from core.utils import reservar_proxima_tarefa, executar_tarefa, enfileirar_materializacao
+
+class Command(BaseCommand):
+    help = 'Worker da fila de materialização da Agenda Fixa (tira o processamento das requisições HTTP).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uma-vez', action='store_true', help='Processa a fila atual e encerra')
+        parser.add_argument('--intervalo', type=float, default=5.0, help='Segundos de espera quando a fila está vazia')
+        parser.add_argument('--sem-rotina', action='store_true', help='Não enfileira a materialização diária da janela rolante')
+
+    def handle(self, *args, **kwargs):
+        uma_vez = kwargs['uma_vez']
+        intervalo = kwargs['intervalo']
+        rotina = not kwargs['sem_rotina']
+        ultima_rotina = None
+        self.stdout.write(self.style.WARNING('Aguardando tarefas de materialização...'))
+
+        while True:
+            # Uma vez por dia avança a janela rolante de todas as grades (barato com a marca d'água)
+            hoje = timezone.localdate()
+            if rotina and ultima_rotina != hoje:
+                enfileirar_materializacao()
+                ultima_rotina = hoje
+
+            tarefa = reservar_proxima_tarefa()
+            if not tarefa:
+                if uma_vez: break
+                time.sleep(intervalo)
+                continue
+
+            inicio = time.monotonic()
+            executar_tarefa(tarefa)
+            duracao = time.monotonic() - inicio
+
+            if tarefa.status == 'CONCLUIDA':
+                self.stdout.write(self.style.SUCCESS(
+                    f'Tarefa #{tarefa.id}: {tarefa.resultado} agendamentos lançados ({duracao:.1f}s)'
+                ))
+            else:
+                self.stdout.write(self.style.ERROR(f'Tarefa #{tarefa.id} falhou: {tarefa.erro}'))
@@ -0,0 +1,61 @@
+import time
+from importlib import import_module
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, connection, transaction
+from core.models import Paciente, Terapeuta, Sala
+from core.normalizacao import chave_busca
+
+# Migrações que criam os índices FTS5 (SQLITE / SQLITE_REVERSO). AlterField em core_paciente ou
+# core_consulta recria a tabela no SQLite e descarta os triggers: refazer por aqui
+MIGRACOES_INDICES = ['core.migrations.0037_paciente_busca', 'core.migrations.0038_consulta_busca']
+
+class Command(BaseCommand):
+    help = 'Recalcula nome_search de pacientes, terapeutas e salas em lotes e refaz os índices de busca do SQLite.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=1000, help='Linhas lidas e gravadas por vez')
+        parser.add_argument('--sem-indices', action='store_true', help='Só o nome_search, sem refazer os índices FTS5')
+
+    def handle(self, *args, **kwargs):
+        lote = max(1, kwargs['lote'])
+        inicio = time.perf_counter()
+        for modelo in (Paciente, Terapeuta, Sala):
+            total, alterados = self._reindexar(modelo, lote)
+            self.stdout.write(f'{str(modelo._meta.verbose_name_plural).capitalize()}: {alterados} de {total} atualizados')
+
+        if not kwargs['sem_indices'] and connection.vendor == 'sqlite':
+            try:
+                for caminho in MIGRACOES_INDICES:
+                    self._refazer_indice(import_module(caminho))
+            except DatabaseError as erro:
+                self.stdout.write(self.style.WARNING(f'Índices FTS5 não refeitos ({erro}); a busca segue pelo icontains.'))
+            else:
+                self.stdout.write('Índices FTS5 refeitos (servidores em execução passam a usá-los ao reiniciar).')
+
+        self.stdout.write(self.style.SUCCESS(f'--- FIM --- {time.perf_counter() - inicio:.2f}s'))
+
+    def _reindexar(self, modelo, lote):
+        # Paginação por chave: cada lote é uma consulta curta pelo índice da pk, sem OFFSET
+        total = alterados = 0
+        ultimo = 0
+        while True:
+            objetos = list(modelo.objects.filter(pk__gt=ultimo).order_by('pk').only('id', 'nome', 'nome_search')[:lote])
+            if not objetos:
+                return total, alterados
+            mudaram = []
+            for obj in objetos:
+                chave = chave_busca(obj.nome)
+                if obj.nome_search != chave:
+                    obj.nome_search = chave
+                    mudaram.append(obj)
+            if mudaram:
+                with transaction.atomic():
+                    modelo.objects.bulk_update(mudaram, ['nome_search'], batch_size=lote)
+            total += len(objetos)
+            alterados += len(mudaram)
+            ultimo = objetos[-1].pk
+
+    def _refazer_indice(self, migracao):
+        with transaction.atomic(), connection.cursor() as cursor:
+            for sql in migracao.SQLITE_REVERSO + migracao.SQLITE:
+                cursor.execute(sql)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-17 02:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_remove_bloqueiofixo_motivo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agendafixa',
+            name='materializado_ate',
+            field=models.DateField(blank=True, editable=False, null=True, verbose_name='Agenda Gerada Até'),
+        ),
+    ]
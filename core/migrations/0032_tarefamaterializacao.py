@@ -0,0 +1,34 @@
+# Generated by Django 5.2.9 on 2026-10-17 02:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_agendafixa_materializado_ate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TarefaMaterializacao',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('PENDENTE', 'Pendente'), ('EXECUTANDO', 'Executando'), ('CONCLUIDA', 'Concluída'), ('ERRO', 'Erro')], db_index=True, default='PENDENTE', max_length=20)),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Grades a Processar')),
+                ('processados', models.PositiveIntegerField(default=0, verbose_name='Grades Processadas')),
+                ('resultado', models.IntegerField(blank=True, null=True, verbose_name='Agendamentos Lançados')),
+                ('erro', models.TextField(blank=True, null=True)),
+                ('criado_em', models.DateTimeField(auto_now_add=True)),
+                ('iniciado_em', models.DateTimeField(blank=True, null=True)),
+                ('concluido_em', models.DateTimeField(blank=True, null=True)),
+                ('agenda_fixa', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='tarefas', to='core.agendafixa')),
+            ],
+            options={
+                'verbose_name': 'Tarefa de Materialização',
+                'verbose_name_plural': 'Tarefas de Materialização',
+                'ordering': ['criado_em'],
+            },
+        ),
+    ]
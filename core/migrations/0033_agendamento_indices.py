@@ -0,0 +1,29 @@
+# Generated by Django 5.2.9 on 2026-10-17 02:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_tarefamaterializacao'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='agendamento',
+            index=models.Index(fields=['terapeuta', 'data', 'hora_inicio'], name='agend_terap_data_hora_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='agendamento',
+            index=models.Index(condition=models.Q(('deletado', False)), fields=['data', 'hora_inicio'], name='agend_ativo_data_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='agendamento',
+            index=models.Index(condition=models.Q(('deletado', False)), fields=['data', 'sala'], name='agend_ativo_data_sala_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='agendamento',
+            index=models.Index(condition=models.Q(('deletado', False), ('status', 'AGUARDANDO')), fields=['data', 'terapeuta'], name='agend_aguardando_idx'),
+        ),
+    ]
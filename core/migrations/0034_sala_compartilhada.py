@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-17 02:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_agendamento_indices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sala',
+            name='compartilhada',
+            field=models.BooleanField(default=False, help_text='Permite atendimentos simultâneos de pacientes diferentes (ex: co-terapia, grupos).', verbose_name='Sala Compartilhada'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.9 on 2026-10-17 03:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0034_sala_compartilhada'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlteracaoAgenda',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.DateField(blank=True, null=True)),
+                ('criado_em', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'Alteração da Agenda',
+                'verbose_name_plural': 'Alterações da Agenda',
+                'ordering': ['id'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-17 03:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0035_alteracao_agenda'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='terapeuta',
+            name='token_calendario',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,75 @@
+import unicodedata
+
+from django.db import DatabaseError, migrations, transaction
+
+# Texto indexado de cada paciente: nome normalizado + documentos. Mantido pelos triggers, então
+# save(), bulk_create e queryset.update() ficam todos em dia sem código do lado do Django
+TEXTO = (
+    "coalesce({p}.nome_search, lower({p}.nome)) || ' ' || coalesce({p}.cpf, '') || ' ' || "
+    "coalesce({p}.telefone, '') || ' ' || lower(coalesce({p}.carteirinha, ''))"
+)
+
+SQLITE = [
+    "CREATE VIRTUAL TABLE core_paciente_busca USING fts5(texto, tokenize='trigram')",
+    f"""CREATE TRIGGER core_paciente_busca_ai AFTER INSERT ON core_paciente BEGIN
+        INSERT INTO core_paciente_busca(rowid, texto) VALUES (new.id, {TEXTO.format(p='new')});
+    END""",
+    f"""CREATE TRIGGER core_paciente_busca_au AFTER UPDATE OF nome, nome_search, cpf, telefone, carteirinha ON core_paciente BEGIN
+        DELETE FROM core_paciente_busca WHERE rowid = old.id;
+        INSERT INTO core_paciente_busca(rowid, texto) VALUES (new.id, {TEXTO.format(p='new')});
+    END""",
+    """CREATE TRIGGER core_paciente_busca_ad AFTER DELETE ON core_paciente BEGIN
+        DELETE FROM core_paciente_busca WHERE rowid = old.id;
+    END""",
+    f"INSERT INTO core_paciente_busca(rowid, texto) SELECT id, {TEXTO.format(p='core_paciente')} FROM core_paciente",
+]
+
+SQLITE_REVERSO = [
+    "DROP TRIGGER IF EXISTS core_paciente_busca_ai",
+    "DROP TRIGGER IF EXISTS core_paciente_busca_au",
+    "DROP TRIGGER IF EXISTS core_paciente_busca_ad",
+    "DROP TABLE IF EXISTS core_paciente_busca",
+]
+
+POSTGRES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS core_paciente_nome_search_trgm ON core_paciente USING gin (nome_search gin_trgm_ops)",
+]
+
+def preencher_nome_search(apps, schema_editor):
+    # Cadastros vindos de bulk_create nunca passaram pelo save() que preenche o campo
+    Paciente = apps.get_model('core', 'Paciente')
+    for paciente in Paciente.objects.filter(nome_search__isnull=True).only('id', 'nome'):
+        texto = ''.join(c for c in unicodedata.normalize('NFD', paciente.nome or '') if unicodedata.category(c) != 'Mn')
+        Paciente.objects.filter(pk=paciente.pk).update(nome_search=texto.lower())
+
+def criar_indice(apps, schema_editor):
+    preencher_nome_search(apps, schema_editor)
+    comandos = {'sqlite': SQLITE, 'postgresql': POSTGRES}.get(schema_editor.connection.vendor, [])
+    # SQLite sem FTS5/trigram (anterior à 3.34) ou Postgres sem permissão para o pg_trgm:
+    # a migração passa e a busca continua no LIKE de sempre (ver core/busca.py)
+    try:
+        with transaction.atomic():
+            for sql in comandos:
+                schema_editor.execute(sql)
+    except DatabaseError:
+        pass
+
+def remover_indice(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for sql in SQLITE_REVERSO:
+            schema_editor.execute(sql)
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS core_paciente_nome_search_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0036_terapeuta_token_calendario'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_indice, remover_indice),
+    ]
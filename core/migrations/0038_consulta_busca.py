@@ -0,0 +1,52 @@
+from django.db import DatabaseError, migrations, transaction
+
+# Índice das evoluções: palavras sem acento (unicode61 remove_diacritics), rowid = agendamento_id.
+# Os triggers mantêm o índice a cada gravação do prontuário, inclusive fora do realizar_consulta
+SQLITE = [
+    "CREATE VIRTUAL TABLE core_consulta_busca USING fts5(evolucao, tokenize='unicode61 remove_diacritics 2')",
+    """CREATE TRIGGER core_consulta_busca_ai AFTER INSERT ON core_consulta BEGIN
+        INSERT INTO core_consulta_busca(rowid, evolucao) VALUES (new.agendamento_id, new.evolucao);
+    END""",
+    """CREATE TRIGGER core_consulta_busca_au AFTER UPDATE OF evolucao ON core_consulta BEGIN
+        DELETE FROM core_consulta_busca WHERE rowid = old.agendamento_id;
+        INSERT INTO core_consulta_busca(rowid, evolucao) VALUES (new.agendamento_id, new.evolucao);
+    END""",
+    """CREATE TRIGGER core_consulta_busca_ad AFTER DELETE ON core_consulta BEGIN
+        DELETE FROM core_consulta_busca WHERE rowid = old.agendamento_id;
+    END""",
+    "INSERT INTO core_consulta_busca(rowid, evolucao) SELECT agendamento_id, evolucao FROM core_consulta",
+]
+
+SQLITE_REVERSO = [
+    "DROP TRIGGER IF EXISTS core_consulta_busca_ai",
+    "DROP TRIGGER IF EXISTS core_consulta_busca_au",
+    "DROP TRIGGER IF EXISTS core_consulta_busca_ad",
+    "DROP TABLE IF EXISTS core_consulta_busca",
+]
+
+def criar_indice(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    # SQLite sem FTS5: a migração passa e a busca cai no icontains (ver core/busca_prontuarios.py)
+    try:
+        with transaction.atomic():
+            for sql in SQLITE:
+                schema_editor.execute(sql)
+    except DatabaseError:
+        pass
+
+def remover_indice(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for sql in SQLITE_REVERSO:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0037_paciente_busca'),
+    ]
+
+    operations = [
+        migrations.RunPython(criar_indice, remover_indice),
+    ]
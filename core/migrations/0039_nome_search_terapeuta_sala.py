@@ -0,0 +1,33 @@
+# Generated by Django 5.2.9 on 2026-10-17 03:31
+
+import unicodedata
+
+from django.db import migrations, models
+
+def preencher_nome_search(apps, schema_editor):
+    # Poucas linhas (equipe e salas); pacientes já foram preenchidos na 0037
+    for modelo in ('Terapeuta', 'Sala'):
+        Modelo = apps.get_model('core', modelo)
+        for id_, nome in Modelo.objects.values_list('id', 'nome'):
+            texto = ''.join(c for c in unicodedata.normalize('NFD', nome or '') if unicodedata.category(c) != 'Mn')
+            Modelo.objects.filter(pk=id_).update(nome_search=texto.lower())
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0038_consulta_busca'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sala',
+            name='nome_search',
+            field=models.CharField(blank=True, editable=False, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='terapeuta',
+            name='nome_search',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=100, null=True),
+        ),
+        migrations.RunPython(preencher_nome_search, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.9 on 2026-10-17 03:39
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+def remover_pendentes_duplicadas(apps, schema_editor):
+    # Mantém a pendente mais antiga de cada grade; as repetidas nunca começaram
+    Tarefa = apps.get_model('core', 'TarefaMaterializacao')
+    vistas = set()
+    for id_, agenda_id in Tarefa.objects.filter(status='PENDENTE').order_by('criado_em', 'id').values_list('id', 'agenda_fixa_id'):
+        if agenda_id in vistas:
+            Tarefa.objects.filter(pk=id_).delete()
+        vistas.add(agenda_id)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0039_nome_search_terapeuta_sala'),
+    ]
+
+    operations = [
+        migrations.RunPython(remover_pendentes_duplicadas, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='tarefamaterializacao',
+            constraint=models.UniqueConstraint(django.db.models.functions.comparison.Coalesce('agenda_fixa', models.Value(0)), condition=models.Q(('status', 'PENDENTE')), name='tarefa_pendente_unica'),
+        ),
+    ]
@@ -1,13 +1,14 @@
 from django.db import models
+from django.db.models import Q, Value
+from django.db.models.functions import Coalesce
 from django.core.validators import RegexValidator
 from django.core.exceptions import ValidationError
 from datetime import datetime, timedelta
 from django.utils import timezone
-import unicodedata
+from collections import defaultdict
+import secrets
 
-def remover_acentos(texto):
-    if not texto: return ""
-    return ''.join(c for c in unicodedata.normalize('NFD', texto) if unicodedata.category(c) != 'Mn')
+from .normalizacao import chave_busca
 
 def validar_tamanho_arquivo(file):
     limite_mb = 10
@@ -47,7 +48,12 @@ TIPO_ATENDIMENTO_CHOICES = [
 
 class Sala(models.Model):
     nome = models.CharField(max_length=50, verbose_name="Nome da Sala")
+    nome_search = models.CharField(max_length=50, blank=True, null=True, editable=False)
+    compartilhada = models.BooleanField(default=False, verbose_name="Sala Compartilhada", help_text="Permite atendimentos simultâneos de pacientes diferentes (ex: co-terapia, grupos).")
     def __str__(self): return self.nome
+    def save(self, *args, **kwargs):
+        self.nome_search = chave_busca(self.nome)
+        super().save(*args, **kwargs)
 
 class Convenio(models.Model):
     nome = models.CharField(max_length=100, unique=True, verbose_name="Nome do Convênio")
@@ -73,16 +79,29 @@ class Paciente(models.Model):
         verbose_name = 'Paciente'
     def __str__(self): return self.nome
     def save(self, *args, **kwargs):
-        self.nome_search = remover_acentos(self.nome).lower()
+        self.nome_search = chave_busca(self.nome)
         super().save(*args, **kwargs)
 
 class Terapeuta(models.Model):
     usuario = models.OneToOneField('auth.User', on_delete=models.CASCADE, null=True, blank=True)
     nome = models.CharField(max_length=100)
+    nome_search = models.CharField(max_length=100, blank=True, null=True, db_index=True, editable=False)
     registro_profissional = models.CharField(max_length=50, blank=True, null=True)
     especialidade = models.CharField(max_length=50, choices=ESPECIALIDADES_CHOICES, blank=True, null=True)
+    # Segredo do link da agenda em .ics (calendario_terapeuta); vazio = link ainda não gerado
+    token_calendario = models.CharField(max_length=64, unique=True, null=True, blank=True, editable=False)
     class Meta: ordering = ['nome']
     def __str__(self): return self.nome
+    def save(self, *args, **kwargs):
+        self.nome_search = chave_busca(self.nome)
+        super().save(*args, **kwargs)
+
+    def renovar_token_calendario(self):
+        """Gera um novo link do calendário; o anterior para de funcionar."""
+        self.token_calendario = secrets.token_urlsafe(24)
+        # update direto: não é mudança de cadastro, não precisa invalidar grades
+        Terapeuta.objects.filter(pk=self.pk).update(token_calendario=self.token_calendario)
+        return self.token_calendario
 
 class AgendaFixa(models.Model):
     DIAS_DA_SEMANA = [
@@ -109,6 +128,7 @@ class AgendaFixa(models.Model):
     ativo = models.BooleanField(default=True, verbose_name="Grade Ativa")
     data_inicio = models.DateField(default=timezone.now, verbose_name="Vigência Início")
     data_fim = models.DateField(null=True, blank=True, verbose_name="Vigência Fim (Opcional)")
+    materializado_ate = models.DateField(null=True, blank=True, editable=False, verbose_name="Agenda Gerada Até")
 
     class Meta:
         verbose_name = "Horário Fixo (Grade)"
@@ -167,7 +187,17 @@ class Agendamento(models.Model):
     
     objects = AgendamentoManager()
 
-    class Meta: ordering = ['data', 'hora_inicio'] 
+    class Meta:
+        ordering = ['data', 'hora_inicio']
+        indexes = [
+            # Conflitos e materialização: terapeuta + data (+ faixa de horário)
+            models.Index(fields=['terapeuta', 'data', 'hora_inicio'], name='agend_terap_data_hora_idx'),
+            # Grades por período e ocupação de salas (só agendamentos ativos)
+            models.Index(fields=['data', 'hora_inicio'], name='agend_ativo_data_idx', condition=Q(deletado=False)),
+            models.Index(fields=['data', 'sala'], name='agend_ativo_data_sala_idx', condition=Q(deletado=False)),
+            # Pendências (relatório de atrasos, materialização)
+            models.Index(fields=['data', 'terapeuta'], name='agend_aguardando_idx', condition=Q(deletado=False, status='AGUARDANDO')),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.hora_fim and self.hora_inicio:
@@ -176,12 +206,79 @@ class Agendamento(models.Model):
             self.hora_fim = (dt_inicio + timedelta(minutes=45)).time()
         super().save(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instancia = super().from_db(db, field_names, values)
+        # Data como veio do banco: se o agendamento for remarcado, a grade da data antiga também muda
+        instancia._data_original = instancia.__dict__.get('data')
+        return instancia
+
     @classmethod
     def verificar_conflito(cls, terapeuta, data, hora_inicio, hora_fim, ignorar_id=None):
-        conflitos = cls.objects.ativos().filter(terapeuta=terapeuta, data=data).exclude(status='FALTA')
-        conflitos = conflitos.filter(hora_inicio__lt=hora_fim, hora_fim__gt=hora_inicio)
-        if ignorar_id: conflitos = conflitos.exclude(id=ignorar_id)
-        return conflitos.exists()
+        candidato = {'terapeuta': terapeuta, 'data': data, 'hora_inicio': hora_inicio, 'hora_fim': hora_fim, 'ignorar_id': ignorar_id}
+        return bool(cls.verificar_conflitos_lote([candidato])[0])
+
+    @classmethod
+    def verificar_conflitos_lote(cls, candidatos):
+        """Confere vários horários com um número fixo de SELECTs (agendamentos; com grades ativas,
+        mais as grades e suas linhas gravadas para as sessões projetadas), seja qual for o lote.
+        Cada candidato é um dict com terapeuta (objeto ou id), data, hora_inicio, hora_fim e, opcionalmente,
+        ignorar_id e ignorar_agenda_fixa. Devolve, na mesma ordem, a lista de agendamentos que colidem com cada um."""
+        terapeutas = {getattr(c['terapeuta'], 'pk', c['terapeuta']) for c in candidatos}
+        return cls._sobreposicoes_lote(
+            candidatos, 'terapeuta', cls.objects.ativos().exclude(status='FALTA'), cls._projetadas(candidatos, terapeutas)
+        )
+
+    @classmethod
+    def verificar_conflitos_sala_lote(cls, candidatos):
+        """Mesma ideia por sala: cada candidato traz sala (objeto, id ou None) no lugar do terapeuta.
+        Salas compartilhadas nunca conflitam, e se o candidato informar `paciente`, as sessões
+        desse mesmo paciente (co-terapia) também não contam."""
+        existentes = cls.objects.ativos().exclude(status='FALTA').filter(sala__compartilhada=False)
+        salas = {getattr(c['sala'], 'pk', c['sala']) for c in candidatos if c['sala'] is not None}
+        terapeutas = set(AgendaFixa.objects.filter(ativo=True, sala_id__in=salas).values_list('terapeuta_id', flat=True))
+        projetadas = [ag for ag in cls._projetadas(candidatos, terapeutas) if ag.sala_id in salas and not ag.sala.compartilhada]
+        return cls._sobreposicoes_lote(candidatos, 'sala', existentes, projetadas)
+
+    @classmethod
+    def _projetadas(cls, candidatos, terapeutas):
+        """Sessões da grade fixa ainda não gravadas (AGENDA_OCORRENCIAS_VIRTUAIS) nas datas dos candidatos:
+        ocupam o horário tanto quanto uma linha no banco."""
+        from .utils import projetar_ocorrencias
+
+        if not candidatos or not terapeutas:
+            return []
+        datas = {c['data'] for c in candidatos}
+        return [ag for ag in projetar_ocorrencias(min(datas), max(datas), list(terapeutas)) if ag.data in datas]
+
+    @classmethod
+    def _sobreposicoes_lote(cls, candidatos, campo, existentes, projetadas=()):
+        if not candidatos: return []
+
+        def pk(valor):
+            return getattr(valor, 'pk', valor)
+
+        ocupacao = defaultdict(list)
+        existentes = existentes.filter(**{
+            f'{campo}_id__in': {pk(c[campo]) for c in candidatos if c[campo] is not None},
+            'data__in': {c['data'] for c in candidatos},
+        }).select_related('paciente')
+        for ag in [*existentes, *projetadas]:
+            ocupacao[(getattr(ag, f'{campo}_id'), ag.data)].append(ag)
+
+        resultado = []
+        for c in candidatos:
+            ignorar_id = c.get('ignorar_id')
+            ignorar_agenda_fixa = c.get('ignorar_agenda_fixa')
+            paciente_id = pk(c.get('paciente'))
+            resultado.append([
+                ag for ag in ocupacao[(pk(c[campo]), c['data'])]
+                if ag.hora_fim is not None and ag.hora_inicio < c['hora_fim'] and ag.hora_fim > c['hora_inicio']
+                and not (ignorar_id and ag.id == ignorar_id)
+                and not (ignorar_agenda_fixa and ag.agenda_fixa_id == ignorar_agenda_fixa)
+                and not (paciente_id and ag.paciente_id == paciente_id)
+            ])
+        return resultado
 
     @property
     def descricao_modalidade(self):
@@ -223,4 +320,58 @@ class BloqueioFixo(models.Model):
 
     class Meta:
         verbose_name = "Bloqueio de Agenda (Fixo)"
-        verbose_name_plural = "Bloqueios de Agenda (Fixos)"
\ No newline at end of file
+        verbose_name_plural = "Bloqueios de Agenda (Fixos)"
+
+# --- FILA DE MATERIALIZAÇÃO DA AGENDA FIXA ---
+class TarefaMaterializacao(models.Model):
+    STATUS_CHOICES = [
+        ('PENDENTE', 'Pendente'), ('EXECUTANDO', 'Executando'),
+        ('CONCLUIDA', 'Concluída'), ('ERRO', 'Erro'),
+    ]
+
+    # Vazio = materializa todas as grades ativas
+    agenda_fixa = models.ForeignKey(AgendaFixa, on_delete=models.CASCADE, null=True, blank=True, related_name='tarefas')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDENTE', db_index=True)
+    total = models.PositiveIntegerField(default=0, verbose_name="Grades a Processar")
+    processados = models.PositiveIntegerField(default=0, verbose_name="Grades Processadas")
+    resultado = models.IntegerField(null=True, blank=True, verbose_name="Agendamentos Lançados")
+    erro = models.TextField(null=True, blank=True)
+    criado_em = models.DateTimeField(auto_now_add=True)
+    iniciado_em = models.DateTimeField(null=True, blank=True)
+    concluido_em = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['criado_em']
+        verbose_name = "Tarefa de Materialização"
+        verbose_name_plural = "Tarefas de Materialização"
+        constraints = [
+            # No máximo uma pendente por grade (0 = a geral): o banco barra a duplicata de saves simultâneos
+            models.UniqueConstraint(
+                Coalesce('agenda_fixa', Value(0)), condition=Q(status='PENDENTE'), name='tarefa_pendente_unica',
+            ),
+        ]
+
+    def __str__(self):
+        alvo = self.agenda_fixa_id or 'todas'
+        return f"Tarefa #{self.id} ({alvo}) - {self.get_status_display()}"
+
+    @property
+    def progresso(self):
+        if self.status == 'CONCLUIDA': return 100
+        if not self.total: return 0
+        return int(100 * self.processados / self.total)
+
+class AlteracaoAgenda(models.Model):
+    """Registro das datas alteradas, para as telas ao vivo (SSE) de outros processos consultarem.
+    Só é gravado com AGENDA_ALTERACOES_BANCO ligado; ver core/alteracoes.py."""
+    # Vazio = mudança que aparece em todas as datas (bloqueios, grades, cadastros)
+    data = models.DateField(null=True, blank=True)
+    criado_em = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = "Alteração da Agenda"
+        verbose_name_plural = "Alterações da Agenda"
+
+    def __str__(self):
+        return f"Alteração #{self.id} ({self.data or 'todas as datas'})"
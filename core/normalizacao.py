@@ -0,0 +1,31 @@
+"""Normalização de texto para busca: sem acento e em minúsculas.
+
+Mesmo resultado do antigo `''.join(c for c in normalize('NFD', texto) if category(c) != 'Mn')`, mas
+caractere a caractere por uma tabela de `str.translate`: Latin-1 e Latin Extended já vêm calculados
+e qualquer outro caractere é decomposto na primeira vez que aparece e guardado na tabela. Texto só
+ASCII volta sem passar pela tabela, e os nomes repetidos (salas, terapeutas, termos comuns) saem
+do lru_cache.
+"""
+import unicodedata
+from functools import lru_cache
+
+def _sem_marcas(codigo):
+    return ''.join(c for c in unicodedata.normalize('NFD', chr(codigo)) if unicodedata.category(c) != 'Mn')
+
+class _Tabela(dict):
+    def __missing__(self, codigo):
+        self[codigo] = valor = _sem_marcas(codigo)
+        return valor
+
+_TABELA = _Tabela((codigo, _sem_marcas(codigo)) for codigo in range(0x80, 0x250))
+
+@lru_cache(maxsize=4096)
+def remover_acentos(texto):
+    if not texto: return ""
+    if texto.isascii(): return texto
+    return texto.translate(_TABELA)
+
+@lru_cache(maxsize=4096)
+def chave_busca(texto):
+    """Forma gravada em `nome_search` e usada para comparar com ela."""
+    return remover_acentos(texto).lower()
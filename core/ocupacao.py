@@ -0,0 +1,163 @@
+"""Mapa de ocupação da clínica em resolução de minuto.
+
+Para cada recurso (terapeuta, sala ou paciente) e dia, um int do Python com um bit por minuto
+do dia marca quem está ocupado quando. O mapa de um período inteiro é montado com uma consulta
+por tipo de recurso (agendamentos, salas) mais as sessões projetadas de `projetar_ocorrencias`,
+e os bloqueios fixos vêm do índice de `bloqueios`. Sobreposição, janelas livres e utilização
+viram operações de bits (&, |, ~) sobre esses inteiros, sem voltar ao banco.
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+
+from django.utils import timezone
+
+from .bloqueios import mascara_bloqueios, mascara_minutos
+from .utils import get_horarios_clinica, projetar_ocorrencias
+
+DIAS_ATENDIMENTO = range(6)  # Segunda a sábado, como nas grades
+TERAPEUTA, SALA, PACIENTE = 'terapeuta', 'sala', 'paciente'
+
+def _fim(data, hora_inicio, minutos=45):
+    return (datetime.combine(data, hora_inicio) + timedelta(minutes=minutos)).time()
+
+def _hora(minuto):
+    return time(minuto // 60, minuto % 60) if minuto < 24 * 60 else time(23, 59)
+
+def _intervalos(mascara):
+    """Trechos contínuos de bits ligados, como pares (minuto_inicio, minuto_fim)."""
+    intervalos = []
+    while mascara:
+        inicio = (mascara & -mascara).bit_length() - 1
+        resto = mascara >> inicio
+        tamanho = (~resto & (resto + 1)).bit_length() - 1
+        intervalos.append((inicio, inicio + tamanho))
+        mascara &= ~(((1 << tamanho) - 1) << inicio)
+    return intervalos
+
+def mascara_expediente():
+    """Minutos de atendimento da clínica (os slots de `get_horarios_clinica`)."""
+    mascara = 0
+    for hora_inicio in get_horarios_clinica():
+        mascara |= mascara_minutos(hora_inicio, _fim(datetime.today(), hora_inicio))
+    return mascara
+
+class MapaOcupacao:
+    """Ocupação por (recurso, dia) de um período. Montar com `MapaOcupacao.carregar`.
+
+    Segue as regras de `Agendamento.verificar_conflito`: só agendamentos ativos, FALTA não ocupa,
+    sala compartilhada nunca conflita. Com `virtuais=True` as sessões projetadas da grade
+    (`projetar_ocorrencias`, as mesmas regras de data e de pulo) também ocupam; com `bloqueios=True` os bloqueios fixos entram na máscara dos terapeutas."""
+
+    def __init__(self, data_inicio, data_fim, bloqueios=True):
+        self.data_inicio, self.data_fim = data_inicio, data_fim
+        self.bloqueios = bloqueios
+        self.mapas = {TERAPEUTA: defaultdict(int), SALA: defaultdict(int), PACIENTE: defaultdict(int)}
+        self.salas_compartilhadas = set()
+
+    @classmethod
+    def carregar(cls, data_inicio, data_fim, virtuais=True, bloqueios=True):
+        from .models import Agendamento, Sala
+
+        mapa = cls(data_inicio, data_fim, bloqueios=bloqueios)
+        mapa.salas_compartilhadas = set(Sala.objects.filter(compartilhada=True).values_list('id', flat=True))
+
+        linhas = Agendamento.objects.ativos().filter(
+            data__range=[data_inicio, data_fim], hora_fim__isnull=False
+        ).exclude(status='FALTA').values_list('terapeuta_id', 'sala_id', 'paciente_id', 'data', 'hora_inicio', 'hora_fim')
+        for linha in linhas:
+            mapa.ocupar(*linha)
+
+        if virtuais:
+            # As mesmas sessões projetadas que a agenda mostra e que `verificar_conflito` enxerga
+            for ag in projetar_ocorrencias(data_inicio, data_fim):
+                mapa.ocupar(ag.terapeuta_id, ag.sala_id, ag.paciente_id, ag.data, ag.hora_inicio, ag.hora_fim)
+
+        return mapa
+
+    def ocupar(self, terapeuta_id, sala_id, paciente_id, data, hora_inicio, hora_fim):
+        mascara = mascara_minutos(hora_inicio, hora_fim)
+        self.mapas[TERAPEUTA][(terapeuta_id, data)] |= mascara
+        self.mapas[PACIENTE][(paciente_id, data)] |= mascara
+        if sala_id:
+            self.mapas[SALA][(sala_id, data)] |= mascara
+
+    def mascara(self, tipo, recurso_id, data):
+        """Bitmap de minutos ocupados do recurso no dia."""
+        mascara = self.mapas[tipo].get((recurso_id, data), 0)
+        if tipo == TERAPEUTA and self.bloqueios:
+            mascara |= mascara_bloqueios(recurso_id, data.weekday())
+        return mascara
+
+    def livre(self, tipo, recurso_id, data, hora_inicio, hora_fim):
+        """True se o intervalo [hora_inicio, hora_fim) não cruza nada do recurso."""
+        if tipo == SALA and recurso_id in self.salas_compartilhadas:
+            return True
+        return not self.mascara(tipo, recurso_id, data) & mascara_minutos(hora_inicio, hora_fim)
+
+    def sobrepoe(self, tipo, recurso_id, data, hora_inicio, hora_fim):
+        return not self.livre(tipo, recurso_id, data, hora_inicio, hora_fim)
+
+    def janelas_livres(self, tipo, recurso_id, data, duracao=0, expediente=None):
+        """Janelas livres do recurso dentro do expediente, como pares (hora_inicio, hora_fim).
+        `duracao` (minutos) descarta as janelas mais curtas."""
+        expediente = mascara_expediente() if expediente is None else expediente
+        livres = expediente & ~self.mascara(tipo, recurso_id, data)
+        return [(_hora(i), _hora(f)) for i, f in _intervalos(livres) if f - i >= duracao]
+
+    def utilizacao(self, tipo, recurso_id, data, expediente=None):
+        """Fração (0 a 1) do expediente ocupada pelo recurso no dia."""
+        expediente = mascara_expediente() if expediente is None else expediente
+        if not expediente:
+            return 0.0
+        return bin(self.mascara(tipo, recurso_id, data) & expediente).count('1') / bin(expediente).count('1')
+
+def buscar_horarios_livres(data_inicio, data_fim, duracao=45, paciente=None, terapeuta=None, especialidade=None, quantidade=10):
+    """Próximos `quantidade` horários livres (terapeuta, sala, data, hora) no período, em ordem cronológica.
+    Respeita os slots da clínica, os bloqueios fixos, a agenda do terapeuta, da sala e do próprio paciente."""
+    from .models import Terapeuta, Sala
+
+    terapeutas = Terapeuta.objects.all()
+    if terapeuta:
+        terapeutas = terapeutas.filter(pk=getattr(terapeuta, 'pk', terapeuta))
+    if especialidade:
+        terapeutas = terapeutas.filter(especialidade=especialidade)
+    terapeutas = list(terapeutas)
+    salas = list(Sala.objects.all().order_by('nome'))
+    if not terapeutas or not salas:
+        return []
+
+    mapa = MapaOcupacao.carregar(data_inicio, data_fim)
+    paciente_id = getattr(paciente, 'pk', paciente)
+    agora = timezone.localtime()
+    horarios = get_horarios_clinica()
+
+    livres = []
+    data = data_inicio
+    while data <= data_fim and len(livres) < quantidade:
+        if data.weekday() in DIAS_ATENDIMENTO and data >= agora.date():
+            ocupado_paciente = mapa.mascara(PACIENTE, paciente_id, data) if paciente_id else 0
+            # Por dia: o que cada terapeuta e cada sala já têm ocupado
+            ocupado_terapeuta = {t.id: mapa.mascara(TERAPEUTA, t.id, data) | ocupado_paciente for t in terapeutas}
+            ocupado_sala = {s.id: 0 if s.compartilhada else mapa.mascara(SALA, s.id, data) for s in salas}
+
+            for hora_inicio in horarios:
+                if data == agora.date() and hora_inicio <= agora.time():
+                    continue
+                hora_fim = _fim(data, hora_inicio, duracao)
+                if hora_fim <= hora_inicio:
+                    continue
+                mascara = mascara_minutos(hora_inicio, hora_fim)
+                sala = next((s for s in salas if not ocupado_sala[s.id] & mascara), None)
+                if sala is None:
+                    continue
+                for t in terapeutas:
+                    if ocupado_terapeuta[t.id] & mascara:
+                        continue
+                    livres.append({'terapeuta': t, 'sala': sala, 'data': data, 'hora_inicio': hora_inicio, 'hora_fim': hora_fim})
+                    if len(livres) >= quantidade:
+                        break
+                if len(livres) >= quantidade:
+                    break
+        data += timedelta(days=1)
+
+    return livres
@@ -0,0 +1,35 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from . import bloqueios, cache_agenda
+from .models import Agendamento, AgendaFixa, BloqueioFixo, Paciente, Sala, Terapeuta
+
+@receiver([post_save, post_delete], sender=BloqueioFixo)
+@receiver(post_save, sender=Terapeuta)
+def invalidar_bloqueios(sender, **kwargs):
+    # Só depois do commit: antes disso os outros processos recompilariam sem a mudança
+    transaction.on_commit(bloqueios.invalidar)
+
+@receiver([post_save, post_delete], sender=Agendamento)
+def invalidar_grade_das_datas(sender, instance, **kwargs):
+    cache_agenda.invalidar_datas([instance.data, getattr(instance, '_data_original', None)])
+    # Próximo save da mesma instância precisa saber de onde ela sai
+    instance._data_original = instance.data
+
+@receiver([post_save, post_delete], sender=BloqueioFixo)
+@receiver([post_save, post_delete], sender=AgendaFixa)
+@receiver([post_save, post_delete], sender=Paciente)
+@receiver([post_save, post_delete], sender=Terapeuta)
+@receiver([post_save, post_delete], sender=Sala)
+def invalidar_grades(sender, **kwargs):
+    # Aparecem em qualquer data da grade (bloqueios, sessões projetadas, nomes)
+    cache_agenda.invalidar_tudo()
+
+@receiver(connection_created)
+def configurar_sqlite(sender, connection, **kwargs):
+    if connection.vendor == 'sqlite' and settings.SQLITE_WAL:
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
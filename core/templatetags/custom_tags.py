@@ -11,12 +11,3 @@ def get_item(dictionary, key):
         except (TypeError, AttributeError):
             return None
     return None
-
-@register.filter
-def dict_get(dictionary, key):
-    if isinstance(dictionary, dict):
-        try:
-            return dictionary.get(int(key))
-        except (ValueError, TypeError):
-            return dictionary.get(key)
-    return None
\ No newline at end of file
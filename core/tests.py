@@ -1,8 +1,17 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.utils import timezone
-from datetime import timedelta, time
-from .models import Paciente, Terapeuta, Agendamento
-from django.contrib.auth.models import User
+from datetime import date, timedelta, time
+from .models import Paciente, Terapeuta, Agendamento, AgendaFixa, BloqueioFixo, Sala, Consulta
+from . import bloqueios
+from .ocupacao import MapaOcupacao, buscar_horarios_livres
+from .grade import Grade
+from .utils import criar_agendamentos_em_lote, gerar_agenda_futura, ressincronizar_agenda_fixa, projetar_ocorrencias, materializar_ocorrencia, planejar_agenda_futura, aplicar_plano, guardar_plano, recuperar_plano, enfileirar_materializacao, reservar_proxima_tarefa, executar_tarefa, setup_grupos
+from django.contrib.auth.models import User, Group
+from django.core.management import call_command
+from django.core.cache import cache
+from io import StringIO
+import asyncio
+import json
 
 class AgendamentoModelTest(TestCase):
     def setUp(self):
@@ -61,4 +70,801 @@ class AgendamentoModelTest(TestCase):
         tem_conflito = Agendamento.verificar_conflito(
             self.terapeuta, self.hoje, time(11, 0), time(12, 0)
         )
-        self.assertFalse(tem_conflito)
\ No newline at end of file
+        self.assertFalse(tem_conflito)
+
+    def test_verificar_conflitos_lote(self):
+        outro = Terapeuta.objects.create(nome='Dra. Outra')
+        amanha = self.hoje + timedelta(days=1)
+        ocupado = Agendamento.objects.create(
+            paciente=self.paciente, terapeuta=self.terapeuta,
+            data=self.hoje, hora_inicio=time(10, 0), hora_fim=time(11, 0)
+        )
+        Agendamento.objects.create(
+            paciente=self.paciente, terapeuta=outro,
+            data=amanha, hora_inicio=time(8, 0), hora_fim=time(8, 45), status='FALTA'
+        )
+
+        # Agendamentos + grades ativas (sessões projetadas)
+        with self.assertNumQueries(2):
+            resultado = Agendamento.verificar_conflitos_lote([
+                {'terapeuta': self.terapeuta, 'data': self.hoje, 'hora_inicio': time(10, 30), 'hora_fim': time(11, 30)},
+                {'terapeuta': self.terapeuta, 'data': self.hoje, 'hora_inicio': time(10, 30), 'hora_fim': time(11, 30), 'ignorar_id': ocupado.id},
+                {'terapeuta': outro.id, 'data': amanha, 'hora_inicio': time(8, 0), 'hora_fim': time(8, 45)},
+                {'terapeuta': outro, 'data': self.hoje, 'hora_inicio': time(10, 0), 'hora_fim': time(11, 0)},
+            ])
+        self.assertEqual(resultado, [[ocupado], [], [], []])
+
+    def test_conflitos_lote_com_grades_em_consultas_fixas(self):
+        data = self.hoje + timedelta(weeks=4)
+        terapeutas = [self.terapeuta] + [Terapeuta.objects.create(nome=f'Dr. Grade {i}') for i in range(3)]
+        for t in terapeutas:
+            AgendaFixa.objects.create(
+                paciente=self.paciente, terapeuta=t, dia_semana=data.weekday(),
+                hora_inicio=time(9, 0), hora_fim=time(9, 45), data_inicio=self.hoje,
+            )
+        candidatos = [{'terapeuta': t, 'data': data, 'hora_inicio': time(9, 30), 'hora_fim': time(10, 15)} for t in terapeutas]
+
+        # Agendamentos + grades ativas + linhas das grades, para qualquer número de terapeutas
+        with self.assertNumQueries(3):
+            resultado = Agendamento.verificar_conflitos_lote(candidatos)
+        self.assertEqual([[ag.virtual for ag in c] for c in resultado], [[True]] * len(terapeutas))
+        with self.assertNumQueries(3):
+            self.assertTrue(Agendamento.verificar_conflito(terapeutas[-1], data, time(9, 0), time(9, 45)))
+
+    def test_criacao_em_lote_indice_de_conflitos(self):
+        semana_1 = self.hoje + timedelta(weeks=1)
+        semana_2 = self.hoje + timedelta(weeks=2)
+        falta = Agendamento.objects.create(
+            paciente=self.paciente, terapeuta=self.terapeuta, data=semana_1,
+            hora_inicio=time(14, 0), hora_fim=time(14, 45), status='FALTA'
+        )
+        Agendamento.objects.create(
+            paciente=self.paciente, terapeuta=self.terapeuta, data=semana_2,
+            hora_inicio=time(14, 30), hora_fim=time(15, 15)
+        )
+        dados = {
+            'paciente': self.paciente, 'terapeuta': self.terapeuta, 'data': self.hoje,
+            'hora_inicio': time(14, 0), 'hora_fim': time(14, 45), 'repeticoes': 3,
+        }
+
+        # SELECT + grades ativas (sessões projetadas) + soft delete + bulk_create (+ savepoint da transação)
+        with self.assertNumQueries(6):
+            criados, conflitos = criar_agendamentos_em_lote(dados, None)
+
+        self.assertEqual(criados, 3)
+        self.assertEqual(conflitos, [semana_2.strftime('%d/%m')])
+        falta.refresh_from_db()
+        self.assertTrue(falta.deletado)
+
+
+class BloqueiosFixosTest(TestCase):
+    def setUp(self):
+        self.terapeuta = Terapeuta.objects.create(nome='Dra. Bloqueio')
+        self.addCleanup(bloqueios.invalidar)
+
+    def test_indice_invalidado_pelos_signals(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            bloqueio = BloqueioFixo.objects.create(terapeuta=self.terapeuta, dia_semana=2, hora_inicio=time(13, 30), hora_fim=time(15, 0))
+
+        self.assertTrue(bloqueios.esta_bloqueado(self.terapeuta.id, 2, time(14, 45), time(15, 30)))
+        # Depois de compilado, consultar não vai mais ao banco
+        with self.assertNumQueries(0):
+            self.assertFalse(bloqueios.esta_bloqueado(self.terapeuta.id, 2, time(15, 0), time(15, 45)))
+            self.assertFalse(bloqueios.esta_bloqueado(self.terapeuta.id, 3, time(14, 0), time(14, 45)))
+            self.assertEqual(bloqueios.bloqueios_do_dia(2)[0].indices_grade, (7, 8))  # 13:30 e 14:15
+
+        with self.captureOnCommitCallbacks(execute=True):
+            bloqueio.delete()
+        self.assertFalse(bloqueios.esta_bloqueado(self.terapeuta.id, 2, time(14, 45), time(15, 30)))
+
+    def test_mudanca_de_outro_processo_vale_quando_a_versao_expira(self):
+        bloqueio = BloqueioFixo.objects.create(terapeuta=self.terapeuta, dia_semana=2, hora_inicio=time(13, 30), hora_fim=time(15, 0))
+        bloqueios.invalidar()
+        self.assertTrue(bloqueios.esta_bloqueado(self.terapeuta.id, 2, time(14, 45), time(15, 30)))
+
+        # Gravação sem signal neste processo, como a de outro worker com LocMemCache
+        BloqueioFixo.objects.filter(pk=bloqueio.pk).update(hora_fim=time(14, 0))
+        self.assertTrue(bloqueios.esta_bloqueado(self.terapeuta.id, 2, time(14, 45), time(15, 30)))
+        cache.delete(bloqueios.CHAVE_VERSAO)  # o que o VALIDADE_VERSAO faz sozinho
+        self.assertFalse(bloqueios.esta_bloqueado(self.terapeuta.id, 2, time(14, 45), time(15, 30)))
+
+        # Cache compartilhado: a versão só muda pelos signals, sem expirar
+        self.assertEqual(bloqueios._validade(), bloqueios.VALIDADE_VERSAO)
+        with self.settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}}):
+            self.assertIsNone(bloqueios._validade())
+
+
+class MapaOcupacaoTest(TestCase):
+    def setUp(self):
+        self.terapeuta = Terapeuta.objects.create(nome='Dra. Ocupada')
+        self.addCleanup(bloqueios.invalidar)
+
+    def test_equivale_a_verificar_conflito(self):
+        import random
+        random.seed(7)
+        dia = timezone.localdate()
+        terapeutas = [self.terapeuta, Terapeuta.objects.create(nome='Dr. Dois')]
+        salas = [Sala.objects.create(nome='Sala 1'), Sala.objects.create(nome='Sala 2', compartilhada=True)]
+        paciente = Paciente.objects.create(nome='Paciente Mapa', cpf='45645645645')
+        for _ in range(30):
+            inicio = random.randrange(7 * 60, 19 * 60, 5)
+            Agendamento.objects.create(
+                paciente=paciente, terapeuta=random.choice(terapeutas), sala=random.choice(salas),
+                data=dia + timedelta(days=random.randint(0, 1)), status=random.choice(['AGUARDANDO', 'FALTA', 'REALIZADO']),
+                hora_inicio=time(inicio // 60, inicio % 60), hora_fim=time(*divmod(inicio + random.choice([20, 45, 90]), 60)),
+                deletado=random.random() < 0.2,
+            )
+
+        with self.assertNumQueries(2):
+            mapa = MapaOcupacao.carregar(dia, dia + timedelta(days=1), virtuais=False, bloqueios=False)
+        for data in (dia, dia + timedelta(days=1)):
+            for inicio in range(7 * 60, 19 * 60, 10):
+                hi, hf = time(*divmod(inicio, 60)), time(*divmod(inicio + 45, 60))
+                for t in terapeutas:
+                    self.assertEqual(mapa.sobrepoe('terapeuta', t.id, data, hi, hf), Agendamento.verificar_conflito(t, data, hi, hf), (t, data, hi))
+                for sala in salas:
+                    esperado = bool(Agendamento.verificar_conflitos_sala_lote([{'sala': sala, 'data': data, 'hora_inicio': hi, 'hora_fim': hf}])[0])
+                    self.assertEqual(mapa.sobrepoe('sala', sala.id, data, hi, hf), esperado, (sala, data, hi))
+
+    def test_sessoes_projetadas_equivalem_a_verificar_conflito(self):
+        hoje = timezone.localdate()
+        sala = Sala.objects.create(nome='Sala Grade')
+        pacientes = [Paciente.objects.create(nome=f'Paciente Grade {i}', cpf=f'1111111111{i}') for i in range(3)]
+        # Vigência no passado e nenhuma semana gravada: a projeção começa hoje
+        grade = AgendaFixa.objects.create(
+            paciente=pacientes[0], terapeuta=self.terapeuta, sala=sala, dia_semana=hoje.weekday(),
+            hora_inicio=time(9, 0), hora_fim=time(9, 45), data_inicio=hoje - timedelta(days=28),
+        )
+        # Semana 1: falta gravada; semana 2: outro paciente no horário (a grade pula a data)
+        Agendamento.objects.create(paciente=pacientes[0], terapeuta=self.terapeuta, agenda_fixa=grade, sala=sala,
+                                   data=hoje + timedelta(days=7), hora_inicio=time(9, 0), hora_fim=time(9, 45), status='FALTA')
+        Agendamento.objects.create(paciente=pacientes[1], terapeuta=self.terapeuta,
+                                   data=hoje + timedelta(days=14), hora_inicio=time(8, 30), hora_fim=time(9, 15))
+
+        inicio, fim = hoje - timedelta(days=14), hoje + timedelta(days=21)
+        mapa = MapaOcupacao.carregar(inicio, fim, bloqueios=False)
+        for semana in range(-2, 4):
+            data = hoje + timedelta(weeks=semana)
+            for hi, hf in [(time(8, 0), time(8, 45)), (time(9, 15), time(10, 0)), (time(10, 0), time(10, 45))]:
+                self.assertEqual(mapa.sobrepoe('terapeuta', self.terapeuta.id, data, hi, hf),
+                                 Agendamento.verificar_conflito(self.terapeuta, data, hi, hf), (data, hi))
+                sala_ocupada = Agendamento.verificar_conflitos_sala_lote([{'sala': sala, 'data': data, 'hora_inicio': hi, 'hora_fim': hf}])[0]
+                self.assertEqual(mapa.sobrepoe('sala', sala.id, data, hi, hf), bool(sala_ocupada), (data, hi))
+
+    def test_janelas_livres_e_utilizacao(self):
+        dia = timezone.localdate()
+        paciente = Paciente.objects.create(nome='Paciente Janela', cpf='78978978978')
+        Agendamento.objects.create(paciente=paciente, terapeuta=self.terapeuta, data=dia, hora_inicio=time(8, 0))
+        mapa = MapaOcupacao.carregar(dia, dia, bloqueios=False)
+        janelas = mapa.janelas_livres('terapeuta', self.terapeuta.id, dia)
+        self.assertEqual(janelas, [(time(7, 15), time(8, 0)), (time(8, 45), time(12, 30)), (time(13, 30), time(19, 30))])
+        self.assertEqual(mapa.janelas_livres('terapeuta', self.terapeuta.id, dia, duracao=60)[0], (time(8, 45), time(12, 30)))
+        self.assertAlmostEqual(mapa.utilizacao('terapeuta', self.terapeuta.id, dia), 45 / 675)
+
+    def test_horarios_livres_pulam_ocupados(self):
+        segunda = timezone.localdate() + timedelta(days=7 - timezone.localdate().weekday())
+        sala = Sala.objects.create(nome='Sala Única')
+        outro_terapeuta = Terapeuta.objects.create(nome='Dr. Vizinho')
+        paciente = Paciente.objects.create(nome='Paciente Reposição', cpf='12312312312')
+        outro = Paciente.objects.create(nome='Outro', cpf='32132132132')
+        with self.captureOnCommitCallbacks(execute=True):
+            BloqueioFixo.objects.create(terapeuta=self.terapeuta, dia_semana=0, hora_inicio=time(7, 15), hora_fim=time(8, 0))
+        # 08:00 terapeuta ocupado, 08:45 paciente ocupado, 09:30 sala ocupada
+        Agendamento.objects.create(paciente=outro, terapeuta=self.terapeuta, sala=sala, data=segunda, hora_inicio=time(8, 0))
+        Agendamento.objects.create(paciente=paciente, terapeuta=outro_terapeuta, data=segunda, hora_inicio=time(8, 45))
+        Agendamento.objects.create(paciente=outro, terapeuta=outro_terapeuta, sala=sala, data=segunda, hora_inicio=time(9, 30))
+
+        livres = buscar_horarios_livres(segunda, segunda, paciente=paciente, terapeuta=self.terapeuta, quantidade=2)
+        self.assertEqual([h['hora_inicio'] for h in livres], [time(10, 15), time(11, 0)])
+        self.assertEqual(livres[0]['sala'], sala)
+
+    def test_falta_na_grade_libera_o_horario_projetado(self):
+        segunda = timezone.localdate() + timedelta(days=7 - timezone.localdate().weekday())
+        Sala.objects.create(nome='Sala Reposição')
+        paciente = Paciente.objects.create(nome='Paciente Fixo', cpf='74174174174')
+        grade = AgendaFixa.objects.create(
+            paciente=paciente, terapeuta=self.terapeuta, dia_semana=0,
+            hora_inicio=time(7, 15), hora_fim=time(8, 0), data_inicio=segunda,
+        )
+        primeiro = lambda: buscar_horarios_livres(segunda, segunda, terapeuta=self.terapeuta, quantidade=1)[0]['hora_inicio']
+        self.assertEqual(primeiro(), time(8, 0))
+
+        # A falta grava a sessão daquela data: a projeção não volta a ocupar o horário
+        Agendamento.objects.create(
+            paciente=paciente, terapeuta=self.terapeuta, agenda_fixa=grade, data=segunda,
+            hora_inicio=time(7, 15), hora_fim=time(8, 0), status='FALTA',
+        )
+        self.assertEqual(primeiro(), time(7, 15))
+
+
+class GradeTest(TestCase):
+    def test_itens_caem_no_slot_visual(self):
+        dias = [date(2026, 3, 2), date(2026, 3, 3)]
+        grade = Grade(dias)
+        grade.adicionar(dias[0], time(7, 0), 'antes da abertura')
+        grade.adicionar(dias[0], time(8, 30), 'meio do slot')
+        grade.adicionar(dias[1], time(13, 30), 'tarde')
+        grade.adicionar(date(2026, 3, 9), time(8, 0), 'fora da grade')
+        grade.carimbar(dias[1], [['bloqueio'], ['bloqueio']])
+
+        linhas = grade.linhas
+        self.assertEqual([l.hora for l in linhas[:2]], [time(7, 15), time(8, 0)])
+        self.assertEqual(linhas[0].celulas, [['antes da abertura'], ['bloqueio']])
+        self.assertEqual(linhas[1].celulas, [['meio do slot'], ['bloqueio']])
+        self.assertEqual(linhas[7].celulas, [[], ['tarde']])
+        self.assertEqual(sum(len(c) for l in linhas for c in l.celulas), 5)
+
+
+@override_settings(AGENDA_CACHE_GRADE=True)
+class GradeAgendamentosTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('recepcao', password='x'))
+        self.terapeuta = Terapeuta.objects.create(nome='Dra. Cache')
+        self.paciente = Paciente.objects.create(nome='Paciente Cacheado', cpf='14714714714')
+        self.addCleanup(cache.clear)
+
+    def test_grade_servida_do_cache_ate_a_data_mudar(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        self.client.get('/agendamentos/')
+        with CaptureQueriesContext(connection) as consultas:
+            self.client.get('/agendamentos/')
+        self.assertFalse([q for q in consultas if 'core_agendamento' in q['sql']])
+
+        ag = Agendamento.objects.create(paciente=self.paciente, terapeuta=self.terapeuta, data=timezone.localdate(), hora_inicio=time(8, 0))
+        self.assertIn('Paciente Cacheado', self.client.get('/agendamentos/').context['grade_html'])
+
+        # Remarcar para outra semana tira da grade antiga
+        ag.data = timezone.localdate() + timedelta(days=21)
+        ag.save()
+        self.assertNotIn('Paciente Cacheado', self.client.get('/agendamentos/').context['grade_html'])
+
+    def test_periodo_longo_carrega_em_blocos(self):
+        inicio = timezone.localdate()
+        Agendamento.objects.create(paciente=self.paciente, terapeuta=self.terapeuta, data=inicio + timedelta(days=40), hora_inicio=time(8, 0))
+
+        resposta = self.client.get('/agendamentos/', {'data_inicio': str(inicio), 'data_fim': str(inicio + timedelta(days=90))})
+        self.assertNotIn('Paciente Cacheado', resposta.context['grade_html'])
+        blocos = resposta.context['blocos_pendentes']
+        self.assertEqual(len(blocos), 12)  # 91 dias = 13 semanas, a primeira já vem na página
+
+        bloco = next(b for b in blocos if b['inicio'] <= inicio + timedelta(days=40) <= b['fim'])
+        self.assertContains(self.client.get(bloco['url']), 'Paciente Cacheado')
+        # O endpoint nunca devolve mais que uma semana
+        longo = self.client.get('/agendamentos/grade-semana/', {'data_inicio': str(inicio), 'data_fim': str(inicio + timedelta(days=90))})
+        self.assertEqual(longo.content.count(b'<th class="text-secondary'), 7)
+
+    def test_feed_json_responde_304_enquanto_o_periodo_nao_muda(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        primeira = self.client.get('/agendamentos/feed/')
+        self.assertEqual(primeira.json()['ag'], [])
+        with CaptureQueriesContext(connection) as consultas:
+            segunda = self.client.get('/agendamentos/feed/', HTTP_IF_NONE_MATCH=primeira['ETag'])
+        self.assertEqual(segunda.status_code, 304)
+        self.assertEqual(segunda.content, b'')
+        self.assertFalse([q for q in consultas if 'core_agendamento' in q['sql']])
+
+        Agendamento.objects.create(paciente=self.paciente, terapeuta=self.terapeuta, data=timezone.localdate(), hora_inicio=time(8, 0))
+        terceira = self.client.get('/agendamentos/feed/', HTTP_IF_NONE_MATCH=primeira['ETag'])
+        self.assertEqual(terceira.status_code, 200)
+        self.assertEqual(terceira.json()['ag'][0]['pn'], 'Paciente Cacheado')
+
+        # Sem cache compartilhado a versão seria só deste processo: nada de ETag nem 304
+        with self.settings(AGENDA_CACHE_GRADE=False):
+            resposta = self.client.get('/agendamentos/feed/', HTTP_IF_NONE_MATCH=terceira['ETag'])
+        self.assertEqual(resposta.status_code, 200)
+        self.assertNotIn('ETag', resposta)
+
+        # Filtro de id que não é número: 400 na API, ignorado na tela
+        self.assertEqual(self.client.get('/agendamentos/feed/', {'terapeuta': 'abc'}).status_code, 400)
+        self.assertEqual(self.client.get('/agendamentos/', {'filtro_terapeuta': 'abc', 'filtro_sala': '1 OR 1'}).status_code, 200)
+
+
+class AgendaAoVivoTest(TestCase):
+    async def test_eventos_trazem_so_as_celulas_alteradas(self):
+        from asgiref.sync import sync_to_async
+        from core import alteracoes
+
+        hoje = timezone.localdate()
+        usuario = await sync_to_async(User.objects.create_superuser)('aovivo', password='x')
+        terapeuta = await Terapeuta.objects.acreate(nome='Dra. Ao Vivo')
+        paciente = await Paciente.objects.acreate(nome='Paciente Ao Vivo', cpf='25825825825')
+        await self.async_client.aforce_login(usuario)
+
+        resposta = await self.async_client.get('/agendamentos/eventos/', {'data_inicio': str(hoje), 'data_fim': str(hoje + timedelta(days=6))})
+        eventos = aiter(resposta.streaming_content)
+        self.assertIn(b'retry', await anext(eventos))
+
+        async def proximo_evento(hora):
+            await sync_to_async(Agendamento.objects.create)(paciente=paciente, terapeuta=terapeuta, data=hoje, hora_inicio=hora)
+            alteracoes.publicar([hoje])  # o signal só avisa no commit, que o TestCase não faz
+            return json.loads((await asyncio.wait_for(anext(eventos), 5)).decode().split('data: ', 1)[1])
+
+        # Primeiro aviso: a coluna inteira do dia (ainda não há o que comparar)
+        celulas = await proximo_evento(time(7, 15))
+        self.assertTrue(all(chave.startswith(f'{hoje}|') for chave in celulas))
+        self.assertIn('Paciente Ao Vivo', celulas[f'{hoje}|0'])
+        # Depois só a célula que mudou
+        celulas = await proximo_evento(time(8, 0))
+        self.assertEqual(list(celulas), [f'{hoje}|1'])
+
+
+@override_settings(AGENDA_CACHE_GRADE=True)
+class CalendarioTerapeutaTest(TestCase):
+    def test_ics_gerado_em_streaming_e_depois_do_cache(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        self.addCleanup(cache.clear)
+        terapeuta = Terapeuta.objects.create(nome='Dra. Celular')
+        paciente = Paciente.objects.create(nome='Paciente, Agenda', cpf='36936936936')
+        Agendamento.objects.create(paciente=paciente, terapeuta=terapeuta, data=timezone.localdate() + timedelta(days=3), hora_inicio=time(8, 0))
+        BloqueioFixo.objects.create(terapeuta=terapeuta, dia_semana=2, hora_inicio=time(12, 0), hora_fim=time(13, 0))
+        url = f'/calendario/{terapeuta.renovar_token_calendario()}.ics'
+
+        resposta = self.client.get(url)
+        self.assertTrue(resposta.streaming)
+        corpo = b''.join(resposta.streaming_content).decode()
+        self.assertTrue(corpo.startswith('BEGIN:VCALENDAR\r\n') and corpo.endswith('END:VCALENDAR\r\n'))
+        self.assertIn('SUMMARY:Paciente\\, Agenda', corpo)
+        self.assertIn('RRULE:FREQ=WEEKLY;BYDAY=WE', corpo)
+        # O TZID dos bloqueios precisa da VTIMEZONE no próprio arquivo, antes dos eventos
+        self.assertLess(corpo.index('BEGIN:VTIMEZONE\r\nTZID:America/Sao_Paulo\r\n'), corpo.index('BEGIN:VEVENT'))
+
+        with CaptureQueriesContext(connection) as consultas:
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=resposta['ETag']).status_code, 304)
+            self.assertEqual(self.client.get(url).content.decode(), corpo)
+        self.assertFalse([q for q in consultas if 'core_agendamento' in q['sql']])
+
+        self.assertEqual(self.client.get('/calendario/token-errado.ics').status_code, 404)
+
+    def test_vtimezone_traz_as_trocas_de_horario(self):
+        from zoneinfo import ZoneInfo
+        from core.calendario import _vtimezone
+
+        linhas = _vtimezone(ZoneInfo('America/New_York'), date(2026, 1, 1), date(2026, 12, 31))
+        self.assertEqual([l for l in linhas if l.startswith(('BEGIN:', 'DTSTART', 'TZOFFSETTO'))], [
+            'BEGIN:VTIMEZONE', 'BEGIN:STANDARD', 'DTSTART:19700101T000000', 'TZOFFSETTO:-0500',
+            'BEGIN:DAYLIGHT', 'DTSTART:20260308T020000', 'TZOFFSETTO:-0400',
+            'BEGIN:STANDARD', 'DTSTART:20261101T020000', 'TZOFFSETTO:-0500',
+        ])
+
+
+class BuscaPacientesTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('busca', password='x'))
+        for i in range(25):
+            Paciente.objects.create(nome=f'Paciente {i:02d}', cpf=f'{i:011d}')
+        self.ana = Paciente.objects.create(nome='Ana Conceição', cpf='98765432100')
+        Paciente.objects.create(nome='João Ananias', cpf='98765432111')
+
+    def test_busca_por_palavra_cpf_e_paginas(self):
+        resultado = self.client.get('/pacientes/buscar/', {'q': 'ana'}).json()['results']
+        self.assertEqual([r['text'] for r in resultado], ['Ana Conceição', 'João Ananias'])
+        self.assertEqual(self.client.get('/pacientes/buscar/', {'q': 'CONCEICAO'}).json()['results'][0]['id'], self.ana.id)
+        self.assertEqual(len(self.client.get('/pacientes/buscar/', {'q': '9876543'}).json()['results']), 2)
+
+        primeira = self.client.get('/pacientes/buscar/', {'q': 'paciente'}).json()
+        segunda = self.client.get('/pacientes/buscar/', {'q': 'paciente', 'page': 2}).json()
+        self.assertEqual((len(primeira['results']), primeira['pagination']['more']), (20, True))
+        self.assertEqual((len(segunda['results']), segunda['pagination']['more']), (5, False))
+
+    def test_indice_acompanha_gravacoes_e_tolera_erro_de_digitacao(self):
+        from . import busca
+
+        self.assertTrue(busca.disponivel())
+        Paciente.objects.filter(pk=self.ana.pk).update(telefone='11987654321', carteirinha='UNI-7788')
+        Paciente.objects.bulk_create([Paciente(nome='Beatriz Lote', nome_search='beatriz lote', cpf='12312312399')])
+
+        self.assertEqual(busca.buscar('(11) 98765-4321'), [self.ana.id])
+        self.assertEqual(busca.buscar('uni-77'), [self.ana.id])
+        self.assertEqual(len(busca.buscar('lote')), 1)
+        self.assertEqual(busca.buscar('Conseicao'), [self.ana.id])  # erro de digitação
+        self.assertEqual(busca.buscar('an'), [self.ana.id])  # curto: só começo do nome
+
+        Paciente.objects.filter(pk=self.ana.pk).delete()
+        self.assertEqual(busca.buscar('conceicao'), [])
+
+    def test_reindex_busca_corrige_nome_search_desatualizado(self):
+        from . import busca
+
+        Paciente.objects.filter(pk=self.ana.pk).update(nome='Ana Müller', nome_search=None)
+        terapeuta = Terapeuta.objects.create(nome='Dra. Conceição')
+        Terapeuta.objects.filter(pk=terapeuta.pk).update(nome_search='antigo')
+        saida = StringIO()
+        call_command('reindex_busca', '--lote', '7', stdout=saida)
+
+        self.assertIn('Pacientes: 1 de 27 atualizados', saida.getvalue())
+        self.assertEqual(Paciente.objects.get(pk=self.ana.pk).nome_search, 'ana muller')
+        self.assertEqual(busca.buscar('muller'), [self.ana.id])
+        self.assertEqual(self.client.get('/equipe/lista/', {'q': 'CONCEICAO'}).context['terapeutas'].get(), terapeuta)
+
+    def test_formulario_so_traz_o_paciente_selecionado(self):
+        from .forms import AgendamentoForm
+
+        html = str(AgendamentoForm(initial={'paciente': self.ana.pk})['paciente'])
+        self.assertIn('Ana Conceição', html)
+        self.assertNotIn('Paciente 01', html)
+        self.assertNotIn('Paciente 01', self.client.get('/agendamentos/').content.decode())
+
+
+
+class BuscaProntuariosTest(TestCase):
+    def setUp(self):
+        setup_grupos()
+        self.usuario = User.objects.create_user('terapeuta', password='x')
+        self.usuario.groups.add(Group.objects.get(name='Terapeutas'))
+        self.terapeuta = Terapeuta.objects.create(nome='Dra. Própria', usuario=self.usuario)
+        self.colega = Terapeuta.objects.create(nome='Dr. Colega')
+        self.meu = Paciente.objects.create(nome='Paciente Meu', cpf='10000000001')
+        self.alheio = Paciente.objects.create(nome='Paciente Alheio', cpf='10000000002')
+        hoje = timezone.localdate()
+        self.sessoes = [
+            Agendamento.objects.create(paciente=paciente, terapeuta=terapeuta, data=hoje - timedelta(days=dias), hora_inicio=time(9, 0), hora_fim=time(9, 45))
+            for paciente, terapeuta, dias in [(self.meu, self.terapeuta, 1), (self.meu, self.colega, 2), (self.alheio, self.colega, 3)]
+        ]
+        self.client.force_login(self.usuario)
+
+    def test_indexa_ao_salvar_e_respeita_permissoes(self):
+        for ag in self.sessoes[1:]:
+            Consulta.objects.create(agendamento=ag, evolucao='Nova crise convulsiva <b>durante</b> a sessão.')
+        atender = f'/agendamentos/atender/{self.sessoes[0].id}/'
+        self.client.post(atender, {'evolucao': 'Crise convulsiva breve.'})
+        self.client.post(atender, {'evolucao': 'Sem intercorrências.'})
+
+        # Terapeuta: só os pacientes que atende (a evolução do colega com o mesmo paciente entra)
+        resposta = self.client.get('/consultas/prontuarios/', {'q': 'SESSAO convuls "crise convulsiva"'})
+        html = resposta.content.decode()
+        self.assertEqual([r.agendamento_id for r in resposta.context['resultados']], [self.sessoes[1].id])
+        self.assertIn('<mark>crise convulsiva</mark>', html)
+        self.assertIn('&lt;b&gt;durante&lt;/b&gt;', html)
+
+        dono = User.objects.create_superuser('dono', password='x')
+        self.client.force_login(dono)
+        primeira = self.client.get('/consultas/prontuarios/', {'q': 'crise'}).context
+        self.assertEqual(len(primeira['resultados']), 2)
+
+        from .busca_prontuarios import buscar
+        pagina, cursor = buscar('crise', limite=1)
+        seguinte, fim = buscar('crise', apos=cursor, limite=1)
+        self.assertEqual([pagina[0].agendamento_id, seguinte[0].agendamento_id, fim], [self.sessoes[1].id, self.sessoes[2].id, None])
+
+        administrativo = User.objects.create_user('adm', password='x')
+        administrativo.groups.add(Group.objects.get(name='Administrativo'))
+        self.client.force_login(administrativo)
+        self.assertRedirects(self.client.get('/consultas/prontuarios/', {'q': 'crise'}), '/agendamentos/', fetch_redirect_response=False)
+
+class GerarAgendaFuturaTest(TestCase):
+    def setUp(self):
+        self.terapeuta = Terapeuta.objects.create(nome='Dra. Grade')
+        self.paciente = Paciente.objects.create(nome='Paciente Fixo', cpf='55566677788')
+        self.outro = Paciente.objects.create(nome='Outro Paciente', cpf='99988877766')
+        self.hoje = timezone.localdate()
+        self.grade = AgendaFixa.objects.create(
+            paciente=self.paciente, terapeuta=self.terapeuta,
+            dia_semana=self.hoje.weekday(), hora_inicio=time(9, 0), hora_fim=time(9, 45),
+            data_inicio=self.hoje
+        )
+
+    def test_cria_absorve_e_pula(self):
+        semana_1 = self.hoje + timedelta(days=7)
+        semana_2 = self.hoje + timedelta(days=14)
+        # Mesmo paciente em outro horário sobreposto -> absorvido
+        absorvido = Agendamento.objects.create(
+            paciente=self.paciente, terapeuta=self.terapeuta,
+            data=semana_1, hora_inicio=time(9, 15), hora_fim=time(10, 0)
+        )
+        # Outro paciente ocupando o horário -> conflito, pula
+        Agendamento.objects.create(
+            paciente=self.outro, terapeuta=self.terapeuta,
+            data=semana_2, hora_inicio=time(9, 0), hora_fim=time(9, 45)
+        )
+
+        total = gerar_agenda_futura(dias_a_frente=21, agenda_especifica=self.grade)
+
+        # hoje e +21 criados, +7 absorvido, +14 pulado
+        self.assertEqual(total, 3)
+        absorvido.refresh_from_db()
+        self.assertEqual(absorvido.agenda_fixa, self.grade)
+        self.assertEqual(absorvido.hora_inicio, time(9, 0))
+        self.assertEqual(Agendamento.objects.filter(agenda_fixa=self.grade).count(), 3)
+        self.assertFalse(Agendamento.objects.filter(agenda_fixa=self.grade, data=semana_2).exists())
+
+        # Segunda execução não cria nem altera nada
+        self.assertEqual(gerar_agenda_futura(dias_a_frente=21, agenda_especifica=self.grade), 0)
+
+    def test_marca_dagua_gera_apenas_semanas_novas(self):
+        self.assertEqual(gerar_agenda_futura(dias_a_frente=14, agenda_especifica=self.grade), 3)
+        self.grade.refresh_from_db()
+        self.assertEqual(self.grade.materializado_ate, self.hoje + timedelta(days=14))
+
+        # Sessão removida dentro da janela já coberta não é recriada
+        Agendamento.objects.filter(agenda_fixa=self.grade, data=self.hoje).update(deletado=True)
+        self.assertEqual(gerar_agenda_futura(dias_a_frente=28), 2)
+        self.assertFalse(Agendamento.objects.ativos().filter(agenda_fixa=self.grade, data=self.hoje).exists())
+
+
+    def test_plano_simulado_nao_grava_e_reaproveita(self):
+        plano = planejar_agenda_futura(dias_a_frente=14, agenda_especifica=self.grade)
+        self.assertEqual(len(plano.criar), 3)
+        self.assertFalse(Agendamento.objects.exists())
+        self.assertIsNone(AgendaFixa.objects.get(pk=self.grade.pk).materializado_ate)
+
+        token = guardar_plano(plano, 'assinatura')
+        self.assertIsNone(recuperar_plano(token, 'outra'))  # consumido e rejeitado
+
+        token = guardar_plano(plano, 'assinatura')
+        self.assertEqual(aplicar_plano(recuperar_plano(token, 'assinatura')), 3)
+        self.assertEqual(Agendamento.objects.filter(agenda_fixa=self.grade).count(), 3)
+
+    def test_plano_guardado_invalida_quando_linha_muda_de_horario(self):
+        outro = Agendamento.objects.create(
+            paciente=self.outro, terapeuta=self.terapeuta, data=self.hoje + timedelta(days=7), hora_inicio=time(14, 0), hora_fim=time(14, 45)
+        )
+        token = guardar_plano(planejar_agenda_futura(dias_a_frente=14, agenda_especifica=self.grade), 'assinatura')
+        # Mesma quantidade e mesmo maior id, mas agora ocupa o horário da grade
+        Agendamento.objects.filter(pk=outro.pk).update(hora_inicio=time(9, 0), hora_fim=time(9, 45))
+        self.assertIsNone(recuperar_plano(token, 'assinatura'))
+
+    def test_nova_agenda_fixa_previa_e_gravacao(self):
+        self.client.force_login(User.objects.create_superuser('grade', password='x'))
+        dados = {
+            'paciente': self.outro.id, 'terapeuta': self.terapeuta.id, 'sala': Sala.objects.create(nome='Sala 1').id,
+            'dia_semana': self.hoje.weekday(), 'hora_inicio': '11:00', 'hora_fim': '11:45',
+            'data_inicio': str(self.hoje), 'ativo': 'on',
+        }
+        resposta = self.client.post('/agenda-fixa/nova/', {**dados, 'acao': 'previa'})
+        self.assertContains(resposta, 'Pré-visualização')
+        self.assertFalse(Agendamento.objects.filter(paciente=self.outro).exists())
+
+        resposta = self.client.post('/agenda-fixa/nova/', {**dados, 'plano_token': resposta.context['plano_token']})
+        self.assertEqual(resposta.status_code, 302)
+        self.assertTrue(Agendamento.objects.filter(paciente=self.outro, hora_inicio=time(11, 0)).exists())
+
+    def test_comando_materializar_agenda(self):
+        saida = StringIO()
+        call_command('materializar_agenda', '--dias', '14', stdout=saida)
+        self.assertIn('Dra. Grade: 3 agendamentos', saida.getvalue())
+        self.assertEqual(Agendamento.objects.filter(agenda_fixa=self.grade).count(), 3)
+
+    def test_conflito_de_sala_entre_terapeutas(self):
+        sala = Sala.objects.create(nome='Sala 3')
+        self.grade.sala = sala
+        self.grade.save()
+        outra_grade = AgendaFixa.objects.create(
+            paciente=self.outro, terapeuta=Terapeuta.objects.create(nome='Dr. Vizinho'), sala=sala,
+            dia_semana=self.hoje.weekday(), hora_inicio=time(9, 30), hora_fim=time(10, 15),
+            data_inicio=self.hoje
+        )
+
+        gerar_agenda_futura(dias_a_frente=7, agenda_especifica=outra_grade)
+        plano = planejar_agenda_futura(dias_a_frente=7, agenda_especifica=self.grade)
+        self.assertEqual(len(plano.criar), 2)
+        self.assertEqual([(data, ag.paciente) for _, data, ag in plano.conflitos_sala],
+                         [(self.hoje, self.outro), (self.hoje + timedelta(days=7), self.outro)])
+        conflitos = Agendamento.verificar_conflitos_sala_lote([
+            {'sala': sala, 'paciente': self.paciente, 'data': self.hoje, 'hora_inicio': time(9, 0), 'hora_fim': time(9, 45)},
+            {'sala': sala, 'paciente': self.outro, 'data': self.hoje, 'hora_inicio': time(9, 0), 'hora_fim': time(9, 45)},
+        ])
+        # O segundo esbarra na sessão projetada de self.grade (ainda não gravada) na mesma sala
+        self.assertEqual([[ag.paciente for ag in c] for c in conflitos], [[self.outro], [self.paciente]])
+
+        # Sala compartilhada (co-terapia) não gera aviso
+        sala.compartilhada = True
+        sala.save()
+        self.grade.refresh_from_db()
+        self.assertEqual(planejar_agenda_futura(dias_a_frente=7, agenda_especifica=self.grade).conflitos_sala, [])
+
+    def test_comando_benchmark_nao_grava(self):
+        saida = StringIO()
+        call_command('benchmark_agenda', '--terapeutas', '2', '--dias', '14', '--repeticoes', '1', stdout=saida)
+        self.assertIn('agend_terap_data_hora_idx', saida.getvalue())
+        self.assertFalse(Agendamento.objects.exists())
+        self.assertEqual(Terapeuta.objects.count(), 1)
+
+    def test_ressincronizacao_move_linhas_sem_recriar(self):
+        gerar_agenda_futura(dias_a_frente=14, agenda_especifica=self.grade)
+        Agendamento.objects.filter(agenda_fixa=self.grade, data=self.hoje).update(status='REALIZADO')
+        ids = set(Agendamento.objects.filter(agenda_fixa=self.grade, status='AGUARDANDO').values_list('id', flat=True))
+
+        # Troca de dia: as mesmas linhas mudam de data, nada é apagado e recriado
+        self.grade.dia_semana = (self.hoje + timedelta(days=1)).weekday()
+        self.grade.hora_inicio, self.grade.hora_fim = time(10, 0), time(10, 45)
+        self.grade.save()
+        plano = ressincronizar_agenda_fixa(self.grade)
+        self.assertEqual((len(plano.criar), len(plano.remover)), (0, 0))
+        futuros = Agendamento.objects.filter(agenda_fixa=self.grade, status='AGUARDANDO')
+        self.assertEqual(set(futuros.values_list('id', flat=True)), ids)
+        self.assertEqual(sorted(futuros.values_list('data', flat=True)), [self.hoje + timedelta(days=1), self.hoje + timedelta(days=8)])
+        self.assertEqual(set(futuros.values_list('hora_inicio', flat=True)), {time(10, 0)})
+        self.assertTrue(Agendamento.objects.filter(agenda_fixa=self.grade, data=self.hoje, status='REALIZADO').exists())
+
+        # Fim de vigência: só o que passou do fim sai
+        self.grade.data_fim = self.hoje + timedelta(days=2)
+        self.grade.save()
+        plano = ressincronizar_agenda_fixa(self.grade)
+        self.assertEqual(len(plano.remover), 1)
+        self.assertEqual(list(futuros.values_list('data', flat=True)), [self.hoje + timedelta(days=1)])
+
+    def test_ressincronizacao_preserva_sessao_aberta_alem_do_horizonte(self):
+        distante = materializar_ocorrencia(self.grade, self.hoje + timedelta(weeks=6))
+        Consulta.objects.create(agendamento=distante, evolucao='Evolução já registrada')
+        sala = Sala.objects.create(nome='Sala Nova')
+
+        self.grade.sala = sala
+        self.grade.save()
+        plano = ressincronizar_agenda_fixa(self.grade)
+        self.assertEqual(plano.remover, [])
+        distante.refresh_from_db()
+        self.assertEqual(distante.sala, sala)
+
+        self.grade.dia_semana = (self.hoje + timedelta(days=1)).weekday()
+        self.grade.save()
+        ressincronizar_agenda_fixa(self.grade)
+        distante.refresh_from_db()
+        self.assertEqual(distante.data, self.hoje + timedelta(weeks=6, days=1))
+        self.assertEqual(distante.consulta.evolucao, 'Evolução já registrada')
+
+
+
+class MaterializacaoParalelaTest(TransactionTestCase):
+    """Os processos do --workers leem o banco de teste em arquivo (DATABASES TEST NAME)."""
+
+    def test_workers_gravam_o_mesmo_que_a_execucao_serial(self):
+        hoje = timezone.localdate()
+        for i in range(3):
+            terapeuta = Terapeuta.objects.create(nome=f'Dra. Paralela {i}')
+            for j in range(2):
+                AgendaFixa.objects.create(
+                    paciente=Paciente.objects.create(nome=f'Paciente {i}-{j}', cpf=f'7000000{i}{j}00'),
+                    terapeuta=terapeuta, dia_semana=(hoje.weekday() + j) % 6,
+                    hora_inicio=time(9 + j, 0), hora_fim=time(9 + j, 45), data_inicio=hoje,
+                )
+        linhas = lambda: sorted(Agendamento.objects.values_list('agenda_fixa_id', 'paciente_id', 'terapeuta_id', 'data', 'hora_inicio'))
+
+        call_command('materializar_agenda', '--dias', '14', stdout=StringIO())
+        serial = linhas()
+        Agendamento.objects.all().delete()
+        AgendaFixa.objects.update(materializado_ate=None)
+
+        saida = StringIO()
+        call_command('materializar_agenda', '--dias', '14', '--workers', '2', stdout=saida)
+        self.assertIn('2 processo(s)', saida.getvalue())
+        self.assertGreater(len(serial), 0)
+        self.assertEqual(linhas(), serial)
+
+
+class FilaMaterializacaoTest(TestCase):
+    def setUp(self):
+        terapeuta = Terapeuta.objects.create(nome='Dra. Fila')
+        paciente = Paciente.objects.create(nome='Paciente Fila', cpf='12312312312')
+        self.grade = AgendaFixa.objects.create(
+            paciente=paciente, terapeuta=terapeuta,
+            dia_semana=timezone.localdate().weekday(), hora_inicio=time(10, 0), hora_fim=time(10, 45)
+        )
+
+    def test_tarefa_deduplicada_e_executada(self):
+        tarefa = enfileirar_materializacao(self.grade)
+        self.assertEqual(enfileirar_materializacao(self.grade), tarefa)
+
+        reservada = reservar_proxima_tarefa()
+        self.assertEqual(reservada, tarefa)
+        self.assertIsNone(reservar_proxima_tarefa())
+
+        executar_tarefa(reservada)
+        self.assertEqual(reservada.status, 'CONCLUIDA')
+        self.assertEqual(reservada.progresso, 100)
+        self.assertEqual(reservada.resultado, Agendamento.objects.filter(agenda_fixa=self.grade).count())
+        self.assertGreater(reservada.resultado, 0)
+
+        # Depois de iniciada, uma nova edição gera outra tarefa
+        self.assertNotEqual(enfileirar_materializacao(self.grade), tarefa)
+
+    def test_tarefa_abandonada_volta_para_a_fila(self):
+        from django.db import IntegrityError, transaction
+        from .models import TarefaMaterializacao
+
+        tarefa = enfileirar_materializacao(self.grade)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            TarefaMaterializacao.objects.create(agenda_fixa=self.grade)  # o banco barra a pendente duplicada
+
+        self.assertEqual(reservar_proxima_tarefa(), tarefa)
+        self.assertIsNone(reservar_proxima_tarefa())
+        # Worker morreu: passado o tempo limite a tarefa é reservada de novo
+        TarefaMaterializacao.objects.filter(pk=tarefa.pk).update(iniciado_em=timezone.now() - timedelta(hours=2))
+        self.assertEqual(reservar_proxima_tarefa(), tarefa)
+
+
+class OcorrenciasVirtuaisTest(TestCase):
+    def setUp(self):
+        self.terapeuta = Terapeuta.objects.create(nome='Dra. Virtual')
+        self.paciente = Paciente.objects.create(nome='Paciente Virtual', cpf='32132132132')
+        self.hoje = timezone.localdate()
+        self.grade = AgendaFixa.objects.create(
+            paciente=self.paciente, terapeuta=self.terapeuta,
+            dia_semana=self.hoje.weekday(), hora_inicio=time(8, 0), hora_fim=time(8, 45),
+            data_inicio=self.hoje, materializado_ate=self.hoje + timedelta(days=7)
+        )
+
+    def test_projecao_respeita_linhas_gravadas(self):
+        inicio, fim = self.hoje, self.hoje + timedelta(days=27)
+        datas = [o.data for o in projetar_ocorrencias(inicio, fim)]
+        # Só o que está depois da marca d'água é projetado
+        self.assertEqual(datas, [self.hoje + timedelta(days=14), self.hoje + timedelta(days=21)])
+        self.assertFalse(Agendamento.objects.exists())
+
+        tocado = materializar_ocorrencia(self.grade, self.hoje + timedelta(days=14))
+        tocado.status = 'FALTA'
+        tocado.save()
+        datas = [o.data for o in projetar_ocorrencias(inicio, fim)]
+        self.assertEqual(datas, [self.hoje + timedelta(days=21)])
+
+        # A materialização rotineira não duplica a sessão já tocada
+        gerar_agenda_futura(dias_a_frente=27)
+        self.assertEqual(Agendamento.objects.filter(agenda_fixa=self.grade, data=tocado.data).count(), 1)
+
+    def test_datas_passadas_depois_da_marca_dagua(self):
+        # Worker parado há duas semanas: a sessão de 7 dias atrás nunca foi gravada
+        self.grade.data_inicio = self.hoje - timedelta(days=21)
+        self.grade.materializado_ate = self.hoje - timedelta(days=14)
+        self.grade.save()
+        passada = self.hoje - timedelta(days=7)
+        self.assertEqual([o.data for o in projetar_ocorrencias(passada, self.hoje)], [passada, self.hoje])
+
+        gerar_agenda_futura(agenda_especifica=self.grade)
+        self.assertTrue(Agendamento.objects.filter(agenda_fixa=self.grade, data=passada, status='AGUARDANDO').exists())
+
+        # Antes da marca d'água não há sessão a abrir: a mensagem diz isso, não "ocupado"
+        self.client.force_login(User.objects.create_superuser('passado', password='x'))
+        resposta = self.client.post(f'/agendamentos/ocorrencia/{self.grade.id}/{self.hoje - timedelta(days=14)}/', follow=True)
+        self.assertContains(resposta, 'já passou')
+        self.assertFalse(Agendamento.objects.filter(data=self.hoje - timedelta(days=14)).exists())
+
+    def test_limpar_dia_remove_sessoes_projetadas(self):
+        data = self.hoje + timedelta(days=21)
+        self.client.force_login(User.objects.create_superuser('limpeza', password='x'))
+        self.client.post('/agendamentos/limpar-dia/', {'data_para_limpar': str(data), 'terapeuta_id': self.terapeuta.id})
+
+        self.assertEqual(projetar_ocorrencias(data, data), [])
+        self.assertTrue(Agendamento.objects.filter(agenda_fixa=self.grade, data=data, deletado=True).exists())
+        self.assertEqual([o.data for o in projetar_ocorrencias(data, data + timedelta(days=7))], [data + timedelta(days=7)])
+
+    def test_sessao_movida_nao_volta_a_ser_projetada(self):
+        data = self.hoje + timedelta(days=14)
+        movida = materializar_ocorrencia(self.grade, data)
+        movida.hora_inicio, movida.hora_fim = time(14, 0), time(14, 45)
+        movida.save()
+
+        self.assertEqual(projetar_ocorrencias(data, data), [])
+        gerar_agenda_futura(dias_a_frente=14)
+        self.assertEqual(list(Agendamento.objects.filter(agenda_fixa=self.grade, data=data).values_list('id', flat=True)), [movida.id])
+
+    def test_sessao_projetada_conta_como_conflito(self):
+        from .forms import AgendamentoForm, avisos_sala
+
+        sala = Sala.objects.create(nome='Sala Virtual')
+        AgendaFixa.objects.filter(pk=self.grade.pk).update(sala=sala)
+        outro = Paciente.objects.create(nome='Outro Paciente', cpf='45645645645')
+        data = self.hoje + timedelta(days=28)
+        form = AgendamentoForm(data={
+            'paciente': outro.id, 'terapeuta': self.terapeuta.id, 'sala': sala.id,
+            'data': str(data), 'hora_inicio': '08:00', 'hora_fim': '08:45',
+        })
+        self.assertFalse(form.is_valid())
+        self.assertIn('Conflito!', str(form.errors))
+
+        dados = {'paciente': outro, 'terapeuta': self.terapeuta, 'data': data, 'hora_inicio': time(8, 0), 'hora_fim': time(8, 45)}
+        self.assertEqual(criar_agendamentos_em_lote(dados, None), (0, [data.strftime('%d/%m')]))
+        self.assertEqual(len(avisos_sala(sala, outro, [data], time(8, 15), time(9, 0))), 1)
+
+        # Abrir a sessão projetada: GET não grava, POST materializa
+        self.client.force_login(User.objects.create_superuser('virtual', password='x'))
+        url = f'/agendamentos/ocorrencia/{self.grade.id}/{data}/?acao=falta'
+        self.client.get(url)
+        self.assertFalse(Agendamento.objects.exists())
+        resposta = self.client.post(url)
+        agendamento = Agendamento.objects.get(agenda_fixa=self.grade, data=data)
+        self.assertRedirects(resposta, f'/agendamentos/falta/{agendamento.id}/', fetch_redirect_response=False)
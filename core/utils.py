@@ -1,7 +1,16 @@
 from django.contrib.auth.models import Group
+from django.conf import settings
 from django.utils import timezone
-from datetime import timedelta, datetime, date
+from datetime import timedelta, datetime
 from django.db.models import Q
+from django.db import IntegrityError, transaction
+from django.core.cache import cache
+from collections import defaultdict
+from functools import lru_cache
+import hashlib
+import uuid
+
+from . import cache_agenda
 
 def make_datetime_aware(data, hora):
     dt_naive = datetime.combine(data, hora)
@@ -9,6 +18,11 @@ def make_datetime_aware(data, hora):
 
 def get_horarios_clinica():
     """Gera a lista de horários de 45min com intervalo de almoço"""
+    return list(horarios_clinica())
+
+@lru_cache(maxsize=None)
+def horarios_clinica():
+    """Mesmos horários, calculados uma vez por processo (tupla, não mexer)."""
     horarios = []
     
     # Manhã: Início 7:15 até 11:45 (7 slots) -> Fim 12:30
@@ -21,98 +35,532 @@ def get_horarios_clinica():
     for i in range(8):
         horarios.append((inicio_tarde + timedelta(minutes=45*i)).time())
         
-    return horarios
+    return tuple(horarios)
+
+BATCH_SIZE = 500
+
+def _inicio_vigencia(grade):
+    # O default (timezone.now) é um datetime até a grade ser recarregada do banco
+    if isinstance(grade.data_inicio, datetime):
+        return timezone.localdate(grade.data_inicio)
+    return grade.data_inicio
+
+def _ocorrencias_grade(grade, inicio, limite):
+    """Datas da grade entre inicio e limite, andando de 7 em 7 dias."""
+    data_atual = max(_inicio_vigencia(grade), inicio)
+    data_atual += timedelta(days=(grade.dia_semana - data_atual.weekday()) % 7)
+    limite_grade = min(limite, grade.data_fim) if grade.data_fim else limite
+    while data_atual <= limite_grade:
+        yield data_atual
+        data_atual += timedelta(days=7)
+
+def _primeiro_sobreposto(itens, hora_inicio, hora_fim):
+    # Mesma regra do filtro hora_inicio__lt / hora_fim__gt + .first() (ordenado por hora_inicio)
+    candidatos = [
+        a for a in itens
+        if a.hora_fim is not None and a.hora_inicio < hora_fim and a.hora_fim > hora_inicio
+    ]
+    if not candidatos: return None
+    return min(candidatos, key=lambda a: (a.hora_inicio, a.pk is None, a.pk or 0))
+
+def _novo_agendamento(grade, data):
+    from .models import Agendamento
+    return Agendamento(
+        agenda_fixa=grade,
+        paciente=grade.paciente,
+        terapeuta=grade.terapeuta,
+        modalidade=grade.modalidade,
+        sala=grade.sala,
+        data=data,
+        hora_inicio=grade.hora_inicio,
+        hora_fim=grade.hora_fim,
+        tipo_atendimento=grade.paciente.tipo_padrao,
+        status='AGUARDANDO'
+    )
+
+def _indice_salas(grades, inicio, limite):
+    """(sala_id, data) -> agendamentos ativos nas salas exclusivas das grades, num único SELECT."""
+    from .models import Agendamento
+
+    indice = defaultdict(list)
+    salas = {g.sala_id for g in grades if g.sala_id and not g.sala.compartilhada}
+    if not salas:
+        return indice
+    existentes = Agendamento.objects.ativos().filter(
+        sala_id__in=salas, data__range=[inicio, limite]
+    ).exclude(status='FALTA').select_related('paciente')
+    for ag in existentes:
+        indice[(ag.sala_id, ag.data)].append(ag)
+    return indice
+
+def _registrar_sala(plano, indice, grade, data, agendamento):
+    """Confere a sala da sessão no índice e passa a contá-la como ocupante."""
+    if not grade.sala_id or grade.sala.compartilhada:
+        return
+    ocupantes = indice[(grade.sala_id, data)]
+    # Linhas da própria grade (inclusive a que está sendo movida) e do mesmo paciente não são conflito
+    outros = [
+        a for a in ocupantes
+        if a is not agendamento and a.paciente_id != grade.paciente_id
+        and not (grade.pk and a.agenda_fixa_id == grade.pk)
+    ]
+    conflito = _primeiro_sobreposto(outros, grade.hora_inicio, grade.hora_fim)
+    if conflito:
+        plano.conflitos_sala.append((grade, data, conflito))
+    ocupantes.append(agendamento)
+
+def horizonte_agenda(hoje=None):
+    """Data limite da janela rolante de materialização (settings.AGENDA_HORIZONTE_SEMANAS)."""
+    hoje = hoje or timezone.localdate()
+    return hoje + timedelta(weeks=settings.AGENDA_HORIZONTE_SEMANAS)
 
-def gerar_agenda_futura(dias_a_frente=None, agenda_especifica=None):
+class PlanoMaterializacao:
+    """Resultado da simulação de gerar_agenda_futura: nada é gravado até aplicar_plano()."""
+
+    CAMPOS_ATUALIZAVEIS = ['agenda_fixa', 'paciente', 'terapeuta', 'data', 'sala', 'modalidade', 'hora_inicio', 'hora_fim']
+
+    def __init__(self, hoje, limite):
+        self.hoje = hoje
+        self.limite = limite
+        self.criar = []        # Agendamentos novos (ainda não salvos)
+        self.atualizar = {}    # id(agendamento) -> (agendamento, {campo: valor_anterior})
+        self.pulos = []        # (grade, data, agendamento de outro paciente no horário)
+        self.remover = []      # Agendamentos da grade que deixaram de fazer parte dela
+        self.conflitos_sala = []  # (grade, data, agendamento de outro paciente na mesma sala) — só aviso
+        self.grades = []       # Grades cuja marca d'água avança até `limite`
+        self.total = 0         # Mesma contagem devolvida por gerar_agenda_futura
+
+    @property
+    def atualizacoes(self):
+        return list(self.atualizar.values())
+
+    def registrar_alteracao(self, agendamento, campo, valor):
+        _, anteriores = self.atualizar.setdefault(id(agendamento), (agendamento, {}))
+        anteriores.setdefault(campo, getattr(agendamento, campo))
+        setattr(agendamento, campo, valor)
+
+    def absorver(self, agendamento, grade):
+        """Reaproveita um agendamento AGUARDANDO do mesmo paciente no horário da grade."""
+        mudou = False
+
+        if agendamento.agenda_fixa_id != grade.id or (grade.pk is None and agendamento.agenda_fixa is not grade):
+            self.registrar_alteracao(agendamento, 'agenda_fixa', grade)
+            mudou = True
+
+        if agendamento.sala_id != grade.sala_id:
+            self.registrar_alteracao(agendamento, 'sala', grade.sala)
+            mudou = True
+
+        if agendamento.modalidade != grade.modalidade:
+            self.registrar_alteracao(agendamento, 'modalidade', grade.modalidade)
+            mudou = True
+
+        if agendamento.hora_inicio != grade.hora_inicio:
+            self.registrar_alteracao(agendamento, 'hora_inicio', grade.hora_inicio)
+            self.registrar_alteracao(agendamento, 'hora_fim', grade.hora_fim)
+            mudou = True
+
+        if mudou:
+            self.total += 1
+        return mudou
+
+    def vincular(self, grade):
+        """Aponta o plano de uma grade ainda não salva para a instância gravada."""
+        for ag in self.criar:
+            ag.agenda_fixa = grade
+        for ag, _ in self.atualizacoes:
+            ag.agenda_fixa = grade
+        if self.grades:
+            self.grades = [grade]
+
+def planejar_agenda_futura(dias_a_frente=None, agenda_especifica=None, progresso=None, terapeutas=None, janela=None):
+    """Calcula, em uma única passada em memória, o que gerar_agenda_futura faria.
+    `terapeutas` restringe as grades a uma lista de ids (conflitos nunca cruzam terapeutas).
+    `janela` (inicio, fim) limita o cálculo a um intervalo de datas sem mexer na marca d'água."""
     from .models import Agendamento, AgendaFixa
     
-    hoje = timezone.now().date()
+    hoje = timezone.localdate()
     
-    # Se não definir dias, o padrão agora é até o FIM DO ANO CORRENTE
-    if dias_a_frente:
+    # Se não definir dias, usa a janela rolante configurada no settings
+    if janela:
+        limite = janela[1]
+    elif dias_a_frente:
         limite = hoje + timedelta(days=dias_a_frente)
     else:
-        # Vai até 31/12 do ano atual
-        limite = date(hoje.year, 12, 31)
+        limite = horizonte_agenda(hoje)
     
     if agenda_especifica:
         grades = [agenda_especifica]
     else:
-        grades = AgendaFixa.objects.filter(ativo=True)
-    
-    total_criados = 0
-    
+        grades = AgendaFixa.objects.filter(ativo=True).select_related('paciente', 'terapeuta', 'sala')
+        if terapeutas is not None:
+            grades = grades.filter(terapeuta_id__in=terapeutas)
+        grades = list(grades)
+
+    plano = PlanoMaterializacao(hoje, limite)
+
+    # Marca d'água: cada grade só gera o que ainda não foi coberto em execuções anteriores
+    grades_por_terapeuta = defaultdict(list)
     for grade in grades:
-        data_atual = max(grade.data_inicio, hoje)
-        limite_grade = limite
-        
-        # Se a grade tiver uma data fim específica menor que o fim do ano, respeita a grade
-        if grade.data_fim:
-            limite_grade = min(limite, grade.data_fim)
-            
-        while data_atual <= limite_grade:
-            if data_atual.weekday() == grade.dia_semana:
-                
+        # Marca d'água no passado (worker parado): as datas que ficaram para trás ainda são da
+        # grade, geradas/projetadas para chegarem à agenda e ao relatório de atrasos
+        inicio = grade.materializado_ate + timedelta(days=1) if grade.materializado_ate else hoje
+        if janela:
+            inicio = max(inicio, janela[0])
+        if inicio > limite:
+            continue
+        if not janela:
+            plano.grades.append(grade)
+        grades_por_terapeuta[grade.terapeuta_id].append((grade, inicio))
+
+    processadas = len(grades) - sum(len(g) for g in grades_por_terapeuta.values())
+
+    # Ocupação das salas cruza terapeutas: um único SELECT para todas as grades do plano
+    # (projeções de tela, com `janela`, não precisam do aviso de sala)
+    planejadas = [item for itens in grades_por_terapeuta.values() for item in itens]
+    indice_salas = defaultdict(list) if janela else _indice_salas(
+        [g for g, _ in planejadas], min((inicio for _, inicio in planejadas), default=hoje), limite
+    )
+
+    # Projeções de tela (e os conflitos que as usam) leem as linhas de todos os terapeutas de uma vez:
+    # o número de consultas não cresce com a quantidade de terapeutas
+    linhas_janela = defaultdict(list)
+    if janela and planejadas:
+        for ag in Agendamento.objects.filter(
+            terapeuta_id__in=grades_por_terapeuta,
+            data__range=[min(max(_inicio_vigencia(g), inicio) for g, inicio in planejadas), limite]
+        ).select_related('paciente'):
+            linhas_janela[ag.terapeuta_id].append(ag)
+
+    for terapeuta_id, grades_terapeuta in grades_por_terapeuta.items():
+        inicio_min = min(max(_inicio_vigencia(g), inicio) for g, inicio in grades_terapeuta)
+
+        # Um único SELECT por terapeuta: tudo que existe no horizonte
+        ocupacao = defaultdict(list)
+        cobertos = set()
+        existentes = linhas_janela[terapeuta_id] if janela else Agendamento.objects.filter(
+            terapeuta_id=terapeuta_id,
+            data__range=[inicio_min, limite]
+        ).select_related('paciente')
+        for ag in existentes:
+            if ag.agenda_fixa_id:
+                # Sessão da grade já gravada naquela data (movida de horário, falta, atendimento,
+                # excluída): a linha prevalece e a data não é gerada nem projetada de novo
+                cobertos.add((ag.agenda_fixa_id, ag.data))
+            if not ag.deletado and ag.status == 'AGUARDANDO':
+                ocupacao[ag.data].append(ag)
+
+        for grade, inicio in grades_terapeuta:
+            for data_atual in _ocorrencias_grade(grade, inicio, limite):
+                if (grade.id, data_atual) in cobertos:
+                    continue
+
                 # --- LÓGICA DE ABSORÇÃO ---
                 # Verifica se já existe algo ocupando este horário 'AGUARDANDO'
-                conflito_ou_existente = Agendamento.objects.ativos().filter(
-                    terapeuta=grade.terapeuta,
-                    data=data_atual,
-                    status='AGUARDANDO'
-                ).filter(
-                    hora_inicio__lt=grade.hora_fim,
-                    hora_fim__gt=grade.hora_inicio
-                ).first()
+                conflito_ou_existente = _primeiro_sobreposto(
+                    ocupacao[data_atual], grade.hora_inicio, grade.hora_fim
+                )
 
                 if conflito_ou_existente:
                     # 1. É do MESMO paciente? -> REAPROVEITAR (Absorver e Atualizar)
-                    if conflito_ou_existente.paciente == grade.paciente:
-                        mudou = False
-                        
-                        if conflito_ou_existente.agenda_fixa != grade:
-                            conflito_ou_existente.agenda_fixa = grade
-                            mudou = True
-                        
-                        if conflito_ou_existente.sala != grade.sala:
-                            conflito_ou_existente.sala = grade.sala
-                            mudou = True
-                            
-                        # --- ATUALIZADO: Verifica e atualiza a Modalidade ---
-                        if conflito_ou_existente.modalidade != grade.modalidade:
-                            conflito_ou_existente.modalidade = grade.modalidade
-                            mudou = True
-                        # ----------------------------------------------------
-                            
-                        if conflito_ou_existente.hora_inicio != grade.hora_inicio:
-                            conflito_ou_existente.hora_inicio = grade.hora_inicio
-                            conflito_ou_existente.hora_fim = grade.hora_fim
-                            mudou = True
-
-                        if mudou:
-                            conflito_ou_existente.save()
-                            total_criados += 1
-                    
+                    if conflito_ou_existente.paciente_id == grade.paciente_id:
+                        plano.absorver(conflito_ou_existente, grade)
+                        _registrar_sala(plano, indice_salas, grade, data_atual, conflito_ou_existente)
+
                     # 2. Se for de OUTRO paciente -> Conflito Real -> Pula
-                
+                    else:
+                        plano.pulos.append((grade, data_atual, conflito_ou_existente))
+
                 else:
                     # Se NÃO existe nada no horário -> Cria Novo
-                    Agendamento.objects.create(
-                        agenda_fixa=grade,
-                        paciente=grade.paciente,
-                        terapeuta=grade.terapeuta,
-                        modalidade=grade.modalidade, # --- NOVO: Copia a modalidade ---
-                        sala=grade.sala,
-                        data=data_atual,
-                        hora_inicio=grade.hora_inicio,
-                        hora_fim=grade.hora_fim,
-                        tipo_atendimento=grade.paciente.tipo_padrao,
-                        status='AGUARDANDO'
-                    )
-                    total_criados += 1
-            
-            data_atual += timedelta(days=1)
-            
-    return total_criados
+                    novo = _novo_agendamento(grade, data_atual)
+                    plano.criar.append(novo)
+                    ocupacao[data_atual].append(novo)
+                    _registrar_sala(plano, indice_salas, grade, data_atual, novo)
+                    plano.total += 1
+
+        processadas += len(grades_terapeuta)
+        if progresso: progresso(processadas, len(grades))
+
+    return plano
+
+def planejar_ressincronizacao(grade):
+    """Plano para alinhar os agendamentos futuros de uma grade editada com os novos dados.
+    Em vez de apagar e gerar tudo de novo, compara as ocorrências desejadas com as linhas que já
+    existem: reaproveita (move) as linhas da grade, cria só as que faltam e remove as que sobram.
+    Assim os ids dos agendamentos continuam os mesmos."""
+    from .models import Agendamento
+
+    hoje = timezone.localdate()
+    proprios = list(
+        Agendamento.objects.ativos().filter(agenda_fixa_id=grade.pk, status='AGUARDANDO', data__gte=hoje)
+        .select_related('paciente', 'terapeuta', 'sala').order_by('data', 'hora_inicio', 'id')
+    )
+
+    limite = horizonte_agenda(hoje)
+    if grade.materializado_ate and grade.materializado_ate > limite:
+        limite = grade.materializado_ate
+    # Sessões abertas além do horizonte (abrir_ocorrencia) também entram: vão para a nova data
+    # da mesma semana em vez de sobrar e ser apagadas junto com a Consulta
+    if proprios and proprios[-1].data > limite:
+        limite = proprios[-1].data + timedelta(days=6)
+
+    plano = PlanoMaterializacao(hoje, limite)
+    if not grade.ativo:
+        return plano
+    plano.grades.append(grade)
+
+    ocupacao = defaultdict(list)
+    cobertos = set()
+    existentes = Agendamento.objects.filter(
+        terapeuta_id=grade.terapeuta_id, data__range=[hoje, limite]
+    ).exclude(agenda_fixa_id=grade.pk, status='AGUARDANDO', deletado=False).select_related('paciente')
+    for ag in existentes:
+        if not ag.deletado and ag.status == 'AGUARDANDO':
+            ocupacao[ag.data].append(ag)
+        elif ag.agenda_fixa_id == grade.pk:
+            cobertos.add(ag.data)
+
+    datas = [d for d in _ocorrencias_grade(grade, hoje, limite) if d not in cobertos]
+    indice_salas = _indice_salas([grade], hoje, limite)
+
+    # Linhas já na data certa ficam nela; as demais (troca de dia, fim de vigência) viram sobras
+    por_data = {}
+    sobras = []
+    alvo = set(datas)
+    for ag in proprios:
+        if ag.data in alvo and ag.data not in por_data:
+            por_data[ag.data] = ag
+        else:
+            sobras.append(ag)
+
+    for data_atual in datas:
+        linha = por_data.pop(data_atual, None)
+        conflito = _primeiro_sobreposto(ocupacao[data_atual], grade.hora_inicio, grade.hora_fim)
+
+        if conflito and conflito.paciente_id == grade.paciente_id:
+            plano.absorver(conflito, grade)
+            _registrar_sala(plano, indice_salas, grade, data_atual, conflito)
+            if linha: sobras.append(linha)
+            continue
+        if conflito:
+            plano.pulos.append((grade, data_atual, conflito))
+            if linha: sobras.append(linha)
+            continue
+
+        if linha is None and sobras:
+            linha = sobras.pop(0)
+        if linha is None:
+            novo = _novo_agendamento(grade, data_atual)
+            plano.criar.append(novo)
+            ocupacao[data_atual].append(novo)
+            _registrar_sala(plano, indice_salas, grade, data_atual, novo)
+            plano.total += 1
+            continue
+
+        mudou = False
+        for campo, valor in (('agenda_fixa', grade), ('paciente', grade.paciente), ('terapeuta', grade.terapeuta), ('sala', grade.sala)):
+            if getattr(linha, f'{campo}_id') != getattr(valor, 'pk', None):
+                plano.registrar_alteracao(linha, campo, valor)
+                mudou = True
+        for campo, valor in (('data', data_atual), ('modalidade', grade.modalidade), ('hora_inicio', grade.hora_inicio), ('hora_fim', grade.hora_fim)):
+            if getattr(linha, campo) != valor:
+                plano.registrar_alteracao(linha, campo, valor)
+                mudou = True
+        if mudou:
+            plano.total += 1
+        ocupacao[data_atual].append(linha)
+        _registrar_sala(plano, indice_salas, grade, data_atual, linha)
+
+    plano.remover = sobras
+    return plano
+
+def aplicar_plano(plano):
+    from .models import Agendamento, AgendaFixa
+
+    with transaction.atomic():
+        if plano.remover:
+            Agendamento.objects.filter(id__in=[ag.id for ag in plano.remover]).delete()
+        if plano.criar:
+            Agendamento.objects.bulk_create(plano.criar, batch_size=BATCH_SIZE)
+        # Agendamentos criados neste mesmo plano já foram gravados com os valores finais
+        novos = {id(ag) for ag in plano.criar}
+        alterados = [(ag, anteriores) for ag, anteriores in plano.atualizacoes if id(ag) not in novos]
+        if alterados:
+            campos = [c for c in PlanoMaterializacao.CAMPOS_ATUALIZAVEIS if any(c in anteriores for _, anteriores in alterados)]
+            Agendamento.objects.bulk_update([ag for ag, _ in alterados], campos, batch_size=BATCH_SIZE)
+        for grade in plano.grades:
+            grade.materializado_ate = plano.limite
+        if plano.grades:
+            AgendaFixa.objects.bulk_update(plano.grades, ['materializado_ate'], batch_size=BATCH_SIZE)
+
+        # bulk_create/bulk_update não disparam signals
+        cache_agenda.invalidar_datas(
+            [ag.data for ag in plano.criar] + [ag.data for ag, _ in alterados]
+            + [anteriores['data'] for _, anteriores in alterados if 'data' in anteriores]
+        )
+        if plano.grades:
+            # A marca d'água andou: sessões projetadas viraram linhas ou deixaram de aparecer
+            cache_agenda.invalidar_tudo()
+
+    return plano.total
+
+def gerar_agenda_futura(dias_a_frente=None, agenda_especifica=None, progresso=None, terapeutas=None):
+    plano = planejar_agenda_futura(dias_a_frente, agenda_especifica, progresso, terapeutas)
+    return aplicar_plano(plano)
+
+def ressincronizar_agenda_fixa(grade):
+    """Aplica na hora o plano de ressincronização de uma grade editada (uma única transação)."""
+    plano = planejar_ressincronizacao(grade)
+    aplicar_plano(plano)
+    return plano
+
+def projetar_ocorrencias(data_inicio, data_fim, terapeutas=None):
+    """Sessões da grade fixa ainda não materializadas no intervalo, calculadas na hora.
+    Devolve Agendamentos não salvos (marcados com `virtual = True`); o que existe no banco prevalece."""
+    if not settings.AGENDA_OCORRENCIAS_VIRTUAIS:
+        return []
+    plano = planejar_agenda_futura(terapeutas=terapeutas, janela=(data_inicio, data_fim))
+    for ag in plano.criar:
+        ag.virtual = True
+    return plano.criar
+
+def materializar_ocorrencia(grade, data):
+    """Grava a sessão da grade naquela data (quando alguém interage com uma ocorrência virtual).
+    Devolve o Agendamento ou None se o horário estiver ocupado por outro paciente."""
+    from .models import Agendamento
+
+    existente = Agendamento.objects.ativos().filter(agenda_fixa=grade, data=data).first()
+    if existente:
+        return existente
+
+    plano = planejar_agenda_futura(agenda_especifica=grade, janela=(data, data))
+    if plano.pulos:
+        return None
+    aplicar_plano(plano)
+    if plano.criar:
+        return plano.criar[0]
+    return Agendamento.objects.ativos().filter(agenda_fixa=grade, data=data).first()
+
+PLANO_CACHE_TTL = 300
+
+CAMPOS_VERSAO = ('id', 'data', 'hora_inicio', 'hora_fim', 'status', 'sala_id', 'deletado', 'terapeuta_id', 'paciente_id', 'agenda_fixa_id', 'modalidade')
+
+def _versao_ocupacao(plano):
+    """Hash das linhas que o plano leu (terapeutas e salas envolvidos, na janela do plano). Qualquer
+    mudança nelas — mover, trocar horário ou sala, cancelar e restaurar — invalida o plano guardado."""
+    from .models import Agendamento
+
+    terapeutas = {g.terapeuta_id for g in plano.grades}
+    # Linhas que o plano move ou remove podem estar com outro terapeuta
+    terapeutas.update(ag.terapeuta_id for ag in plano.remover)
+    terapeutas.update(anteriores['terapeuta'].pk if 'terapeuta' in anteriores else ag.terapeuta_id for ag, anteriores in plano.atualizacoes)
+    salas = {g.sala_id for g in plano.grades if g.sala_id}
+    linhas = Agendamento.objects.filter(
+        Q(terapeuta_id__in=terapeutas) | Q(sala_id__in=salas), data__range=[plano.hoje, plano.limite]
+    ).order_by('id').values_list(*CAMPOS_VERSAO)
+    resumo = hashlib.sha1()
+    for linha in linhas.iterator(chunk_size=BATCH_SIZE):
+        resumo.update(repr(linha).encode())
+    return resumo.hexdigest()
+
+def guardar_plano(plano, assinatura):
+    """Guarda o plano simulado para ser aplicado depois sem recalcular. Retorna o token."""
+    token = uuid.uuid4().hex
+    cache.set(f'plano_agenda:{token}', (assinatura, _versao_ocupacao(plano), plano), PLANO_CACHE_TTL)
+    return token
+
+def recuperar_plano(token, assinatura):
+    """Devolve o plano guardado se ainda corresponde ao formulário e à ocupação atual."""
+    if not token: return None
+    chave = f'plano_agenda:{token}'
+    guardado = cache.get(chave)
+    cache.delete(chave)
+    if not guardado: return None
+    assinatura_guardada, versao, plano = guardado
+    if assinatura_guardada != assinatura or plano.hoje != timezone.localdate():
+        return None
+    if _versao_ocupacao(plano) != versao:
+        return None
+    return plano
+
+def _pendente_equivalente(agenda):
+    from .models import TarefaMaterializacao
+
+    pendentes = TarefaMaterializacao.objects.filter(status='PENDENTE')
+    # Uma tarefa geral pendente já cobre qualquer grade específica
+    existente = pendentes.filter(agenda_fixa__isnull=True).first()
+    if not existente and agenda:
+        existente = pendentes.filter(agenda_fixa=agenda).first()
+    return existente
+
+def enfileirar_materializacao(agenda=None):
+    """Coloca a materialização na fila (processada por `manage.py processar_tarefas`).
+    Reaproveita uma tarefa pendente equivalente em vez de duplicar."""
+    from .models import TarefaMaterializacao
+
+    existente = _pendente_equivalente(agenda)
+    if existente:
+        return existente
+    try:
+        # A restrição tarefa_pendente_unica decide entre dois saves simultâneos: o segundo
+        # INSERT falha e reaproveita a tarefa que o primeiro acabou de criar
+        with transaction.atomic():
+            return TarefaMaterializacao.objects.create(agenda_fixa=agenda)
+    except IntegrityError:
+        return _pendente_equivalente(agenda)
+
+def liberar_tarefas_abandonadas():
+    """Devolve à fila as tarefas EXECUTANDO há mais de AGENDA_TAREFA_TEMPO_LIMITE minutos
+    (worker que morreu no meio). Se já existe outra pendente para a mesma grade, a abandonada
+    fica como ERRO. Retorna quantas foram liberadas."""
+    from .models import TarefaMaterializacao
+
+    limite = timezone.now() - timedelta(minutes=settings.AGENDA_TAREFA_TEMPO_LIMITE)
+    liberadas = 0
+    for tarefa in TarefaMaterializacao.objects.filter(status='EXECUTANDO', iniciado_em__lt=limite):
+        abandonada = TarefaMaterializacao.objects.filter(pk=tarefa.pk, status='EXECUTANDO', iniciado_em=tarefa.iniciado_em)
+        try:
+            with transaction.atomic():
+                liberadas += abandonada.update(status='PENDENTE', iniciado_em=None)
+        except IntegrityError:
+            abandonada.update(status='ERRO', erro='Tempo esgotado; outra tarefa pendente cobre a mesma grade.', concluido_em=timezone.now())
+    return liberadas
+
+def reservar_proxima_tarefa():
+    """Pega a tarefa pendente mais antiga, marcando-a como EXECUTANDO de forma atômica."""
+    from .models import TarefaMaterializacao
+
+    liberar_tarefas_abandonadas()
+    for tarefa in TarefaMaterializacao.objects.filter(status='PENDENTE').order_by('criado_em')[:10]:
+        reservada = TarefaMaterializacao.objects.filter(pk=tarefa.pk, status='PENDENTE').update(
+            status='EXECUTANDO', iniciado_em=timezone.now()
+        )
+        if reservada:
+            tarefa.refresh_from_db()
+            return tarefa
+    return None
+
+def executar_tarefa(tarefa):
+    from .models import TarefaMaterializacao
+
+    def registrar_progresso(processadas, total):
+        TarefaMaterializacao.objects.filter(pk=tarefa.pk).update(processados=processadas, total=total)
+
+    try:
+        agenda = tarefa.agenda_fixa
+        if agenda and not agenda.ativo:
+            tarefa.resultado = 0
+        else:
+            tarefa.resultado = gerar_agenda_futura(agenda_especifica=agenda, progresso=registrar_progresso)
+        tarefa.status = 'CONCLUIDA'
+    except Exception as e:
+        tarefa.status = 'ERRO'
+        tarefa.erro = str(e)
+    tarefa.refresh_from_db(fields=['processados', 'total'])
+    tarefa.concluido_em = timezone.now()
+    tarefa.save()
+    return tarefa
 
 def criar_agendamentos_em_lote(form_data, user_request):
     from .models import Agendamento
@@ -130,33 +578,38 @@ def criar_agendamentos_em_lote(form_data, user_request):
     
     tipo = paciente.tipo_padrao
 
-    criados = 0
+    if not hora_fim:
+        # Mesmo padrão de Agendamento.save(), que o bulk_create não chama
+        hora_fim = (datetime.combine(data_base, hora_inicio) + timedelta(minutes=45)).time()
+
+    datas = [data_base + timedelta(weeks=i) for i in range(0, repeticoes + 1)]
+
+    # Um único SELECT traz tudo do terapeuta nas datas pedidas; o resto é decidido em memória
+    por_data = defaultdict(list)
+    for ag in Agendamento.objects.ativos().filter(terapeuta=terapeuta, data__in=datas).only('id', 'data', 'status', 'hora_inicio', 'hora_fim'):
+        por_data[ag.data].append(ag)
+    # Sessões da grade ainda não gravadas ocupam o horário como as gravadas
+    for ag in projetar_ocorrencias(datas[0], datas[-1], [terapeuta.pk]):
+        por_data[ag.data].append(ag)
+
+    novos = []
+    sobras_falta = []
     conflitos = []
-    
-    for i in range(0, repeticoes + 1):
-        nova_data = data_base + timedelta(weeks=i)
-        
-        # Verifica conflito apenas com agendamentos ativos
-        tem_conflito = Agendamento.verificar_conflito(
-            terapeuta=terapeuta,
-            data=nova_data,
-            hora_inicio=hora_inicio,
-            hora_fim=hora_fim
-        )
 
-        if tem_conflito:
+    for nova_data in datas:
+        # Mesma regra de Agendamento.verificar_conflito: faltas não bloqueiam o horário
+        sobrepostos = [
+            ag for ag in por_data[nova_data]
+            if ag.hora_fim is not None and ag.hora_inicio < hora_fim and ag.hora_fim > hora_inicio
+        ]
+
+        if any(ag.status != 'FALTA' for ag in sobrepostos):
             conflitos.append(nova_data.strftime('%d/%m'))
         else:
             # Remove "sobras" de faltas deletadas ou agendamentos deletados
-            Agendamento.objects.ativos().filter(
-                terapeuta=terapeuta,
-                data=nova_data,
-                status='FALTA',
-                hora_inicio__lt=hora_fim,
-                hora_fim__gt=hora_inicio
-            ).update(deletado=True)
+            sobras_falta.extend(ag.id for ag in sobrepostos)
 
-            Agendamento.objects.create(
+            novos.append(Agendamento(
                 paciente=paciente,
                 terapeuta=terapeuta,
                 sala=sala,
@@ -166,10 +619,16 @@ def criar_agendamentos_em_lote(form_data, user_request):
                 hora_fim=hora_fim,
                 status='AGUARDANDO',
                 tipo_atendimento=tipo
-            )
-            criados += 1
+            ))
+
+    with transaction.atomic():
+        if sobras_falta:
+            Agendamento.objects.filter(id__in=sobras_falta).update(deletado=True)
+        if novos:
+            Agendamento.objects.bulk_create(novos, batch_size=BATCH_SIZE)
+        cache_agenda.invalidar_datas(ag.data for ag in novos)
             
-    return criados, conflitos
+    return len(novos), conflitos
 
 def setup_grupos():
     Group.objects.get_or_create(name='Administrativo')
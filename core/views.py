@@ -1,20 +1,29 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.utils import timezone
 from datetime import timedelta, datetime
-from django.db.models import Count, Q, F, Case, When, FloatField
+from django.db.models import Count, Q, F, Case, When, FloatField, IntegerField
 from django.db import transaction
+from django.core.cache import cache
+from django.template.loader import get_template, render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django import forms
 from django.contrib.auth.models import Group
 import calendar
 from collections import defaultdict
-import unicodedata
+import asyncio
+import json
+from urllib.parse import urlencode
+from asgiref.sync import sync_to_async
+from django.conf import settings
 
 from .models import (
     Paciente, Terapeuta, Agendamento, Consulta, AnexoConsulta, 
     TIPO_ATENDIMENTO_CHOICES, ESPECIALIDADES_CHOICES,
-    AgendaFixa, Sala, BloqueioFixo
+    AgendaFixa, Sala, BloqueioFixo, TarefaMaterializacao
 )
 
 from .forms import (
@@ -23,21 +32,33 @@ from .forms import (
 )
 
 from .decorators import admin_required, terapeuta_required, dono_required, is_admin, is_terapeuta, is_dono
-from .utils import setup_grupos, criar_agendamentos_em_lote, gerar_agenda_futura, get_horarios_clinica
+from . import alteracoes, cache_agenda, calendario
+from .bloqueios import bloqueios_do_dia, projecao_semanal
+from .busca import buscar as buscar_no_indice, filtrar as filtrar_pacientes
+from .busca_prontuarios import buscar as buscar_evolucoes
+from .grade import Grade, ItemAgenda
+from .normalizacao import chave_busca
+from .ocupacao import MapaOcupacao, SALA, buscar_horarios_livres
+from .utils import (
+    setup_grupos, criar_agendamentos_em_lote, enfileirar_materializacao,
+    planejar_agenda_futura, planejar_ressincronizacao, aplicar_plano, guardar_plano, recuperar_plano,
+    projetar_ocorrencias, materializar_ocorrencia
+)
 from django.urls import reverse
 
-def remover_acentos(texto):
-    if not texto: return ""
-    return ''.join(c for c in unicodedata.normalize('NFD', texto) if unicodedata.category(c) != 'Mn')
+def ocorrencias_virtuais(request, data_inicio, data_fim, filtro_terapeuta=None):
+    """Sessões projetadas da grade fixa visíveis para o usuário (mesmas regras dos agendamentos)."""
+    if is_admin(request.user):
+        terapeutas = [int(filtro_terapeuta)] if filtro_terapeuta and filtro_terapeuta != 'todos' else None
+    elif is_terapeuta(request.user):
+        terapeutas = [request.user.terapeuta.id]
+    else:
+        return []
 
-def encontrar_slot_visual(hora_real, horarios_grade):
-    if not horarios_grade: return hora_real.strftime('%H:%M')
-    slot_candidato = horarios_grade[0]
-    for h in horarios_grade:
-        if h > hora_real:
-            break
-        slot_candidato = h
-    return slot_candidato.strftime('%H:%M')
+    ocorrencias = projetar_ocorrencias(data_inicio, data_fim, terapeutas)
+    for item in ocorrencias:
+        item.url_ocorrencia = reverse('abrir_ocorrencia', args=[item.agenda_fixa_id, item.data.strftime('%Y-%m-%d')])
+    return ocorrencias
 
 @login_required
 def dashboard(request):
@@ -50,17 +71,69 @@ def dashboard(request):
         else:
             qs = Agendamento.objects.none()
 
+    virtuais = ocorrencias_virtuais(request, hoje, hoje)
+    if virtuais:
+        qs = sorted(list(qs) + virtuais, key=lambda a: a.hora_inicio)
+
     total_pacientes = Paciente.objects.filter(ativo=True).count()
-    total_agendamentos_hoje = qs.count()
+    total_agendamentos_hoje = len(qs) if virtuais else qs.count()
+
+    # Link da agenda para o celular (só para quem tem cadastro de terapeuta)
+    terapeuta = Terapeuta.objects.filter(usuario=request.user).first()
+    url_calendario = None
+    if terapeuta and terapeuta.token_calendario:
+        url_calendario = request.build_absolute_uri(reverse('calendario_terapeuta', args=[terapeuta.token_calendario]))
     
     return render(request, 'dashboard.html', {
         'agendamentos_hoje': qs,
         'total_pacientes': total_pacientes,
         'total_agendamentos_hoje': total_agendamentos_hoje,
         'is_admin': is_admin(request.user),
-        'agora': hoje
+        'agora': hoje,
+        'terapeuta': terapeuta,
+        'url_calendario': url_calendario,
     })
 
+@login_required
+def renovar_calendario(request):
+    """Gera (ou troca, invalidando o antigo) o link .ics do terapeuta logado."""
+    terapeuta = Terapeuta.objects.filter(usuario=request.user).first()
+    if request.method == 'POST' and terapeuta:
+        terapeuta.renovar_token_calendario()
+        messages.success(request, "Link da agenda gerado. Assine-o no aplicativo de calendário do celular.")
+    return redirect('dashboard')
+
+TEMPO_CALENDARIO = 60 * 60
+
+def calendario_terapeuta(request, token):
+    """Agenda do terapeuta em .ics (sem login: o token no link é o segredo).
+
+    Calendários consultam a cada poucos minutos; enquanto nenhuma data da janela muda, a resposta é 304
+    ou o arquivo guardado no cache, sem consulta de agendamentos. Gerado em streaming quando muda."""
+    terapeuta = get_object_or_404(Terapeuta, token_calendario=token)
+    hoje = timezone.localdate()
+    data_inicio, data_fim = calendario.janela(hoje)
+    datas = [data_inicio + timedelta(days=i) for i in range((data_fim - data_inicio).days + 1)]
+
+    versao, instante = cache_agenda.versao_periodo(datas, 'ics', terapeuta.id, hoje)
+    etag = f'"{versao}"'
+    resposta = get_conditional_response(request, etag=etag, last_modified=instante) if cache_agenda.habilitado() else None
+    if resposta is None:
+        chave = f'agenda:ics:{versao}'
+        corpo = cache.get(chave) if cache_agenda.habilitado() else None
+        if corpo is not None:
+            resposta = HttpResponse(corpo, content_type='text/calendar; charset=utf-8')
+        else:
+            pedacos = calendario.eventos_ics(terapeuta, data_inicio, data_fim)
+            if cache_agenda.habilitado():
+                pedacos = calendario.guardar_ao_final(pedacos, chave, TEMPO_CALENDARIO)
+            resposta = StreamingHttpResponse(pedacos, content_type='text/calendar; charset=utf-8')
+        resposta['Content-Disposition'] = 'inline; filename="agenda.ics"'
+
+    cache_agenda.marcar_versao(resposta, etag, instante)
+    patch_cache_control(resposta, private=True, no_cache=True)
+    return resposta
+
 @login_required
 def lista_pacientes(request):
     busca = request.GET.get('q')
@@ -79,14 +152,13 @@ def lista_pacientes(request):
             agendamento__terapeuta=request.user.terapeuta
         ).distinct()
 
-    if busca:
-        busca_limpa = remover_acentos(busca).lower()
-        pacientes = pacientes.filter(Q(nome_search__icontains=busca_limpa) | Q(cpf__icontains=busca))
-    
     if filtro_tipo:
         pacientes = pacientes.filter(tipo_padrao=filtro_tipo)
     
     pacientes = pacientes.order_by('nome')
+    if busca:
+        # Pelo índice de busca (core/busca.py): lista já na ordem de relevância
+        pacientes = filtrar_pacientes(pacientes, busca)
 
     return render(request, 'lista_pacientes.html', {
         'pacientes': pacientes,
@@ -97,6 +169,44 @@ def lista_pacientes(request):
         'busca_atual': busca
     })
 
+PACIENTES_POR_PAGINA = 20
+
+@login_required
+def buscar_pacientes(request):
+    """Autocomplete de pacientes ativos no formato do select2 (results/pagination), 20 por página.
+    Usa o índice de core/busca.py; sem ele, números buscam pelo início do CPF e texto pelo início
+    de qualquer palavra do nome (sem acento)."""
+    termo = request.GET.get('q', '').strip()
+    try:
+        pagina = max(int(request.GET.get('page') or 1), 1)
+    except ValueError:
+        pagina = 1
+
+    pacientes = Paciente.objects.filter(ativo=True)
+    inicio = (pagina - 1) * PACIENTES_POR_PAGINA
+    ids = buscar_no_indice(termo) if termo else None
+    if ids is not None:
+        # Índice de busca: ids na ordem de relevância; a página sai dos ativos entre eles
+        posicao = {id_: i for i, id_ in enumerate(ids)}
+        linhas = sorted(pacientes.filter(pk__in=ids).values_list('id', 'nome'), key=lambda linha: posicao[linha[0]])
+        linhas = linhas[inicio:inicio + PACIENTES_POR_PAGINA + 1]
+    else:
+        if termo.isdigit():
+            pacientes = pacientes.filter(cpf__startswith=termo).order_by('cpf')
+        elif termo:
+            termo = chave_busca(termo)
+            pacientes = pacientes.filter(Q(nome_search__startswith=termo) | Q(nome_search__contains=f' {termo}')).annotate(
+                # Quem começa com o termo vem antes de quem só tem uma palavra com ele
+                posicao=Case(When(nome_search__startswith=termo, then=0), default=1, output_field=IntegerField())
+            ).order_by('posicao', 'nome_search')
+        else:
+            pacientes = pacientes.order_by('nome_search')
+        linhas = list(pacientes.values_list('id', 'nome')[inicio:inicio + PACIENTES_POR_PAGINA + 1])
+    return JsonResponse({
+        'results': [{'id': id_, 'text': nome} for id_, nome in linhas[:PACIENTES_POR_PAGINA]],
+        'pagination': {'more': len(linhas) > PACIENTES_POR_PAGINA},
+    })
+
 @admin_required
 def cadastro_paciente(request):
     if request.method == 'POST':
@@ -162,123 +272,159 @@ def detalhe_paciente(request, paciente_id):
         'is_admin': is_admin(request.user)
     })
 
-@login_required
-def lista_agendamentos(request):
-    data_inicio_get = request.GET.get('data_inicio')
-    data_fim_get = request.GET.get('data_fim')
-    filtro_hoje = request.GET.get('filtro_hoje')
-    filtro_semana = request.GET.get('filtro_semana')
-    
-    agora = timezone.localtime(timezone.now())
-    hoje = agora.date()
-    
-    if filtro_hoje:
-        data_inicio, data_fim = hoje, hoje
-    elif data_inicio_get and data_fim_get:
-        data_inicio = datetime.strptime(data_inicio_get, '%Y-%m-%d').date()
-        data_fim = datetime.strptime(data_fim_get, '%Y-%m-%d').date()
-    else:
-        start_week = hoje - timedelta(days=hoje.weekday())
-        data_inicio, data_fim = start_week, start_week + timedelta(days=6)
-        filtro_semana = '1'
+FILTROS_ID = ('paciente', 'terapeuta', 'sala')
 
-    filtro_paciente = request.GET.get('filtro_paciente')
-    filtro_tipo = request.GET.get('filtro_tipo')
-    filtro_terapeuta = request.GET.get('filtro_terapeuta')
-    filtro_status = request.GET.get('filtro_status')
-    filtro_sala = request.GET.get('filtro_sala')
+def filtros_invalidos(filtros):
+    """Filtros de id vindos da URL que não são números ('todos' vale como sem filtro)."""
+    return [k for k in FILTROS_ID if filtros.get(k) and filtros[k] != 'todos' and not str(filtros[k]).isdigit()]
 
-    agendamentos = Agendamento.objects.ativos().select_related('paciente', 'terapeuta', 'sala', 'agenda_fixa').filter(
-        data__range=[data_inicio, data_fim]
-    ).order_by('data', 'hora_inicio')
+def itens_agenda(request, data_inicio, data_fim, filtros):
+    """Agendamentos e sessões projetadas visíveis para o usuário no período, já filtrados e em ordem,
+    mais os terapeutas cujos bloqueios aparecem junto (None = todos, [] = nenhum)."""
+    filtro_paciente, filtro_tipo, filtro_terapeuta = filtros['paciente'], filtros['tipo'], filtros['terapeuta']
+    filtro_status, filtro_sala = filtros['status'], filtros['sala']
 
-    bloqueios_fixos = BloqueioFixo.objects.select_related('terapeuta').all()
+    agendamentos = Agendamento.objects.ativos().filter(data__range=[data_inicio, data_fim]).order_by('data', 'hora_inicio')
+
+    # Terapeutas cujos bloqueios fixos aparecem na grade (None = todos)
+    terapeutas_bloqueio = None
 
     if not is_admin(request.user):
         if is_terapeuta(request.user):
             agendamentos = agendamentos.filter(terapeuta=request.user.terapeuta)
-            bloqueios_fixos = bloqueios_fixos.filter(terapeuta=request.user.terapeuta)
+            terapeutas_bloqueio = [request.user.terapeuta.id]
         else:
             agendamentos = Agendamento.objects.none()
-            bloqueios_fixos = bloqueios_fixos.none()
+            terapeutas_bloqueio = []
     else:
         if filtro_terapeuta and filtro_terapeuta != 'todos': 
             agendamentos = agendamentos.filter(terapeuta_id=filtro_terapeuta)
-            bloqueios_fixos = bloqueios_fixos.filter(terapeuta_id=filtro_terapeuta)
+            terapeutas_bloqueio = [filtro_terapeuta]
     
     if filtro_paciente:
         agendamentos = agendamentos.filter(paciente_id=filtro_paciente)
-        bloqueios_fixos = bloqueios_fixos.none()
+        terapeutas_bloqueio = []
 
     if filtro_tipo: 
         agendamentos = agendamentos.filter(tipo_atendimento=filtro_tipo)
-        bloqueios_fixos = bloqueios_fixos.none()
+        terapeutas_bloqueio = []
 
     if filtro_status: 
         agendamentos = agendamentos.filter(status=filtro_status)
-        bloqueios_fixos = bloqueios_fixos.none()
+        terapeutas_bloqueio = []
 
     if filtro_sala: 
         agendamentos = agendamentos.filter(sala_id=filtro_sala)
-        bloqueios_fixos = bloqueios_fixos.none()
+        terapeutas_bloqueio = []
 
-    horarios_grade = get_horarios_clinica()
-    delta = data_fim - data_inicio
-    dates_in_range = []
-    for i in range(delta.days + 1):
-        dates_in_range.append(data_inicio + timedelta(days=i))
+    # Só as colunas que a grade mostra: nada de instância de model por agendamento
+    itens = [ItemAgenda(*linha) for linha in agendamentos.values_list(*ItemAgenda.CAMPOS)]
 
-    agenda_map = {t.strftime('%H:%M'): {d.strftime('%Y-%m-%d'): [] for d in dates_in_range} for t in horarios_grade}
+    virtuais = ocorrencias_virtuais(request, data_inicio, data_fim, filtro_terapeuta)
+    if filtro_paciente: virtuais = [v for v in virtuais if str(v.paciente_id) == filtro_paciente]
+    if filtro_tipo: virtuais = [v for v in virtuais if v.tipo_atendimento == filtro_tipo]
+    if filtro_status: virtuais = [v for v in virtuais if v.status == filtro_status]
+    if filtro_sala: virtuais = [v for v in virtuais if str(v.sala_id) == filtro_sala]
+    if virtuais:
+        itens = sorted(itens + [ItemAgenda.de_agendamento(v) for v in virtuais], key=lambda a: (a.data, a.hora_inicio))
+    return itens, terapeutas_bloqueio
 
-    for item in agendamentos:
-        h_str = encontrar_slot_visual(item.hora_inicio, horarios_grade)
-        d_str = item.data.strftime('%Y-%m-%d')
-        
-        if h_str in agenda_map and d_str in agenda_map[h_str]:
-            item.tipo_obj = 'agendamento'
-            agenda_map[h_str][d_str].append(item)
-
-    for data_loop in dates_in_range:
-        dia_semana_loop = data_loop.weekday()
-        d_str = data_loop.strftime('%Y-%m-%d')
-        bloqueios_do_dia = [b for b in bloqueios_fixos if b.dia_semana == dia_semana_loop]
-        
-        for b in bloqueios_do_dia:
-            curr_time = datetime.combine(datetime.today(), b.hora_inicio)
-            end_time = datetime.combine(datetime.today(), b.hora_fim)
-            
-            while curr_time < end_time:
-                h_str = encontrar_slot_visual(curr_time.time(), horarios_grade)
-                
-                if h_str in agenda_map and d_str in agenda_map[h_str]:
-                    ja_existe = any(
-                        isinstance(x, dict) and x.get('id') == b.id and x.get('tipo_obj') == 'bloqueio' 
-                        for x in agenda_map[h_str][d_str]
-                    )
-                    
-                    if not ja_existe:
-                        bloqueio_visual = {
-                            'tipo_obj': 'bloqueio',
-                            'id': b.id,
-                            'terapeuta': b.terapeuta,
-                            'hora_real_inicio': b.hora_inicio,
-                            'hora_real_fim': b.hora_fim,
-                            'status': 'BLOQUEADO'
-                        }
-                        agenda_map[h_str][d_str].append(bloqueio_visual)
-                
-                curr_time += timedelta(minutes=45) 
+def montar_grade_agendamentos(request, dates_in_range, filtros):
+    """Grade da agenda (agendamentos, sessões projetadas e bloqueios) com as regras de visibilidade do usuário."""
+    itens, terapeutas_bloqueio = itens_agenda(request, dates_in_range[0], dates_in_range[-1], filtros)
+    grade = Grade(dates_in_range)
+
+    for item in itens:
+        grade.adicionar(item.data, item.hora_inicio, item)
+
+    if terapeutas_bloqueio != []:
+        # Projeção por dia da semana montada uma vez; cada data só copia a coluna pronta
+        projecao = projecao_semanal(terapeutas_bloqueio)
+        for data_loop in dates_in_range:
+            grade.carimbar(data_loop, projecao.get(data_loop.weekday(), ()))
+
+    return grade
+
+DIAS_POR_BLOCO = 7
+
+def perfil_agenda(request):
+    """O que muda a agenda visível de um usuário para outro (entra nas chaves de cache e no ETag)."""
+    if is_admin(request.user):
+        return 'admin'
+    if is_terapeuta(request.user):
+        return f'terapeuta:{request.user.terapeuta.id}'
+    return 'nenhum'
+
+def html_grade_agendamentos(request, dates_in_range, filtros, agora):
+    """Tabela renderizada de um bloco de datas, servida do cache enquanto nenhuma data dele mudar."""
+    chave = cache_agenda.chave_grade(dates_in_range, perfil_agenda(request), agora.date(), *[filtros[k] for k in sorted(filtros)])
+    grade_html = cache.get(chave) if cache_agenda.habilitado() else None
+
+    if grade_html is None:
+        grade = montar_grade_agendamentos(request, dates_in_range, filtros)
+        grade_html = render_to_string('grade_agendamentos.html', {
+            'grade': grade, 'dates_in_range': dates_in_range, 'agora': agora, 'is_admin': is_admin(request.user),
+        })
+        if cache_agenda.habilitado():
+            cache.set(chave, grade_html, cache_agenda.TEMPO_GRADE)
+    return mark_safe(grade_html)
+
+@login_required
+def lista_agendamentos(request):
+    data_inicio_get = request.GET.get('data_inicio')
+    data_fim_get = request.GET.get('data_fim')
+    filtro_hoje = request.GET.get('filtro_hoje')
+    filtro_semana = request.GET.get('filtro_semana')
+    
+    agora = timezone.localtime(timezone.now())
+    hoje = agora.date()
+    
+    if filtro_hoje:
+        data_inicio, data_fim = hoje, hoje
+    elif data_inicio_get and data_fim_get:
+        data_inicio = datetime.strptime(data_inicio_get, '%Y-%m-%d').date()
+        data_fim = datetime.strptime(data_fim_get, '%Y-%m-%d').date()
+    else:
+        start_week = hoje - timedelta(days=hoje.weekday())
+        data_inicio, data_fim = start_week, start_week + timedelta(days=6)
+        filtro_semana = '1'
+
+    filtro_paciente = request.GET.get('filtro_paciente')
+    filtro_tipo = request.GET.get('filtro_tipo')
+    filtro_terapeuta = request.GET.get('filtro_terapeuta')
+    filtro_status = request.GET.get('filtro_status')
+    filtro_sala = request.GET.get('filtro_sala')
+
+    filtros = {
+        'paciente': filtro_paciente, 'tipo': filtro_tipo, 'terapeuta': filtro_terapeuta,
+        'status': filtro_status, 'sala': filtro_sala,
+    }
+    # Link adulterado na tela: o filtro inválido é ignorado
+    for campo in filtros_invalidos(filtros):
+        filtros[campo] = None
+    dates_in_range = [data_inicio + timedelta(days=i) for i in range((data_fim - data_inicio).days + 1)]
+
+    # Períodos longos: só a primeira semana vem no HTML; as demais são pedidas em blocos ao rolar
+    blocos = [dates_in_range[i:i + DIAS_POR_BLOCO] for i in range(0, len(dates_in_range), DIAS_POR_BLOCO)]
+    grade_html = html_grade_agendamentos(request, blocos[0], filtros, agora)
+    parametros = urlencode({f'filtro_{k}': v for k, v in filtros.items() if v})
+    blocos_pendentes = [
+        {'inicio': bloco[0], 'fim': bloco[-1], 'url': f"{reverse('grade_semana')}?data_inicio={bloco[0]}&data_fim={bloco[-1]}&{parametros}"}
+        for bloco in blocos[1:]
+    ]
+    url_eventos = f"{reverse('eventos_agenda')}?data_inicio={data_inicio}&data_fim={data_fim}&{parametros}"
 
     return render(request, 'lista_agendamentos.html', {
-        'agenda_map': agenda_map,
-        'horarios_grade': horarios_grade,
+        'grade_html': grade_html,
+        'blocos_pendentes': blocos_pendentes,
+        'url_eventos': url_eventos,
         'dates_in_range': dates_in_range,
         'agora': agora,
         'data_inicio': str(data_inicio), 'data_fim': str(data_fim),
         'filtro_hoje': filtro_hoje, 'filtro_semana': filtro_semana,
         'tipos_atendimento': TIPO_ATENDIMENTO_CHOICES,
-        'pacientes': Paciente.objects.filter(ativo=True).order_by('nome'),
-        'filtro_paciente_selecionado': int(filtro_paciente) if filtro_paciente else None,
+        # Só o paciente do filtro; os demais vêm do select2 via buscar_pacientes
+        'paciente_selecionado': Paciente.objects.filter(pk=filtro_paciente).first() if filtro_paciente and filtro_paciente.isdigit() else None,
         'terapeutas': Terapeuta.objects.all().order_by('nome') if is_admin(request.user) else None,
         'salas': Sala.objects.all(),
         'filtro_tipo_selecionado': filtro_tipo,
@@ -289,6 +435,148 @@ def lista_agendamentos(request):
         'is_admin': is_admin(request.user),
     })
 
+@login_required
+def grade_semana(request):
+    """Um bloco (até uma semana) da grade de lista_agendamentos, carregado conforme a página rola."""
+    try:
+        data_inicio = datetime.strptime(request.GET.get('data_inicio', ''), '%Y-%m-%d').date()
+        data_fim = datetime.strptime(request.GET.get('data_fim', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return HttpResponse(status=400)
+    data_fim = min(data_fim, data_inicio + timedelta(days=DIAS_POR_BLOCO - 1))
+    if data_fim < data_inicio:
+        return HttpResponse(status=400)
+
+    filtros = {k: request.GET.get(f'filtro_{k}') for k in ('paciente', 'tipo', 'terapeuta', 'status', 'sala')}
+    if filtros_invalidos(filtros):
+        return HttpResponse(status=400)
+    datas = [data_inicio + timedelta(days=i) for i in range((data_fim - data_inicio).days + 1)]
+    return HttpResponse(html_grade_agendamentos(request, datas, filtros, timezone.localtime(timezone.now())))
+
+def celulas_agenda(request, datas, filtros):
+    """HTML de cada célula das `datas` (chave 'AAAA-MM-DD|slot'), igual ao da grade semanal."""
+    grade = montar_grade_agendamentos(request, datas, filtros)
+    template = get_template('celula_agenda.html')
+    admin = is_admin(request.user)
+    return {
+        f'{data}|{i}': template.render({'lista': linha.celulas[j], 'is_admin': admin})
+        for i, linha in enumerate(grade.linhas) for j, data in enumerate(grade.colunas)
+    }
+
+MAX_DIAS_EVENTOS = 92
+INTERVALO_PING = 25  # segundos sem aviso até mandar um comentário (mantém proxies com a conexão aberta)
+INTERVALO_BANCO = 5  # com AGENDA_ALTERACOES_BANCO, de quanto em quanto tempo olhar a tabela
+AGRUPAR_AVISOS = 0.2  # rajadas (lote, plano aplicado) viram um único evento
+
+async def fluxo_eventos(request, datas, filtros):
+    fila = alteracoes.assinar()
+    banco = settings.AGENDA_ALTERACOES_BANCO
+    ultimo = await sync_to_async(alteracoes.ultimo_id)() if banco else 0
+    # Hash do que o navegador já tem em cada célula; só vai o que mudou
+    enviadas = {}
+    try:
+        yield 'retry: 5000\n\n'
+        while True:
+            try:
+                alteradas = await asyncio.wait_for(fila.get(), INTERVALO_BANCO if banco else INTERVALO_PING)
+                await asyncio.sleep(AGRUPAR_AVISOS)
+                while not fila.empty():
+                    alteradas |= fila.get_nowait()
+            except asyncio.TimeoutError:
+                alteradas = set()
+                if banco:
+                    ultimo, alteradas = await sync_to_async(alteracoes.alteracoes_desde)(ultimo)
+
+            afetadas = datas if alteracoes.TUDO in alteradas else [d for d in datas if str(d) in alteradas]
+            if not afetadas:
+                yield ': ping\n\n'
+                continue
+            celulas = await sync_to_async(celulas_agenda)(request, afetadas, filtros)
+            mudaram = {chave: html for chave, html in celulas.items() if enviadas.get(chave) != hash(html)}
+            enviadas.update((chave, hash(html)) for chave, html in mudaram.items())
+            if mudaram:
+                yield f'event: celulas\ndata: {json.dumps(mudaram)}\n\n'
+    finally:
+        alteracoes.cancelar(fila)
+
+@login_required
+async def eventos_agenda(request):
+    """Agenda ao vivo: server-sent events com as células alteradas do período da tela, para a página se
+    atualizar sem recarregar. Mesmos parâmetros de grade_semana. Só funciona servido por ASGI
+    (config/asgi.py); sob WSGI responde 204, que faz o navegador desistir de reconectar."""
+    if not hasattr(request, 'scope'):
+        return HttpResponse(status=204)
+    try:
+        data_inicio = datetime.strptime(request.GET.get('data_inicio', ''), '%Y-%m-%d').date()
+        data_fim = datetime.strptime(request.GET.get('data_fim', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return HttpResponse(status=400)
+    data_fim = min(data_fim, data_inicio + timedelta(days=MAX_DIAS_EVENTOS - 1))
+    if data_fim < data_inicio:
+        return HttpResponse(status=400)
+
+    filtros = {k: request.GET.get(f'filtro_{k}') for k in ('paciente', 'tipo', 'terapeuta', 'status', 'sala')}
+    if filtros_invalidos(filtros):
+        return HttpResponse(status=400)
+    datas = [data_inicio + timedelta(days=i) for i in range((data_fim - data_inicio).days + 1)]
+    resposta = StreamingHttpResponse(fluxo_eventos(request, datas, filtros), content_type='text/event-stream')
+    resposta['Cache-Control'] = 'no-cache'
+    resposta['X-Accel-Buffering'] = 'no'  # nginx: não segurar os eventos no buffer
+    return resposta
+
+MAX_DIAS_FEED = 31
+
+@login_required
+def feed_agenda(request):
+    """Agenda em JSON para telas que ficam consultando (recepção, tablets dos terapeutas).
+
+    GET data_inicio/data_fim (padrão: semana atual, até 31 dias), terapeuta, sala. Mesmas regras de
+    visibilidade de lista_agendamentos. Responde 304 sem tocar no banco quando o If-None-Match ou o
+    If-Modified-Since ainda valem para as versões das datas do período.
+
+    Chaves: ag = agendamentos [id, d(ata), hi/hf (horas), st(atus), tp (tipo), p/pn, t/tn, s/sn (ids e nomes
+    de paciente, terapeuta, sala), fx (grade fixa), v (1 = sessão projetada, ainda sem id)];
+    bl = bloqueios [d, hi, hf, t, tn].
+    """
+    hoje = timezone.localdate()
+    try:
+        data_inicio = datetime.strptime(request.GET['data_inicio'], '%Y-%m-%d').date() if request.GET.get('data_inicio') else hoje - timedelta(days=hoje.weekday())
+        data_fim = datetime.strptime(request.GET['data_fim'], '%Y-%m-%d').date() if request.GET.get('data_fim') else data_inicio + timedelta(days=6)
+    except ValueError:
+        return JsonResponse({'erro': 'Datas inválidas.'}, status=400)
+    if data_fim < data_inicio or (data_fim - data_inicio).days >= MAX_DIAS_FEED:
+        return JsonResponse({'erro': f'Período inválido (máximo de {MAX_DIAS_FEED} dias).'}, status=400)
+
+    filtros = {'paciente': None, 'tipo': None, 'status': None,
+               'terapeuta': request.GET.get('terapeuta') or None, 'sala': request.GET.get('sala') or None}
+    invalidos = filtros_invalidos(filtros)
+    if invalidos:
+        return JsonResponse({'erro': f'Filtro inválido: {", ".join(invalidos)}.'}, status=400)
+    datas = [data_inicio + timedelta(days=i) for i in range((data_fim - data_inicio).days + 1)]
+
+    versao, instante = cache_agenda.versao_periodo(datas, 'feed', perfil_agenda(request), hoje, filtros['terapeuta'], filtros['sala'])
+    etag = f'"{versao}"'
+    resposta = get_conditional_response(request, etag=etag, last_modified=instante) if cache_agenda.habilitado() else None
+
+    if resposta is None:
+        itens, terapeutas_bloqueio = itens_agenda(request, data_inicio, data_fim, filtros)
+        hora = lambda h: h.strftime('%H:%M') if h else None
+        agendamentos = [{
+            'id': i.id, 'd': i.data.isoformat(), 'hi': hora(i.hora_inicio), 'hf': hora(i.hora_fim),
+            'st': i.status, 'tp': i.tipo_atendimento,
+            'p': i.paciente_id, 'pn': i.paciente_nome, 't': i.terapeuta_id, 'tn': i.terapeuta_nome,
+            's': i.sala_id, 'sn': i.sala_nome, 'fx': i.agenda_fixa, 'v': int(i.virtual),
+        } for i in itens]
+        bloqueios = [] if terapeutas_bloqueio == [] else [
+            {'d': data.isoformat(), 'hi': hora(b.hora_inicio), 'hf': hora(b.hora_fim), 't': b.terapeuta_id, 'tn': b.terapeuta.nome}
+            for data in datas for b in bloqueios_do_dia(data.weekday(), terapeutas_bloqueio)
+        ]
+        resposta = JsonResponse({'inicio': str(data_inicio), 'fim': str(data_fim), 'ag': agendamentos, 'bl': bloqueios})
+
+    cache_agenda.marcar_versao(resposta, etag, instante)
+    patch_cache_control(resposta, private=True, no_cache=True)
+    return resposta
+
 @login_required
 def novo_agendamento(request):
     if not is_admin(request.user):
@@ -298,7 +586,9 @@ def novo_agendamento(request):
     if request.method == 'POST':
         form = AgendamentoForm(request.POST)
     else:
-        form = AgendamentoForm()
+        # Pré-preenchimento vindo da busca de horários livres
+        campos = ['paciente', 'terapeuta', 'sala', 'data', 'hora_inicio', 'hora_fim']
+        form = AgendamentoForm(initial={c: request.GET[c] for c in campos if request.GET.get(c)})
 
     if request.method == 'POST' and form.is_valid():
         try:
@@ -310,6 +600,8 @@ def novo_agendamento(request):
                 if conflitos: msg += f" (Conflitos ignorados: {', '.join(conflitos)})"
                 if conflitos: messages.warning(request, msg)
                 else: messages.success(request, msg)
+                for aviso in form.avisos:
+                    messages.warning(request, aviso)
                 return redirect('lista_agendamentos')
             else:
                 messages.error(request, f"Falha: Datas ocupadas ({', '.join(conflitos)}).")
@@ -325,52 +617,89 @@ def lista_agendas_fixas(request):
         return redirect('dashboard')
         
     agendas = AgendaFixa.objects.filter(ativo=True).select_related('paciente', 'terapeuta', 'sala')
-    bloqueios = BloqueioFixo.objects.select_related('terapeuta').all()
     
     terapeuta_id = request.GET.get('terapeuta')
     if terapeuta_id:
         agendas = agendas.filter(terapeuta_id=terapeuta_id)
-        bloqueios = bloqueios.filter(terapeuta_id=terapeuta_id)
     
-    horarios_grade = get_horarios_clinica()
-    range_dias = range(6) 
-    
-    agenda_map = {t.strftime('%H:%M'): {d: [] for d in range_dias} for t in horarios_grade}
+    grade = Grade(range(6))
     
     for item in agendas:
-        h_str = encontrar_slot_visual(item.hora_inicio, horarios_grade)
-        d = item.dia_semana
-        if h_str in agenda_map and d in range_dias:
-            item.tipo_obj = 'fixo' 
-            agenda_map[h_str][d].append(item)
-
-    for b in bloqueios:
-        if b.dia_semana in range_dias:
-            curr_time = datetime.combine(datetime.today(), b.hora_inicio)
-            end_time = datetime.combine(datetime.today(), b.hora_fim)
-            
-            while curr_time < end_time:
-                h_str = encontrar_slot_visual(curr_time.time(), horarios_grade)
-                if h_str in agenda_map:
-                    ja_existe = any(x.id == b.id and getattr(x, 'tipo_obj', '') == 'bloqueio' for x in agenda_map[h_str][b.dia_semana])
-                    if not ja_existe:
-                        b.tipo_obj = 'bloqueio'
-                        agenda_map[h_str][b.dia_semana].append(b)
-                
-                curr_time += timedelta(minutes=45)
+        item.tipo_obj = 'fixo' 
+        grade.adicionar(item.dia_semana, item.hora_inicio, item)
+
+    projecao = projecao_semanal([terapeuta_id] if terapeuta_id else None)
+    for dia in grade.colunas:
+        grade.carimbar(dia, projecao.get(dia, ()))
             
     nomes_dias = ['Segunda', 'Terça', 'Quarta', 'Quinta', 'Sexta', 'Sábado']
 
     return render(request, 'lista_agendas_fixas.html', {
-        'agenda_map': agenda_map,
-        'horarios_grade': horarios_grade,
+        'grade': grade,
         'nomes_dias': nomes_dias,
         'terapeutas': Terapeuta.objects.all().order_by('nome'),
         'is_admin': True, 
         'filtro_terapeuta': terapeuta_id,
+        'tarefa_id': request.GET.get('tarefa'),
         'bloqueio_form': BloqueioFixoForm() 
     })
 
+@login_required
+def status_tarefa(request, tarefa_id):
+    if not is_admin(request.user):
+        return JsonResponse({'erro': 'Acesso restrito.'}, status=403)
+
+    tarefa = get_object_or_404(TarefaMaterializacao, id=tarefa_id)
+    return JsonResponse({
+        'id': tarefa.id,
+        'status': tarefa.status,
+        'status_display': tarefa.get_status_display(),
+        'progresso': tarefa.progresso,
+        'processados': tarefa.processados,
+        'total': tarefa.total,
+        'resultado': tarefa.resultado,
+        'erro': tarefa.erro,
+    })
+
+@login_required
+def horarios_livres(request):
+    """Próximos horários livres para reposição (JSON). Janela padrão: 4 semanas a partir de hoje."""
+    if not is_admin(request.user):
+        return JsonResponse({'erro': 'Acesso restrito.'}, status=403)
+
+    hoje = timezone.localdate()
+    try:
+        data_inicio = datetime.strptime(request.GET['data_inicio'], '%Y-%m-%d').date() if request.GET.get('data_inicio') else hoje
+        data_fim = datetime.strptime(request.GET['data_fim'], '%Y-%m-%d').date() if request.GET.get('data_fim') else data_inicio + timedelta(weeks=4)
+        duracao = int(request.GET.get('duracao') or 45)
+        quantidade = min(int(request.GET.get('quantidade') or 10), 50)
+    except ValueError:
+        return JsonResponse({'erro': 'Parâmetros inválidos.'}, status=400)
+    if data_fim < data_inicio or not 0 < duracao <= 240:
+        return JsonResponse({'erro': 'Parâmetros inválidos.'}, status=400)
+
+    paciente_id = request.GET.get('paciente') or None
+    livres = buscar_horarios_livres(
+        max(data_inicio, hoje), data_fim, duracao=duracao, paciente=paciente_id,
+        terapeuta=request.GET.get('terapeuta') or None, especialidade=request.GET.get('especialidade') or None,
+        quantidade=quantidade,
+    )
+
+    resultado = []
+    for h in livres:
+        params = {
+            'terapeuta': h['terapeuta'].id, 'sala': h['sala'].id, 'data': h['data'].isoformat(),
+            'hora_inicio': h['hora_inicio'].strftime('%H:%M'), 'hora_fim': h['hora_fim'].strftime('%H:%M'),
+        }
+        if paciente_id: params['paciente'] = paciente_id
+        resultado.append({
+            'terapeuta': h['terapeuta'].nome, 'sala': h['sala'].nome,
+            'data': h['data'].strftime('%d/%m/%Y'), 'dia_semana': dict(AgendaFixa.DIAS_DA_SEMANA)[h['data'].weekday()],
+            'hora_inicio': params['hora_inicio'], 'hora_fim': params['hora_fim'],
+            'url': f"{reverse('novo_agendamento')}?{urlencode(params)}",
+        })
+    return JsonResponse({'horarios': resultado})
+
 @login_required
 def adicionar_bloqueio(request):
     filtro_terapeuta = request.GET.get('terapeuta')
@@ -410,6 +739,24 @@ def excluir_bloqueio(request, bloqueio_id):
         url_destino += f"?terapeuta={filtro_terapeuta}"
     return redirect(url_destino)
 
+def assinatura_form_grade(form):
+    """Identifica os dados do formulário usados para simular um plano de materialização."""
+    dados = form.cleaned_data
+    campos = ['paciente', 'terapeuta', 'modalidade', 'sala', 'dia_semana', 'hora_inicio', 'hora_fim', 'data_inicio', 'data_fim', 'ativo']
+    return (form.instance.pk,) + tuple(str(getattr(dados.get(c), 'pk', dados.get(c))) for c in campos)
+
+def simular_grade(request, form, titulo):
+    """Mostra, no próprio formulário, o que a materialização faria com a grade informada."""
+    grade = form.save(commit=False)
+    if grade.pk:
+        plano = planejar_ressincronizacao(grade)
+    else:
+        plano = planejar_agenda_futura(agenda_especifica=grade)
+    return render(request, 'form_agenda_fixa.html', {
+        'form': form, 'titulo': titulo, 'plano': plano,
+        'plano_token': guardar_plano(plano, assinatura_form_grade(form)),
+    })
+
 @login_required
 def nova_agenda_fixa(request):
     if not is_admin(request.user):
@@ -419,10 +766,25 @@ def nova_agenda_fixa(request):
     if request.method == 'POST':
         form = AgendaFixaForm(request.POST)
         if form.is_valid():
+            if request.POST.get('acao') == 'previa':
+                return simular_grade(request, form, 'Nova Agenda Fixa')
+
+            plano = recuperar_plano(request.POST.get('plano_token'), assinatura_form_grade(form))
             nova_grade = form.save()
-            qtd = gerar_agenda_futura(agenda_especifica=nova_grade) 
-            messages.success(request, f"Regra criada! {qtd} agendamentos foram lançados no calendário.")
-            return redirect(f"{reverse('lista_agendas_fixas')}?terapeuta={nova_grade.terapeuta.id}")
+            destino = f"{reverse('lista_agendas_fixas')}?terapeuta={nova_grade.terapeuta.id}"
+            for aviso in form.avisos:
+                messages.warning(request, aviso)
+
+            if plano and nova_grade.ativo:
+                # Reaproveita o plano já simulado: só falta gravar
+                plano.vincular(nova_grade)
+                qtd = aplicar_plano(plano)
+                messages.success(request, f"Regra criada! {qtd} agendamentos foram lançados no calendário.")
+                return redirect(destino)
+
+            tarefa = enfileirar_materializacao(nova_grade)
+            messages.success(request, f"Regra criada! Os agendamentos estão sendo lançados no calendário (tarefa #{tarefa.id}).")
+            return redirect(f"{destino}&tarefa={tarefa.id}")
             
     else:
         form = AgendaFixaForm()
@@ -438,37 +800,31 @@ def editar_agenda_fixa(request, id):
         return redirect('dashboard')
 
     if request.method == 'POST':
-        dia_semana_antigo = agenda.dia_semana
         form = AgendaFixaForm(request.POST, instance=agenda)
         if form.is_valid():
-            nova_agenda = form.save()
-            hoje = timezone.now().date()
-            
-            if nova_agenda.data_fim:
-                Agendamento.objects.filter(
-                    agenda_fixa=nova_agenda, data__gt=nova_agenda.data_fim, status='AGUARDANDO'
-                ).delete()
-
-            qs_futuros = Agendamento.objects.filter(
-                agenda_fixa=nova_agenda, data__gte=hoje, status='AGUARDANDO'
-            )
-            
-            msg_extra = ""
-            if nova_agenda.dia_semana != dia_semana_antigo:
-                total_removidos = qs_futuros.count()
-                qs_futuros.delete()
-                msg_extra = f" ({total_removidos} horários realocados para o novo dia)."
+            if request.POST.get('acao') == 'previa':
+                return simular_grade(request, form, 'Editar Agenda Fixa')
+
+            plano = recuperar_plano(request.POST.get('plano_token'), assinatura_form_grade(form))
+            nova_agenda = form.save(commit=False)
+            if plano:
+                plano.vincular(nova_agenda)
             else:
-                total_atualizados = qs_futuros.update(
-                    terapeuta=nova_agenda.terapeuta, sala=nova_agenda.sala,
-                    hora_inicio=nova_agenda.hora_inicio, hora_fim=nova_agenda.hora_fim
-                )
-                if total_atualizados > 0:
-                    msg_extra = f" ({total_atualizados} agendamentos futuros atualizados)."
+                plano = planejar_ressincronizacao(nova_agenda)
+
+            # Grade e agendamentos mudam juntos ou nada muda
+            with transaction.atomic():
+                nova_agenda.save()
+                aplicar_plano(plano)
+
+            msg_extra = ""
+            alterados = len(plano.atualizar) + len(plano.criar) + len(plano.remover)
+            if alterados:
+                msg_extra = f" ({len(plano.atualizar)} agendamentos futuros ajustados, {len(plano.criar)} criados, {len(plano.remover)} removidos)."
+            messages.success(request, f"Agenda Fixa salva.{msg_extra}")
+            for aviso in form.avisos:
+                messages.warning(request, aviso)
 
-            gerar_agenda_futura(agenda_especifica=nova_agenda)
-            messages.success(request, f"Agenda Fixa salva e sincronizada.{msg_extra}")
-            
             return redirect(f"{reverse('lista_agendas_fixas')}?terapeuta={nova_agenda.terapeuta.id}")
             
     else:
@@ -495,6 +851,7 @@ def excluir_agenda_fixa(request, id):
         if limpar:
             hoje = timezone.now().date()
             qtd = Agendamento.objects.filter(agenda_fixa=agenda, data__gte=hoje, status='AGUARDANDO').update(deletado=True)
+            cache_agenda.invalidar_tudo()
             msg_extra = f" {qtd} agendamentos futuros foram removidos."
             
         messages.success(request, f"Agenda fixa desativada.{msg_extra}")
@@ -587,6 +944,48 @@ def reposicao_agendamento(request, agendamento_id):
         'precisa_justificar': precisa_justificar
     })
 
+@login_required
+def abrir_ocorrencia(request, agenda_id, data):
+    """Materializa (POST) uma sessão projetada da grade e segue para a ação pedida."""
+    grade = get_object_or_404(AgendaFixa.objects.select_related('terapeuta'), id=agenda_id, ativo=True)
+    try:
+        data = datetime.strptime(data, '%Y-%m-%d').date()
+    except ValueError:
+        raise Http404
+    if data.weekday() != grade.dia_semana or (grade.data_fim and data > grade.data_fim):
+        raise Http404
+
+    params = request.GET.copy()
+    acao = params.pop('acao', ['atender'])[0]
+    filtros = params.urlencode()
+    url_retorno = redirect('lista_agendamentos').url
+    if filtros: url_retorno += f'?{filtros}'
+
+    # Só POST grava: um GET (prefetch do navegador, robô) nunca materializa a sessão
+    if request.method != 'POST' or (not is_admin(request.user) and grade.terapeuta.usuario != request.user):
+        return redirect(url_retorno)
+
+    if acao == 'excluir':
+        messages.error(request, "Este é um horário de Agenda Fixa. Não é possível excluí-lo individualmente.")
+        return redirect(url_retorno)
+
+    agendamento = materializar_ocorrencia(grade, data)
+    if not agendamento and data < timezone.localdate():
+        # Data passada só é projetada depois da marca d'água; antes dela a sessão nunca foi gravada
+        messages.error(request, "Esta sessão da grade já passou e não está na agenda. Registre um agendamento avulso.")
+        return redirect(url_retorno)
+    if not agendamento:
+        messages.error(request, "Este horário já está ocupado por outro agendamento.")
+        return redirect(url_retorno)
+
+    destinos = {
+        'atender': 'realizar_consulta', 'falta': 'marcar_falta',
+        'repor': 'reposicao_agendamento', 'confirmar': 'confirmar_agendamento',
+    }
+    url_destino = reverse(destinos.get(acao, 'realizar_consulta'), args=[agendamento.id])
+    if filtros: url_destino += f'?{filtros}'
+    return redirect(url_destino)
+
 @login_required
 def confirmar_agendamento(request, agendamento_id):
     agendamento = get_object_or_404(Agendamento.objects.ativos(), id=agendamento_id)
@@ -732,14 +1131,28 @@ def limpar_dia(request):
         data = request.POST.get('data_para_limpar')
         terapeuta_id = request.POST.get('terapeuta_id')
 
+        try:
+            data = datetime.strptime(data, '%Y-%m-%d').date() if data else None
+            terapeutas = [int(terapeuta_id)] if terapeuta_id and terapeuta_id != 'todos' else None
+        except ValueError:
+            messages.error(request, "Data ou terapeuta inválido.")
+            return redirect('lista_agendamentos')
+
         if data: 
             qs = Agendamento.objects.ativos().filter(data=data).exclude(status='REALIZADO')
             
-            if terapeuta_id and terapeuta_id != 'todos':
-                qs = qs.filter(terapeuta_id=terapeuta_id)
+            if terapeutas:
+                qs = qs.filter(terapeuta_id__in=terapeutas)
 
-            total = qs.update(deletado=True)
-            messages.info(request, f"Agenda limpa. {total} agendamentos removidos.")
+            with transaction.atomic():
+                total = qs.update(deletado=True)
+                # Sessões da grade ainda só projetadas: gravadas já excluídas, para não voltarem ao dia
+                virtuais = projetar_ocorrencias(data, data, terapeutas)
+                for ag in virtuais:
+                    ag.deletado = True
+                Agendamento.objects.bulk_create(virtuais)
+            cache_agenda.invalidar_datas([data])
+            messages.info(request, f"Agenda limpa. {total + len(virtuais)} agendamentos removidos.")
             
     return redirect('lista_agendamentos')
 
@@ -778,7 +1191,7 @@ def lista_consultas_geral(request):
     if data_inicio and data_fim: agendamentos = agendamentos.filter(data__range=[data_inicio, data_fim])
     
     if busca_nome:
-        busca_limpa = remover_acentos(busca_nome).lower()
+        busca_limpa = chave_busca(busca_nome)
         agendamentos = agendamentos.filter(paciente__nome_search__icontains=busca_limpa)
 
     if filtro_tipo: agendamentos = agendamentos.filter(tipo_atendimento=filtro_tipo)
@@ -806,6 +1219,28 @@ def lista_consultas_geral(request):
         'is_admin': is_admin(request.user)
     })
 
+@login_required
+def buscar_prontuarios(request):
+    """Busca de texto nas evoluções, com o trecho encontrado em destaque. Donos veem todos os
+    prontuários, terapeutas os dos seus pacientes; o Administrativo não tem acesso."""
+    if is_admin(request.user) and not is_dono(request.user):
+        messages.error(request, "Perfil Administrativo não tem acesso a prontuários.")
+        return redirect('lista_agendamentos')
+    if not is_dono(request.user) and not is_terapeuta(request.user):
+        messages.error(request, "Sem permissão.")
+        return redirect('dashboard')
+
+    termo = request.GET.get('q', '').strip()
+    terapeuta = None if is_dono(request.user) else request.user.terapeuta
+    resultados, proximo = buscar_evolucoes(termo, terapeuta=terapeuta, apos=request.GET.get('apos'))
+
+    return render(request, 'busca_prontuarios.html', {
+        'termo': termo,
+        'resultados': resultados,
+        'url_proxima': f"?{urlencode({'q': termo, 'apos': proximo})}" if proximo else None,
+        'primeira_pagina': not request.GET.get('apos'),
+    })
+
 @dono_required
 def cadastrar_equipe(request):
     setup_grupos()
@@ -841,7 +1276,7 @@ def lista_terapeutas(request):
     busca = request.GET.get('q')
     filtro_esp = request.GET.get('especialidade')
     terapeutas = Terapeuta.objects.all().select_related('usuario').order_by('nome')
-    if busca: terapeutas = terapeutas.filter(nome__icontains=busca)
+    if busca: terapeutas = terapeutas.filter(nome_search__icontains=chave_busca(busca))
     if filtro_esp: terapeutas = terapeutas.filter(especialidade=filtro_esp)
     return render(request, 'lista_terapeutas.html', {
         'terapeutas': terapeutas, 'is_admin': is_admin(request.user),
@@ -868,7 +1303,7 @@ def ocupacao_salas(request):
     todas_salas = Sala.objects.all()
     
     def sort_key(sala):
-        nome = remover_acentos(sala.nome).lower()
+        nome = sala.nome_search or chave_busca(sala.nome)
         if '1a' in nome: return 1.5
         if 'reuniao' in nome: return 8.5
         numeros = re.findall(r'\d+', nome)
@@ -876,7 +1311,13 @@ def ocupacao_salas(request):
         return 999.0
     
     salas = sorted(todas_salas, key=sort_key)
+    mapa = MapaOcupacao.carregar(data_atual, data_atual)
+    for sala in salas:
+        sala.utilizacao = round(mapa.utilizacao(SALA, sala.id, data_atual) * 100)
     agendamentos = Agendamento.objects.ativos().filter(data=data_atual).select_related('paciente', 'terapeuta', 'sala', 'agenda_fixa')
+    virtuais = ocorrencias_virtuais(request, data_atual, data_atual)
+    if virtuais:
+        agendamentos = list(agendamentos) + virtuais
     agrupados = {}
 
     for item in agendamentos:
@@ -897,23 +1338,19 @@ def ocupacao_salas(request):
                 'hora_real': item.hora_inicio 
             }
 
-    horarios_grade = get_horarios_clinica()
-    agenda_map = {t.strftime('%H:%M'): {s.id: [] for s in salas} for t in horarios_grade}
+    grade = Grade([s.id for s in salas])
 
     for (h_str, s_id, p_id), dados in agrupados.items():
-        h_visual = encontrar_slot_visual(dados['hora_real'], horarios_grade)
-        if h_visual in agenda_map and s_id in agenda_map[h_visual]:
-            texto_terapeutas = " + ".join(dados['terapeutas'])
-            item_display = {
-                'paciente_nome': dados['paciente_nome'],
-                'terapeuta_nome': texto_terapeutas,
-                'agenda_fixa': dados['agenda_fixa']
-            }
-            agenda_map[h_visual][s_id].append(item_display)
+        texto_terapeutas = " + ".join(dados['terapeutas'])
+        item_display = {
+            'paciente_nome': dados['paciente_nome'],
+            'terapeuta_nome': texto_terapeutas,
+            'agenda_fixa': dados['agenda_fixa']
+        }
+        grade.adicionar(s_id, dados['hora_real'], item_display)
 
     return render(request, 'ocupacao_salas.html', {
-        'agenda_map': agenda_map,
-        'horarios_grade': horarios_grade,
+        'grade': grade,
         'salas': salas,
         'data_atual': data_atual,
         'data_input': data_atual.strftime('%Y-%m-%d'),